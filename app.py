@@ -2,18 +2,49 @@
 import os
 import sqlite3
 import json
+import hashlib
+import hmac
+import base64
+import threading
+import time
+import atexit
+import bisect
+import itertools
+import csv
+import gzip
+import zlib
+import mimetypes
+import multiprocessing
+import queue
+import shutil
+import tarfile
+import tempfile
+import unicodedata
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FuturesTimeout
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
-from io import BytesIO
+from io import BytesIO, StringIO
 import re
+import struct
 from functools import wraps
+from urllib.parse import quote, urlparse
 import requests
+import click
+
+try:
+    import fcntl
+except ImportError:  # Windows: ไม่มี flock กันซ้ำได้แค่ภายใน process
+    fcntl = None
 
 from flask import (
     Flask, render_template, request, redirect,
-    url_for, session, flash, send_file, abort, Response
+    url_for, session, flash, send_file, abort, Response,
+    send_from_directory, g, has_request_context,
 )
 
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
 
 app = Flask(__name__)
 
@@ -51,7 +82,10 @@ def verify_turnstile(token, remote_ip=None):
 @app.context_processor
 def inject_globals():
     # ให้ใช้ตัวแปร TURNSTILE_SITE_KEY ได้ในทุก template
-    return {"TURNSTILE_SITE_KEY": TURNSTILE_SITE_KEY}
+    return {
+        "TURNSTILE_SITE_KEY": TURNSTILE_SITE_KEY,
+        "DIRECT_PROXY_ENABLED": DIRECT_PROXY_ENABLED,
+    }
 
 
 
@@ -109,6 +143,20 @@ def ensure_episode_thumbnail_column(conn: sqlite3.Connection):
 
 
 
+def ensure_episode_file_columns(conn: sqlite3.Connection):
+    """เพิ่มคอลัมน์ file_size / file_sha256 ให้ตาราง episodes (ขนาดและแฮชของไฟล์ที่โหลดจาก Drive แล้วตรวจผ่าน)
+    และ download_state: 'pending' รอโหลดไฟล์จากคิวนำเข้า, 'failed' โหลดไม่สำเร็จ, NULL ไม่มีงานค้าง"""
+    cur = conn.execute("PRAGMA table_info(episodes)")
+    cols = [row[1] for row in cur.fetchall()]
+    if "file_size" not in cols:
+        conn.execute("ALTER TABLE episodes ADD COLUMN file_size INTEGER")
+    if "file_sha256" not in cols:
+        conn.execute("ALTER TABLE episodes ADD COLUMN file_sha256 TEXT")
+    if "download_state" not in cols:
+        conn.execute("ALTER TABLE episodes ADD COLUMN download_state TEXT")
+    conn.commit()
+
+
 def ensure_visibility_columns(conn: sqlite3.Connection):
     """เพิ่มคอลัมน์ is_active ให้ตาราง series และ episodes ถ้ายังไม่มี (ใช้เปิด/ปิดการดู)."""
     # ตาราง series
@@ -125,6 +173,186 @@ def ensure_visibility_columns(conn: sqlite3.Connection):
 
 
 
+def ensure_series_stats(conn: sqlite3.Connection):
+    """คอลัมน์สถิติของเรื่อง (จำนวนตอน, จำนวนตอนที่เปิดให้ดู, วันที่เพิ่มตอนล่าสุด)
+    ดูแลด้วย trigger บนตาราง episodes หน้ารวมเรื่องจึงไม่ต้องนับจาก episodes ทุกครั้ง"""
+    cur = conn.execute("PRAGMA table_info(series)")
+    cols = [row[1] for row in cur.fetchall()]
+    added = False
+    if "episode_count" not in cols:
+        conn.execute("ALTER TABLE series ADD COLUMN episode_count INTEGER NOT NULL DEFAULT 0")
+        added = True
+    if "active_episode_count" not in cols:
+        conn.execute("ALTER TABLE series ADD COLUMN active_episode_count INTEGER NOT NULL DEFAULT 0")
+        added = True
+    if "last_episode_at" not in cols:
+        conn.execute("ALTER TABLE series ADD COLUMN last_episode_at TEXT")
+        added = True
+
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_episodes_series ON episodes (series_id, episode_number)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_series_recent ON series (COALESCE(last_episode_at, created_at))"
+    )
+
+    # เพิ่มตอน: บวกตัวนับแบบเพิ่มทีละหนึ่ง
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_episodes_stats_insert
+        AFTER INSERT ON episodes
+        BEGIN
+            UPDATE series SET
+                episode_count = episode_count + 1,
+                active_episode_count = active_episode_count
+                    + (CASE WHEN COALESCE(NEW.is_active, 1) != 0 THEN 1 ELSE 0 END),
+                last_episode_at = CASE
+                    WHEN last_episode_at IS NULL OR NEW.created_at > last_episode_at
+                    THEN NEW.created_at ELSE last_episode_at END
+            WHERE id = NEW.series_id;
+        END
+        """
+    )
+    # ลบตอน: ลบตัวนับ แล้วหา created_at ล่าสุดใหม่ (ใช้ index series_id)
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_episodes_stats_delete
+        AFTER DELETE ON episodes
+        BEGIN
+            UPDATE series SET
+                episode_count = episode_count - 1,
+                active_episode_count = active_episode_count
+                    - (CASE WHEN COALESCE(OLD.is_active, 1) != 0 THEN 1 ELSE 0 END),
+                last_episode_at = (
+                    SELECT MAX(created_at) FROM episodes WHERE series_id = OLD.series_id
+                )
+            WHERE id = OLD.series_id;
+        END
+        """
+    )
+    # เปิด/ปิดตอน หรือย้ายเรื่อง: คำนวณใหม่เฉพาะเรื่องที่เกี่ยวข้อง
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_episodes_stats_update
+        AFTER UPDATE OF is_active, series_id, created_at ON episodes
+        BEGIN
+            UPDATE series SET
+                episode_count = (
+                    SELECT COUNT(*) FROM episodes WHERE series_id = series.id
+                ),
+                active_episode_count = (
+                    SELECT COUNT(*) FROM episodes
+                    WHERE series_id = series.id AND COALESCE(is_active, 1) != 0
+                ),
+                last_episode_at = (
+                    SELECT MAX(created_at) FROM episodes WHERE series_id = series.id
+                )
+            WHERE id IN (OLD.series_id, NEW.series_id);
+        END
+        """
+    )
+
+    if added:
+        refresh_series_stats(conn)
+    conn.commit()
+
+
+def refresh_series_stats(conn: sqlite3.Connection):
+    """คำนวณสถิติของทุกเรื่องใหม่จาก episodes (ใช้ตอนเพิ่มคอลัมน์ครั้งแรก) ไม่ commit เอง"""
+    conn.execute(
+        """
+        UPDATE series SET
+            episode_count = (
+                SELECT COUNT(*) FROM episodes WHERE series_id = series.id
+            ),
+            active_episode_count = (
+                SELECT COUNT(*) FROM episodes
+                WHERE series_id = series.id AND COALESCE(is_active, 1) != 0
+            ),
+            last_episode_at = (
+                SELECT MAX(created_at) FROM episodes WHERE series_id = series.id
+            )
+        """
+    )
+
+
+def ensure_catalog_version(conn: sqlite3.Connection):
+    """ตัวนับเวอร์ชันของแคตตาล็อก (series + episodes) เก็บในตาราง app_state
+    เพิ่มค่าอัตโนมัติด้วย trigger ทุกครั้งที่มีการเพิ่ม/แก้ไข/ลบ ไม่ว่าจะมาจาก route ไหน"""
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS app_state (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+        """
+    )
+    conn.execute(
+        "INSERT OR IGNORE INTO app_state (key, value) VALUES ('catalog_version', 1)"
+    )
+    conn.execute(
+        "INSERT OR IGNORE INTO app_state (key, value) VALUES ('catalog_updated_at', CAST(strftime('%s', 'now') AS INTEGER))"
+    )
+    for table in ("series", "episodes"):
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            conn.execute(
+                f"""
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_catalog_version_{event.lower()}
+                AFTER {event} ON {table}
+                BEGIN
+                    UPDATE app_state SET value = value + 1 WHERE key = 'catalog_version';
+                END
+                """
+            )
+            # เวลาแก้ไขล่าสุด (วินาที) ใช้เป็น Last-Modified ของหน้าแคตตาล็อก
+            conn.execute(
+                f"""
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_catalog_touched_{event.lower()}
+                AFTER {event} ON {table}
+                BEGIN
+                    UPDATE app_state SET value = CAST(strftime('%s', 'now') AS INTEGER)
+                    WHERE key = 'catalog_updated_at';
+                END
+                """
+            )
+    conn.commit()
+
+
+def ensure_visibility_generation(conn: sqlite3.Connection):
+    """เลข generation ที่เพิ่มขึ้นทุกครั้งที่เปิด/ปิด ลบเรื่อง/ตอน หรือเพิ่มแถวที่ปิดอยู่ (เช่นคืนค่าจากไฟล์สำรอง)
+    ใช้ยกเลิก stream token ที่ออกไปแล้วทั้งหมดในครั้งเดียว และให้ดัชนีแถวที่ถูกปิดโหลดใหม่
+    (การเปลี่ยนไฟล์ของตอนไม่ต้องยกเลิกทุก token ตรวจกับ file_path ตอน verify แทน)"""
+    conn.execute(
+        "INSERT OR IGNORE INTO app_state (key, value) VALUES ('visibility_generation', 1)"
+    )
+    triggers = {
+        "series_toggle": "AFTER UPDATE OF is_active ON series",
+        "series_delete": "AFTER DELETE ON series",
+        # แถวใหม่ที่เปิดอยู่ไม่ต้องยกเลิก token (เพิ่มตอนปกติจึงไม่กระทบคนที่ดูอยู่)
+        "series_insert": "AFTER INSERT ON series WHEN NEW.is_active = 0",
+        "episodes_toggle": "AFTER UPDATE OF is_active ON episodes",
+        "episodes_delete": "AFTER DELETE ON episodes",
+        "episodes_insert": "AFTER INSERT ON episodes WHEN NEW.is_active = 0",
+    }
+    # trigger รุ่นก่อนจับ file_path ด้วย (ทุกครั้งที่โหลดไฟล์ Drive ใหม่ token ทั้งระบบหลุด) สร้างใหม่
+    old = conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'trg_episodes_toggle_visibility_generation'"
+    ).fetchone()
+    if old and "file_path" in old[0]:
+        conn.execute("DROP TRIGGER trg_episodes_toggle_visibility_generation")
+    for name, event in triggers.items():
+        conn.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{name}_visibility_generation
+            {event}
+            BEGIN
+                UPDATE app_state SET value = value + 1 WHERE key = 'visibility_generation';
+            END
+            """
+        )
+    conn.commit()
+
+
 def generate_user_key() -> str:
     """สร้าง key สำหรับผู้ใช้ ใช้ตัวอักษร hex แบบง่าย ๆ"""
     return "U" + os.urandom(8).hex().upper()
@@ -156,6 +384,211 @@ def ensure_user_extra_columns(conn: sqlite3.Connection):
     conn.commit()
 
 
+_WATCH_ROLLUP_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS {name} (
+        user_id INTEGER NOT NULL,
+        series_id INTEGER NOT NULL,
+        last_episode_id INTEGER,
+        last_watched_at TEXT NOT NULL,
+        view_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, series_id),
+        FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE,
+        FOREIGN KEY(series_id) REFERENCES series(id) ON DELETE CASCADE,
+        FOREIGN KEY(last_episode_id) REFERENCES episodes(id) ON DELETE SET NULL
+    )
+"""
+
+
+def ensure_watch_rollup_table(conn: sqlite3.Connection):
+    """สร้างตารางสรุป "ดูต่อ" (หนึ่งแถวต่อผู้ใช้ต่อเรื่อง) ถ้ายังไม่มี
+    และเติมข้อมูลจาก watch_history เดิมในครั้งแรก
+    ลบตอนแล้วแถวของเรื่องไม่หาย: trigger ชี้ last_episode_id ไปที่ตอนล่าสุดที่ยังเหลือในประวัติ"""
+    conn.execute(_WATCH_ROLLUP_SCHEMA.format(name="series_watch_rollup"))
+    # DB เดิมสร้าง last_episode_id แบบ ON DELETE CASCADE (ลบตอนแล้วทั้งแถวหายไปด้วย)
+    # SQLite แก้ foreign key ไม่ได้ จึงสร้างตารางใหม่แล้วคัดลอกข้อมูล
+    cascades = any(
+        fk[2] == "episodes" and fk[6] == "CASCADE"
+        for fk in conn.execute("PRAGMA foreign_key_list(series_watch_rollup)")
+    )
+    if cascades:
+        conn.execute(_WATCH_ROLLUP_SCHEMA.format(name="series_watch_rollup_new"))
+        conn.execute("INSERT INTO series_watch_rollup_new SELECT * FROM series_watch_rollup")
+        conn.execute("DROP TABLE series_watch_rollup")
+        conn.execute("ALTER TABLE series_watch_rollup_new RENAME TO series_watch_rollup")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_rollup_user_time ON series_watch_rollup (user_id, last_watched_at)"
+    )
+    # ใช้ตอนลบตอน: ON DELETE SET NULL หาแถวจาก last_episode_id และ trigger ด้านล่างหาจาก series_id
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_rollup_last_episode ON series_watch_rollup (last_episode_id)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_rollup_series ON series_watch_rollup (series_id)"
+    )
+    # ทำงานได้ไม่ว่า ON DELETE SET NULL จะทำก่อนหรือหลัง trigger นี้
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_episodes_delete_watch_rollup
+        AFTER DELETE ON episodes
+        BEGIN
+            UPDATE series_watch_rollup SET last_episode_id = (
+                SELECT wh.episode_id FROM watch_history wh
+                WHERE wh.user_id = series_watch_rollup.user_id
+                  AND wh.series_id = series_watch_rollup.series_id
+                  AND wh.episode_id != OLD.id
+                ORDER BY wh.watched_at DESC, wh.id DESC LIMIT 1
+            )
+            WHERE series_id = OLD.series_id
+              AND (last_episode_id = OLD.id OR last_episode_id IS NULL);
+        END
+        """
+    )
+    has_rollup = conn.execute("SELECT 1 FROM series_watch_rollup LIMIT 1").fetchone()
+    has_history = conn.execute("SELECT 1 FROM watch_history LIMIT 1").fetchone()
+    if has_history and not has_rollup:
+        rebuild_watch_rollup(conn)
+    conn.commit()
+
+
+def rebuild_watch_rollup(conn: sqlite3.Connection, user_id=None):
+    """คำนวณตารางสรุปใหม่จาก watch_history (ทั้งหมด หรือเฉพาะผู้ใช้คนเดียว)
+    ใช้หลังลบประวัติหรือคืนค่าจากไฟล์สำรอง ไม่ commit เอง"""
+    # SQLite จะคืนค่า episode_id จากแถวที่ MAX(watched_at) ตรงกัน
+    select_sql = """
+        SELECT user_id, series_id, episode_id, MAX(watched_at), COUNT(*)
+        FROM watch_history
+        {where}
+        GROUP BY user_id, series_id
+    """
+    if user_id is None:
+        conn.execute("DELETE FROM series_watch_rollup")
+        conn.execute(
+            "INSERT INTO series_watch_rollup (user_id, series_id, last_episode_id, last_watched_at, view_count) "
+            + select_sql.format(where="")
+        )
+    else:
+        conn.execute("DELETE FROM series_watch_rollup WHERE user_id = ?", (user_id,))
+        conn.execute(
+            "INSERT INTO series_watch_rollup (user_id, series_id, last_episode_id, last_watched_at, view_count) "
+            + select_sql.format(where="WHERE user_id = ?"),
+            (user_id,),
+        )
+
+
+def record_watch(conn: sqlite3.Connection, user_id, series_id, episode_id):
+    """บันทึกประวัติการดูหนึ่งแถว พร้อมอัปเดตตารางสรุปแบบเพิ่มทีละแถว (ไม่ commit เอง)"""
+    watched_at = datetime.utcnow().isoformat()
+    conn.execute(
+        "INSERT INTO watch_history (user_id, series_id, episode_id, watched_at) VALUES (?, ?, ?, ?)",
+        (user_id, series_id, episode_id, watched_at),
+    )
+    conn.execute(
+        """
+        INSERT INTO series_watch_rollup (user_id, series_id, last_episode_id, last_watched_at, view_count)
+        VALUES (?, ?, ?, ?, 1)
+        ON CONFLICT(user_id, series_id) DO UPDATE SET
+            last_episode_id = excluded.last_episode_id,
+            last_watched_at = excluded.last_watched_at,
+            view_count = view_count + 1
+        """,
+        (user_id, series_id, episode_id, watched_at),
+    )
+
+
+def ensure_playback_positions_table(conn: sqlite3.Connection):
+    """ตารางเก็บตำแหน่งที่ดูค้างไว้ล่าสุด (หนึ่งแถวต่อผู้ใช้ต่อตอน)"""
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS playback_positions (
+            user_id INTEGER NOT NULL,
+            episode_id INTEGER NOT NULL,
+            position REAL NOT NULL,
+            updated_at TEXT NOT NULL,
+            PRIMARY KEY (user_id, episode_id)
+        ) WITHOUT ROWID
+        """
+    )
+    conn.commit()
+
+
+def ensure_backup_changelog(conn: sqlite3.Connection):
+    """ตารางสำหรับสำรองข้อมูลสมาชิกแบบส่วนต่าง
+    backup_changelog: trigger จดว่า users แถวไหนถูกเพิ่ม/แก้/ลบ และ watch_history แถวไหนถูกลบ
+    (แถว watch_history ที่เพิ่มใหม่ไม่ต้องจด ใช้ id ที่เพิ่มขึ้นเรื่อย ๆ เป็น high-water mark แทน)
+    backup_chain: รายการไฟล์สำรองที่ออกไปแล้ว/คืนค่าแล้ว เชื่อมกันด้วย parent_id
+    (confirmed_at: ผู้ดูแลยืนยันว่าเก็บไฟล์แล้ว delta ถัดไปจึงต่อจากไฟล์นี้ได้)"""
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS backup_changelog (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            table_name TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            op TEXT NOT NULL
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS backup_chain (
+            id TEXT PRIMARY KEY,
+            parent_id TEXT,
+            kind TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            history_hwm INTEGER NOT NULL,
+            changes_hwm INTEGER NOT NULL,
+            restored_at TEXT,
+            confirmed_at TEXT
+        )
+        """
+    )
+    cols = [row[1] for row in conn.execute("PRAGMA table_info(backup_chain)")]
+    if "confirmed_at" not in cols:
+        conn.execute("ALTER TABLE backup_chain ADD COLUMN confirmed_at TEXT")
+        # แถวเดิมออกไปแล้วก่อนมีขั้นยืนยัน ถือว่ายืนยันแล้ว
+        conn.execute("UPDATE backup_chain SET confirmed_at = created_at WHERE restored_at IS NULL")
+    triggers = {
+        "users_insert": ("AFTER INSERT ON users", "'users', NEW.id, 'upsert'"),
+        "users_update": ("AFTER UPDATE ON users", "'users', NEW.id, 'upsert'"),
+        "users_delete": ("AFTER DELETE ON users", "'users', OLD.id, 'delete'"),
+        "history_delete": ("AFTER DELETE ON watch_history", "'watch_history', OLD.id, 'delete'"),
+    }
+    for name, (event, values) in triggers.items():
+        conn.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{name}_backup_changelog
+            {event}
+            BEGIN
+                INSERT INTO backup_changelog (table_name, row_id, op) VALUES ({values});
+            END
+            """
+        )
+    conn.commit()
+
+
+def ensure_history_retention(conn: sqlite3.Connection):
+    """index ของ watch_history สำหรับหน้าประวัติและงานเก็บกวาด
+    และตารางสรุปยอดดูรายวัน (ใช้เมื่อ HISTORY_ARCHIVE_MODE=rollup)"""
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_history_user ON watch_history (user_id, id)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_history_watched_at ON watch_history (watched_at)"
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS watch_history_daily (
+            day TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            series_id INTEGER NOT NULL,
+            episode_id INTEGER NOT NULL,
+            view_count INTEGER NOT NULL,
+            PRIMARY KEY (day, user_id, series_id, episode_id)
+        ) WITHOUT ROWID
+        """
+    )
+    conn.commit()
+
+
 def init_db():
     conn = get_db_connection()
     cur = conn.cursor()
@@ -196,6 +629,10 @@ def init_db():
     # กรณีอัปเกรดจากเวอร์ชันเก่าที่ไม่มีคอลัมน์ thumbnail_url
     ensure_episode_thumbnail_column(conn)
     ensure_visibility_columns(conn)
+    ensure_episode_file_columns(conn)
+    ensure_series_stats(conn)
+    ensure_catalog_version(conn)
+    ensure_visibility_generation(conn)
 
     # ตารางผู้ใช้ทั่วไป
     cur.execute(
@@ -226,6 +663,10 @@ def init_db():
     )
 
     ensure_user_extra_columns(conn)
+    ensure_watch_rollup_table(conn)
+    ensure_playback_positions_table(conn)
+    ensure_backup_changelog(conn)
+    ensure_history_retention(conn)
 
     conn.commit()
     conn.close()
@@ -261,107 +702,1497 @@ def extract_drive_id(text: str) -> str | None:
     return None
 
 
-def download_drive_file(file_id: str, series_id: int) -> str:
-    import gdown
+# ---------- คิวกลางของงานดาวน์โหลด (ลำดับความสำคัญ + จำกัด connection + แบนด์วิดท์) ----------
+# งานโหลดไฟล์มาจากสามที่: คนดูที่รออยู่หน้า /stream, แอดมินที่รอฟอร์มเพิ่ม/แก้ไขตอน
+# และงานเบื้องหลัง (นำเข้าหลายตอนจาก manifest) ทุก HTTP request ที่ดึงไฟล์ต้องขอ slot
+# จาก download_scheduler ก่อน slot ว่างจะให้ระดับที่สำคัญกว่าก่อนเสมอ และกัน slot ส่วนหนึ่ง
+# ไว้ให้คนดูเท่านั้น คนดูจึงไม่ต้องต่อคิวหลังงานนำเข้าเป็นกลุ่ม (จำกัดภายใน process นี้)
+DOWNLOAD_PRIORITY_VIEWER = 0
+DOWNLOAD_PRIORITY_ADMIN = 1
+DOWNLOAD_PRIORITY_PREFETCH = 2
+DOWNLOAD_PRIORITY_NAMES = {0: "viewer", 1: "admin", 2: "prefetch"}
+
+DOWNLOAD_MAX_ACTIVE = max(1, int(os.getenv("DOWNLOAD_MAX_ACTIVE", "8")))
+DOWNLOAD_MAX_PER_HOST = max(1, int(os.getenv("DOWNLOAD_MAX_PER_HOST", "6")))
+# จำนวน connection (ทั้งรวมและต่อ host) ที่งานแอดมิน/เบื้องหลังแตะไม่ได้
+DOWNLOAD_VIEWER_RESERVED = max(0, int(os.getenv("DOWNLOAD_VIEWER_RESERVED", "2")))
+# แบนด์วิดท์รวม MB ต่อวินาที (0 = ไม่จำกัด) คนดูนับรวมในงบแต่ไม่ถูกหน่วง
+DOWNLOAD_BANDWIDTH_BYTES = int(float(os.getenv("DOWNLOAD_BANDWIDTH_MB", "0")) * 1024 * 1024)
+
+
+class DownloadJob:
+    """งานโหลดหนึ่งไฟล์ priority เปลี่ยนได้ระหว่างทาง (เช่นมีคนดูมารอไฟล์เดียวกัน)"""
+
+    __slots__ = ("priority",)
+
+    def __init__(self, priority):
+        self.priority = priority
+
+
+class DownloadScheduler:
+    def __init__(self, max_active, max_per_host, viewer_reserved, bandwidth):
+        self.max_active = max_active
+        self.max_per_host = max_per_host
+        self.viewer_reserved = viewer_reserved
+        self.bandwidth = bandwidth
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._waiting = []
+        self._active = 0
+        self._per_host = {}
+        self._bw_lock = threading.Lock()
+        self._tokens = float(bandwidth)
+        self._stamp = time.monotonic()
+        self.metrics = {
+            name: {"granted": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0, "throttled_seconds": 0.0}
+            for name in DOWNLOAD_PRIORITY_NAMES.values()
+        }
+
+    def _fits(self, job, host):
+        reserve = 0
+        if job.priority != DOWNLOAD_PRIORITY_VIEWER:
+            reserve = self.viewer_reserved
+        return (
+            self._active < max(1, self.max_active - reserve)
+            and self._per_host.get(host, 0) < max(1, self.max_per_host - reserve)
+        )
 
-    series_dir = os.path.join(VIDEO_ROOT, f"series_{series_id}")
-    os.makedirs(series_dir, exist_ok=True)
+    def _may_start(self, ticket):
+        """เริ่มได้ถ้ามี slot ให้ และไม่มีคำขอที่มาก่อน/สำคัญกว่าที่เริ่มได้เหมือนกันรออยู่"""
+        seq, job, host = ticket
+        if not self._fits(job, host):
+            return False
+        rank = (job.priority, seq)
+        return not any(
+            (other[1].priority, other[0]) < rank and self._fits(other[1], other[2])
+            for other in self._waiting
+        )
 
-    output = os.path.join(series_dir, f"{file_id}.mp4")
+    @contextmanager
+    def slot(self, job, url):
+        host = urlparse(url).hostname or ""
+        ticket = (next(self._seq), job, host)
+        started = time.monotonic()
+        with self._cond:
+            self._waiting.append(ticket)
+            try:
+                while not self._may_start(ticket):
+                    self._cond.wait()
+            finally:
+                self._waiting.remove(ticket)
+            self._active += 1
+            self._per_host[host] = self._per_host.get(host, 0) + 1
+            waited = time.monotonic() - started
+            m = self.metrics[DOWNLOAD_PRIORITY_NAMES[job.priority]]
+            m["granted"] += 1
+            m["wait_seconds"] += waited
+            m["max_wait_seconds"] = max(m["max_wait_seconds"], waited)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active -= 1
+                self._per_host[host] -= 1
+                if not self._per_host[host]:
+                    del self._per_host[host]
+                self._cond.notify_all()
+
+    def boost(self, job, priority):
+        """ยก priority ของงานที่กำลังโหลดอยู่ (ไม่ลดลง)"""
+        with self._cond:
+            if priority < job.priority:
+                job.priority = priority
+                self._cond.notify_all()
+
+    def throttle(self, job, nbytes):
+        """หักงบแบนด์วิดท์ตามจำนวนไบต์ที่รับมา งานที่ไม่ใช่คนดูจะหยุดรอจนงบกลับมาเป็นบวก"""
+        if self.bandwidth <= 0:
+            return
+        with self._bw_lock:
+            now = time.monotonic()
+            self._tokens = min(self.bandwidth, self._tokens + (now - self._stamp) * self.bandwidth)
+            self._stamp = now
+            self._tokens -= nbytes
+            deficit = -self._tokens
+        if deficit > 0 and job.priority != DOWNLOAD_PRIORITY_VIEWER:
+            delay = deficit / self.bandwidth
+            self.metrics[DOWNLOAD_PRIORITY_NAMES[job.priority]]["throttled_seconds"] += delay
+            time.sleep(delay)
+
+    def snapshot(self):
+        with self._cond:
+            waiting = {name: 0 for name in DOWNLOAD_PRIORITY_NAMES.values()}
+            for _seq, job, _host in self._waiting:
+                waiting[DOWNLOAD_PRIORITY_NAMES[job.priority]] += 1
+            return {
+                "active": self._active,
+                "active_per_host": dict(self._per_host),
+                "waiting": waiting,
+                "max_active": self.max_active,
+                "max_per_host": self.max_per_host,
+                "viewer_reserved": self.viewer_reserved,
+                "bandwidth_bytes_per_second": self.bandwidth,
+                "classes": {name: dict(m) for name, m in self.metrics.items()},
+            }
+
+
+download_scheduler = DownloadScheduler(
+    DOWNLOAD_MAX_ACTIVE, DOWNLOAD_MAX_PER_HOST, DOWNLOAD_VIEWER_RESERVED, DOWNLOAD_BANDWIDTH_BYTES
+)
 
-    if os.path.exists(output):
-        return output
 
-    url = f"https://drive.google.com/uc?export=download&id={file_id}"
-    try:
-        gdown.download(url, output, quiet=False)
-    except Exception as e:
-        raise RuntimeError(f"โหลดไฟล์จาก Google Drive ไม่สำเร็จ: {e}")
+# ---------- โหลดไฟล์จาก Google Drive (โหลดต่อจากที่ค้างได้ + ตรวจไฟล์ก่อนใช้) ----------
+# เขียนลง <file_id>.mp4.part ก่อนเสมอ ถ้าหลุดกลางทาง ครั้งถัดไปจะขอต่อด้วย HTTP Range
+# จากขนาดที่มีอยู่ แล้วตรวจขนาดกับโครงสร้างกล่อง MP4 ก่อน os.replace เข้าที่ (atomic)
+# ไฟล์ .mp4 ที่อยู่ในโฟลเดอร์จึงเป็นไฟล์ที่ตรวจแล้วเท่านั้น
+# ลองโหลดตรงจาก DRIVE_DOWNLOAD_URL ก่อน (แบ่งช่วงได้ ผ่านคิว download_scheduler)
+# ถ้าไม่ได้ เช่น Google เปลี่ยน URL หรือส่งหน้ายืนยันมา จะใช้ gdown แทน (DRIVE_GDOWN_FALLBACK=0 เพื่อปิด)
+DRIVE_DOWNLOAD_URL = os.getenv(
+    "DRIVE_DOWNLOAD_URL",
+    "https://drive.usercontent.google.com/download?id={id}&export=download&confirm=t",
+)
+DRIVE_GDOWN_FALLBACK = os.getenv("DRIVE_GDOWN_FALLBACK", "1") == "1"
+DRIVE_DOWNLOAD_RETRIES = int(os.getenv("DRIVE_DOWNLOAD_RETRIES", "5"))
+DRIVE_DOWNLOAD_TIMEOUT = float(os.getenv("DRIVE_DOWNLOAD_TIMEOUT", "30"))
+DRIVE_RETRY_BACKOFF = float(os.getenv("DRIVE_RETRY_BACKOFF", "1"))
+# เดินกล่อง MP4 เฉพาะไฟล์ที่เป็น MP4 จริง (ขึ้นต้นด้วยกล่อง ftyp) ไฟล์อื่นเช่น mkv / webm ตรวจแค่ขนาด
+DRIVE_VERIFY_MP4 = os.getenv("DRIVE_VERIFY_MP4", "1") == "1"
+DRIVE_CHUNK_SIZE = 64 * 1024
+MP4_REQUIRED_BOXES = (b"ftyp", b"moov", b"mdat")
+CONTENT_RANGE_RE = re.compile(r"bytes (?:(\d+)-\d+|\*)/(\d+|\*)")
+
+# โหลดแบบแบ่งช่วง: ไฟล์ที่ใหญ่กว่าหนึ่งช่วงจะถูกแบ่งเป็นช่วงละ DRIVE_SEGMENT_MB
+# แล้วดึงพร้อมกัน DRIVE_CONNECTIONS เส้น (ตั้ง 1 = connection เดียวแบบเดิม)
+DRIVE_CONNECTIONS = max(1, int(os.getenv("DRIVE_CONNECTIONS", "4")))
+DRIVE_SEGMENT_BYTES = max(1, int(os.getenv("DRIVE_SEGMENT_MB", "16"))) * 1024 * 1024
+
+_drive_http = requests.Session()
+_drive_http.mount(
+    "http://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=max(10, DRIVE_CONNECTIONS * 2))
+)
+_drive_http.mount(
+    "https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=max(10, DRIVE_CONNECTIONS * 2))
+)
+_drive_locks = {}
+# path ของไฟล์ -> DownloadJob ที่กำลังโหลดไฟล์นั้นอยู่ (ใช้ยก priority ให้คนที่มารอ)
+_drive_jobs = {}
+_drive_locks_guard = threading.Lock()
+
+
+def check_mp4_structure(path: str):
+    """เดินกล่อง (box) ระดับบนสุดของไฟล์ MP4 ตั้งแต่ต้นจนจบ
+    กล่องต้องต่อกันพอดีถึงท้ายไฟล์และมี ftyp / moov / mdat ครบ
+    คืน None ถ้าผ่าน หรือข้อความบอกจุดที่เสีย"""
+    total = os.path.getsize(path)
+    found = set()
+    pos = 0
+    with open(path, "rb") as f:
+        while pos < total:
+            f.seek(pos)
+            header = f.read(8)
+            if len(header) < 8:
+                return f"หัวกล่องที่ไบต์ {pos} ไม่ครบ"
+            box_size, box_type = struct.unpack(">I4s", header)
+            header_len = 8
+            if box_size == 1:
+                large = f.read(8)
+                if len(large) < 8:
+                    return f"หัวกล่องที่ไบต์ {pos} ไม่ครบ"
+                box_size = struct.unpack(">Q", large)[0]
+                header_len = 16
+            elif box_size == 0:
+                # กล่องสุดท้ายยาวถึงท้ายไฟล์
+                box_size = total - pos
+            if box_size < header_len:
+                return f"ขนาดกล่องที่ไบต์ {pos} ไม่ถูกต้อง"
+            if pos + box_size > total:
+                return f"ไฟล์ถูกตัดกลางกล่อง {box_type.decode('latin-1')!r}"
+            found.add(box_type)
+            pos += box_size
+    missing = [t.decode() for t in MP4_REQUIRED_BOXES if t not in found]
+    if missing:
+        return "ไม่พบกล่อง " + ", ".join(missing)
+    return None
 
-    if not os.path.exists(output):
-        raise RuntimeError("ไม่พบไฟล์ที่ดาวน์โหลดจาก Google Drive")
 
-    return output
+def is_mp4_file(path: str) -> bool:
+    """ดูจากเนื้อไฟล์ ไม่ใช่นามสกุล (ไฟล์จาก Drive ถูกเก็บเป็น .mp4 ทุกไฟล์)"""
+    with open(path, "rb") as f:
+        header = f.read(8)
+    return len(header) == 8 and header[4:8] == b"ftyp"
 
 
-def is_admin() -> bool:
-    return bool(session.get("is_admin"))
+def verify_video_file(path: str, expected_size=None):
+    """ตรวจไฟล์ที่โหลดมา คืน None ถ้าใช้ได้ หรือข้อความบอกปัญหา"""
+    size = os.path.getsize(path)
+    if size == 0:
+        return "ไฟล์ว่าง"
+    if expected_size is not None and size != expected_size:
+        return f"ขนาดไฟล์ {size} ไบต์ ไม่ตรงกับที่ควรเป็น {expected_size} ไบต์"
+    if DRIVE_VERIFY_MP4 and is_mp4_file(path):
+        return check_mp4_structure(path)
+    return None
 
 
-def admin_required():
-    if not is_admin():
-        flash("ต้องเข้าสู่ระบบแอดมินก่อน", "error")
-        return False
-    return True
+def _file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(DRIVE_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _check_drive_response(resp):
+    """ยก RuntimeError ถ้าคำตอบไม่ใช่ตัวไฟล์และลองซ้ำไปก็ไม่ได้ผล
+    หรือ requests.HTTPError ถ้าเป็นปัญหาชั่วคราว (5xx, 408, 429) ที่ควรลองใหม่"""
+    if 400 <= resp.status_code < 500 and resp.status_code not in (408, 429):
+        raise RuntimeError(f"Google Drive ตอบกลับ HTTP {resp.status_code}")
+    resp.raise_for_status()
+    if "text/html" in resp.headers.get("Content-Type", ""):
+        # หน้ายืนยัน/หน้าโควตาเต็มของ Drive ไม่ใช่ตัวไฟล์
+        raise RuntimeError("Google Drive ส่งหน้าเว็บกลับมาแทนไฟล์ (ไฟล์อาจไม่ได้แชร์สาธารณะหรือโควตาเต็ม)")
+
+
+def _drive_fetch_part(url: str, part_path: str, job: DownloadJob):
+    """โหลดต่อท้าย part_path หนึ่งรอบ คืนขนาดเต็มของไฟล์ที่ server แจ้ง (None ถ้าไม่รู้)
+    ยก requests.RequestException เมื่อเครือข่ายหลุด (ลองใหม่ได้) หรือ RuntimeError เมื่อไม่ควรลองซ้ำ"""
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    # ขอแบบไม่บีบอัด ไม่งั้นตำแหน่ง Range กับ Content-Length จะไม่ใช่ไบต์ของไฟล์จริง
+    headers = {"Accept-Encoding": "identity"}
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+
+    with download_scheduler.slot(job, url), _drive_http.get(
+        url, headers=headers, stream=True, timeout=DRIVE_DOWNLOAD_TIMEOUT
+    ) as resp:
+        if resp.status_code == 416:
+            # .part ยาวเท่าไฟล์แล้ว (เช่นหลุดหลังได้ไบต์สุดท้าย) ให้ไปตรวจต่อ
+            m = CONTENT_RANGE_RE.match(resp.headers.get("Content-Range", ""))
+            return int(m.group(2)) if m and m.group(2) != "*" else None
+        _check_drive_response(resp)
+
+        if resp.status_code == 206:
+            m = CONTENT_RANGE_RE.match(resp.headers.get("Content-Range", ""))
+            if not m or m.group(1) is None or int(m.group(1)) != offset:
+                raise RuntimeError("server ส่งช่วงข้อมูลไม่ตรงกับที่ขอ")
+            total = int(m.group(2)) if m.group(2) != "*" else None
+            mode = "ab"
+        else:
+            # server ไม่รองรับ Range ส่งมาทั้งไฟล์: เริ่มเขียนใหม่ตั้งแต่ต้น
+            length = resp.headers.get("Content-Length")
+            total = int(length) if length and length.isdigit() else None
+            mode = "wb"
+
+        with open(part_path, mode) as f:
+            for chunk in resp.iter_content(DRIVE_CHUNK_SIZE):
+                f.write(chunk)
+                download_scheduler.throttle(job, len(chunk))
+    return total
+
+
+def _drive_fetch_single(url: str, part_path: str, job: DownloadJob):
+    """โหลดแบบ connection เดียว ลองต่อจาก .part ซ้ำได้ DRIVE_DOWNLOAD_RETRIES ครั้ง
+    คืนขนาดเต็มของไฟล์ที่ server แจ้ง (None ถ้าไม่รู้)"""
+    total = None
+    last_error = None
+    for attempt in range(DRIVE_DOWNLOAD_RETRIES + 1):
+        if attempt:
+            time.sleep(min(DRIVE_RETRY_BACKOFF * 2 ** (attempt - 1), 30))
+        try:
+            total = _drive_fetch_part(url, part_path, job) or total
+        except requests.RequestException as e:
+            last_error = e
+            continue
+        have = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if total is None or have >= total:
+            return total
+        last_error = f"ได้มา {have} จาก {total} ไบต์"
+    raise RuntimeError(f"โหลดไฟล์จาก Google Drive ไม่สำเร็จ: {last_error}")
+
+
+class _RangeRefused(Exception):
+    """server ไม่ยอมตอบแบบ Range (ส่งทั้งไฟล์มาแทน 206)"""
+
+
+def _drive_probe(url: str, job: DownloadJob):
+    """ขอแค่ไบต์แรกเพื่อผ่านขั้น confirm/redirect ของ Drive ให้ได้ URL ปลายทางจริง
+    คืน (URL ปลายทาง, ขนาดเต็ม) ขนาดเป็น None ถ้า server ไม่รองรับ Range"""
+    headers = {"Range": "bytes=0-0", "Accept-Encoding": "identity"}
+    with download_scheduler.slot(job, url), _drive_http.get(
+        url, headers=headers, stream=True, timeout=DRIVE_DOWNLOAD_TIMEOUT
+    ) as resp:
+        _check_drive_response(resp)
+        m = CONTENT_RANGE_RE.match(resp.headers.get("Content-Range", ""))
+        if resp.status_code != 206 or not m or m.group(2) == "*":
+            return resp.url, None
+        return resp.url, int(m.group(2))
+
+
+def _load_segment_state(state_path: str, total: int):
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state.get("total") != total:
+        return None
+    return [list(p) for p in state["pieces"]]
+
+
+def _drive_fetch_segmented(url: str, part_path: str, total: int, job: DownloadJob):
+    """ดึงไฟล์เป็นช่วง ๆ พร้อมกันหลาย connection (ใช้ keep-alive จาก pool ของ _drive_http)
+    เขียนด้วย os.pwrite ลงไฟล์ที่จองขนาดเต็มไว้ก่อน ความคืบหน้าของแต่ละช่วงเก็บใน <part>.ranges
+    หลุดกลางทางครั้งหน้าจึงโหลดต่อเฉพาะส่วนที่ขาด ยก _RangeRefused ถ้า server เลิกตอบแบบ Range"""
+    state_path = part_path + ".ranges"
+    pieces = _load_segment_state(state_path, total) if os.path.exists(part_path) else None
+    if pieces is None:
+        # [เริ่ม, จบ, จำนวนไบต์ที่เขียนแล้ว]
+        pieces = [[s, min(s + DRIVE_SEGMENT_BYTES, total) - 1, 0] for s in range(0, total, DRIVE_SEGMENT_BYTES)]
+
+    fd = os.open(part_path, os.O_RDWR | os.O_CREAT, 0o644)
+    state_lock = threading.Lock()
+    stop = threading.Event()
+
+    def save_state():
+        with state_lock:
+            # จดความคืบหน้าก่อน แล้ว fsync ข้อมูล ตัวเลขใน state จึงไม่มีวันเกินข้อมูลที่อยู่บนดิสก์จริง
+            data = json.dumps({"total": total, "pieces": pieces})
+            os.fsync(fd)
+            tmp = state_path + ".tmp"
+            with open(tmp, "w") as f:
+                f.write(data)
+            os.replace(tmp, state_path)
+
+    def run(piece):
+        start, end = piece[0], piece[1]
+        length = end - start + 1
+        last_error = None
+        try:
+            for attempt in range(DRIVE_DOWNLOAD_RETRIES + 1):
+                if piece[2] >= length or stop.is_set():
+                    return
+                if attempt:
+                    time.sleep(min(DRIVE_RETRY_BACKOFF * 2 ** (attempt - 1), 30))
+                headers = {"Range": f"bytes={start + piece[2]}-{end}", "Accept-Encoding": "identity"}
+                try:
+                    with download_scheduler.slot(job, url), _drive_http.get(
+                        url, headers=headers, stream=True, timeout=DRIVE_DOWNLOAD_TIMEOUT
+                    ) as resp:
+                        _check_drive_response(resp)
+                        if resp.status_code != 206:
+                            raise _RangeRefused()
+                        m = CONTENT_RANGE_RE.match(resp.headers.get("Content-Range", ""))
+                        if not m or m.group(1) is None or int(m.group(1)) != start + piece[2]:
+                            raise _RangeRefused()
+                        for chunk in resp.iter_content(DRIVE_CHUNK_SIZE):
+                            if stop.is_set():
+                                return
+                            chunk = chunk[: length - piece[2]]
+                            os.pwrite(fd, chunk, start + piece[2])
+                            piece[2] += len(chunk)
+                            download_scheduler.throttle(job, len(chunk))
+                            if piece[2] >= length:
+                                break
+                except requests.RequestException as e:
+                    last_error = e
+            if piece[2] < length and not stop.is_set():
+                raise RuntimeError(f"โหลดไฟล์จาก Google Drive ไม่สำเร็จ: {last_error}")
+        except BaseException:
+            stop.set()
+            raise
+        finally:
+            save_state()
 
+    try:
+        if os.fstat(fd).st_size != total:
+            # จองพื้นที่เต็มไฟล์ไว้ก่อน ดิสก์เต็มจะรู้ตั้งแต่ต้นไม่ใช่ตอนใกล้เสร็จ
+            try:
+                os.posix_fallocate(fd, 0, total)
+            except (AttributeError, OSError):
+                # ไม่มี fallocate หรือระบบไฟล์ไม่รองรับ ใช้ไฟล์แบบ sparse แทน
+                os.ftruncate(fd, total)
+        todo = [p for p in pieces if p[2] < p[1] - p[0] + 1]
+        with ThreadPoolExecutor(max_workers=min(DRIVE_CONNECTIONS, max(1, len(todo)))) as pool:
+            futures = [pool.submit(run, p) for p in todo]
+        for future in futures:
+            future.result()
+    finally:
+        os.close(fd)
+    os.remove(state_path)
+    return total
+
+
+def _drive_path_lock(path: str) -> threading.Lock:
+    with _drive_locks_guard:
+        return _drive_locks.setdefault(path, threading.Lock())
+
+
+@contextmanager
+def _drive_file_lock(output: str):
+    """ล็อกไฟล์ปลายทางทั้งใน process (threading.Lock) และข้าม worker (flock บน <output>.lock)
+    ไฟล์ .lock ถูกลบตอนปล่อยล็อก คนที่รออยู่จึงต้องเช็กว่ายังล็อกไฟล์เดียวกับที่อยู่ในโฟลเดอร์
+    (inode ตรงกัน) ถ้าไม่ตรงแปลว่าถูกลบไปแล้ว ให้เปิดไฟล์ใหม่แล้วล็อกอีกรอบ"""
+    lock_path = output + ".lock"
+    with _drive_path_lock(output):
+        if fcntl is None:
+            yield
+            return
+        while True:
+            lock_file = open(lock_path, "a")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    current = os.stat(lock_path).st_ino == os.fstat(lock_file.fileno()).st_ino
+                except FileNotFoundError:
+                    current = False
+            except BaseException:
+                lock_file.close()
+                raise
+            if current:
+                break
+            lock_file.close()
+        try:
+            yield
+        finally:
+            # ลบก่อนปล่อยล็อก คนที่ได้ล็อกไฟล์เก่าต่อจากเราจะเห็นว่า inode ไม่ตรงแล้วไปล็อกไฟล์ใหม่
+            try:
+                os.remove(lock_path)
+            except OSError:
+                pass
+            lock_file.close()
 
 
-# ฟังก์ชันจัดการสถานะผู้ใช้ทั่วไป
-def get_current_user():
-    user_id = session.get("user_id")
-    if not user_id:
-        return None
+def _recorded_drive_file(file_id: str):
+    """ขนาดและ sha256 ที่เคยตรวจแล้วของไฟล์ Drive นี้ (จากตอนไหนก็ได้ที่ใช้ไฟล์เดียวกัน)"""
     conn = get_db_connection()
-    user = conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
-    conn.close()
-    return user
+    try:
+        row = conn.execute(
+            """
+            SELECT file_size, file_sha256 FROM episodes
+            WHERE drive_id = ? AND file_size IS NOT NULL AND file_sha256 IS NOT NULL
+            LIMIT 1
+            """,
+            (file_id,),
+        ).fetchone()
+    finally:
+        conn.close()
+    return (row["file_size"], row["file_sha256"]) if row else (None, None)
 
 
-def login_user(user_row):
-    session["user_id"] = user_row["id"]
-    session["username"] = user_row["username"]
+def fetch_drive_file(
+    file_id: str, series_id: int, known_size=None, known_sha256=None, priority=DOWNLOAD_PRIORITY_ADMIN
+):
+    """โหลดไฟล์จาก Google Drive แบบโหลดต่อได้และตรวจไฟล์ก่อนใช้
+    คืน (path เต็ม, ขนาดไฟล์, sha256) known_size / known_sha256 คือค่าที่เคยตรวจแล้ว
+    (ไม่ส่งมาจะหาจากตอนอื่นที่ใช้ drive_id เดียวกัน) ถ้ามีไฟล์อยู่แล้วและขนาดตรง จะไม่อ่านไฟล์ซ้ำ
+    priority คือระดับใน download_scheduler"""
+    series_dir = os.path.join(VIDEO_ROOT, f"series_{series_id}")
+    os.makedirs(series_dir, exist_ok=True)
 
+    output = os.path.join(series_dir, f"{file_id}.mp4")
+    if known_sha256 is None:
+        known_size, known_sha256 = _recorded_drive_file(file_id)
+
+    job = DownloadJob(priority)
+    with _drive_locks_guard:
+        running = _drive_jobs.get(output)
+    if running is not None:
+        # มีคนโหลดไฟล์นี้อยู่แล้ว เราต้องรอไฟล์เดียวกัน งานนั้นจึงต้องสำคัญเท่ากับเราเป็นอย่างน้อย
+        download_scheduler.boost(running, priority)
+
+    # กันสอง thread / สอง worker โหลดไฟล์เดียวกันพร้อมกันแล้วเขียน .part ทับกัน
+    with _drive_file_lock(output):
+        with _drive_locks_guard:
+            _drive_jobs[output] = job
+        try:
+            return _fetch_drive_file_locked(output, file_id, known_size, known_sha256, job)
+        finally:
+            with _drive_locks_guard:
+                _drive_jobs.pop(output, None)
 
-def logout_user():
-    session.pop("user_id", None)
-    session.pop("username", None)
 
+def _fetch_drive_file_locked(output, file_id, known_size, known_sha256, job):
+    part_path = output + ".part"
+    if os.path.exists(output):
+        size = os.path.getsize(output)
+        if known_sha256 and size == known_size:
+            # ไฟล์ในโฟลเดอร์ผ่านการตรวจตอน publish มาแล้ว (os.replace หลังตรวจเท่านั้น)
+            return output, size, known_sha256
+        if verify_video_file(output) is None:
+            return output, size, _file_sha256(output)
+        # ไฟล์เก่าที่โหลดไม่ครบ (เช่นจาก gdown ที่หลุดกลางทาง) ใช้เป็นจุดเริ่มโหลดต่อ
+        os.replace(output, part_path)
+
+    url = DRIVE_DOWNLOAD_URL.format(id=quote(file_id, safe=""))
+    try:
+        total = _drive_fetch_direct(url, part_path, job)
+    except RuntimeError as e:
+        if not DRIVE_GDOWN_FALLBACK:
+            raise
+        try:
+            total = _drive_fetch_gdown(file_id, part_path, job)
+        except ImportError:
+            raise e
+        except Exception as gdown_error:
+            raise RuntimeError(f"{e} (gdown: {gdown_error})") from gdown_error
 
-def user_login_required(view_func):
-    @wraps(view_func)
-    def wrapped_view(*args, **kwargs):
-        if not session.get("user_id"):
-            # ถ้ายังไม่ได้ล็อกอิน ให้ไปหน้าเข้าสู่ระบบผู้ใช้
-            flash("กรุณาเข้าสู่ระบบก่อนดูวิดีโอ", "error")
-            return redirect(url_for("user_login", next=request.path))
-        return view_func(*args, **kwargs)
+    if not os.path.exists(part_path):
+        raise RuntimeError("ไม่พบไฟล์ที่ดาวน์โหลดจาก Google Drive")
 
-    return wrapped_view
+    problem = verify_video_file(part_path, total if total is not None else known_size)
+    if problem:
+        # .part ที่เสียแล้วโหลดต่อก็ไม่มีวันถูก ลบทิ้งให้ครั้งหน้าเริ่มใหม่
+        os.remove(part_path)
+        raise RuntimeError(f"ไฟล์ที่โหลดจาก Google Drive ไม่สมบูรณ์: {problem}")
+
+    size = os.path.getsize(part_path)
+    digest = _file_sha256(part_path)
+    os.replace(part_path, output)
+    return output, size, digest
+
+
+def _drive_fetch_direct(url: str, part_path: str, job: DownloadJob):
+    """โหลดเองผ่าน HTTP ลงใน part_path (แบ่งช่วงถ้าทำได้) คืนขนาดเต็มที่ server แจ้ง (None ถ้าไม่รู้)"""
+    state_path = part_path + ".ranges"
+    total = None
+    # .part ที่ไม่มี .ranges มาจากการโหลดแบบ connection เดียว ให้ต่อท้ายแบบเดิม
+    if DRIVE_CONNECTIONS > 1 and hasattr(os, "pwrite") and (
+        os.path.exists(state_path) or not os.path.exists(part_path)
+    ):
+        try:
+            final_url, size = _drive_probe(url, job)
+        except requests.RequestException:
+            final_url, size = url, None
+        if size is not None and size > DRIVE_SEGMENT_BYTES:
+            try:
+                total = _drive_fetch_segmented(final_url, part_path, size, job)
+            except _RangeRefused:
+                total = None
+        if total is None and os.path.exists(state_path):
+            # ไฟล์ที่จองไว้มีช่องว่างกลางไฟล์ ต่อท้ายแบบ connection เดียวไม่ได้ ต้องเริ่มใหม่
+            for path in (part_path, state_path):
+                if os.path.exists(path):
+                    os.remove(path)
+    if total is None:
+        total = _drive_fetch_single(url, part_path, job)
+    return total
+
+
+def _drive_fetch_gdown(file_id: str, part_path: str, job: DownloadJob):
+    """ทางสำรองด้วย gdown (จัดการหน้ายืนยัน/cookie ของ Drive ให้เอง) ผลลัพธ์ไปอยู่ที่ part_path
+    เพื่อผ่านการตรวจและ os.replace ขั้นเดียวกับการโหลดตรง ไม่รู้ขนาดเต็มจึงคืน None
+    gdown เขียนไฟล์ชั่วคราว <output>*.part ของตัวเองและต่อจากที่ค้างได้ด้วย resume=True"""
+    import gdown
 
-@app.route("/")
-def index():
-    conn = get_db_connection()
-    series_list = conn.execute(
-        "SELECT * FROM series ORDER BY datetime(created_at) DESC"
-    ).fetchall()
-    conn.close()
-    return render_template("index.html", series_list=series_list)
+    staging = part_path[: -len(".part")] + ".gdown"
+    gdown_part = staging + ".part"
+    state_path = part_path + ".ranges"
+    if os.path.exists(state_path):
+        # .part แบบแบ่งช่วงมีช่องว่างกลางไฟล์ ส่งต่อให้ gdown ต่อท้ายไม่ได้
+        for path in (part_path, state_path):
+            if os.path.exists(path):
+                os.remove(path)
+    elif os.path.exists(part_path) and not any(
+        name.startswith(os.path.basename(staging)) for name in os.listdir(os.path.dirname(staging))
+    ):
+        # .part แบบ connection เดียวเป็นไบต์ต้นไฟล์จริง ให้ gdown โหลดต่อจากตรงนี้
+        os.replace(part_path, gdown_part)
+
+    with download_scheduler.slot(job, "https://drive.google.com/"):
+        gdown.download(
+            id=file_id,
+            output=staging,
+            quiet=True,
+            resume=True,
+            retries=DRIVE_DOWNLOAD_RETRIES,
+            timeout=DRIVE_DOWNLOAD_TIMEOUT,
+        )
+    os.replace(staging, part_path)
+    return None
 
 
+# ---------- พร็อกซี + แคชสำหรับตอนแบบ direct ----------
+# เปิดใช้ด้วย DIRECT_PROXY=1 แล้วตอนแบบลิงก์ตรงจะถูกเสิร์ฟผ่าน /stream ของเราเอง
+# โดยดึงข้อมูลจากต้นทางเป็นช่วง ๆ (chunk) และเก็บไว้ในดิสก์ คนดูถัดไปจะได้จากแคช
+DIRECT_PROXY_ENABLED = os.getenv("DIRECT_PROXY", "0") == "1"
+PROXY_CACHE_ROOT = os.getenv("PROXY_CACHE_ROOT", os.path.join(BASE_DIR, "proxy_cache"))
+PROXY_CACHE_MAX_BYTES = int(os.getenv("PROXY_CACHE_MAX_MB", "2048")) * 1024 * 1024
+PROXY_CHUNK_SIZE = int(os.getenv("PROXY_CHUNK_KB", "1024")) * 1024
+# ขนาดข้อมูลต่อรอบตอนรับจากต้นทาง/ส่งให้ผู้ชม (ไม่ต้องถือทั้ง chunk ไว้ในหน่วยความจำ)
+PROXY_READ_SIZE = 64 * 1024
+# meta.json (ขนาดไฟล์ต้นทาง) เก่ากว่านี้จะถามต้นทางใหม่ ถ้าไฟล์ต้นทางเปลี่ยนจะล้าง chunk เดิมทิ้ง
+PROXY_META_TTL = int(os.getenv("PROXY_META_TTL", "3600"))
+
+_proxy_http = requests.Session()
+_proxy_http.mount(
+    "http://", requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=32)
+)
+_proxy_http.mount(
+    "https://", requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=32)
+)
 
+# LRU ของไฟล์ chunk ทั้งหมด: path -> ขนาดไฟล์ (ตัวท้ายสุดคือใช้ล่าสุด)
+_proxy_lru = OrderedDict()
+_proxy_lru_bytes = 0
+_proxy_lru_loaded = False
+_proxy_lock = threading.Lock()
+# chunk ที่กำลังดึงจากต้นทาง: path -> [Lock, จำนวนคนที่ใช้อยู่] คนดูพร้อมกันจึงดึงแค่ครั้งเดียว
+_proxy_inflight = {}
+_proxy_inflight_guard = threading.Lock()
+
+
+def _proxy_load_index():
+    """สแกนโฟลเดอร์แคชครั้งแรก เรียงตามเวลาที่แก้ไขล่าสุด (เก่าสุดอยู่หน้า)"""
+    global _proxy_lru_bytes, _proxy_lru_loaded
+    if _proxy_lru_loaded:
+        return
+    entries = []
+    if os.path.isdir(PROXY_CACHE_ROOT):
+        for root, _dirs, files in os.walk(PROXY_CACHE_ROOT):
+            for name in files:
+                if not name.endswith(".bin"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, path, st.st_size))
+    entries.sort()
+    for _mtime, path, size in entries:
+        _proxy_lru[path] = size
+        _proxy_lru_bytes += size
+    _proxy_lru_loaded = True
+
+
+def _proxy_touch(path, size=None):
+    """ย้าย chunk ไปท้าย LRU และตัดของเก่าทิ้งถ้าเกินขนาดที่กำหนด"""
+    global _proxy_lru_bytes
+    with _proxy_lock:
+        _proxy_load_index()
+        if path in _proxy_lru:
+            _proxy_lru.move_to_end(path)
+        elif size is not None:
+            _proxy_lru[path] = size
+            _proxy_lru_bytes += size
+
+        while _proxy_lru_bytes > PROXY_CACHE_MAX_BYTES and len(_proxy_lru) > 1:
+            old_path, old_size = _proxy_lru.popitem(last=False)
+            _proxy_lru_bytes -= old_size
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
 
-@app.route("/search")
-def search():
-    query = request.args.get("q", "").strip()
-    if not query:
-        return redirect(url_for("index"))
 
-    # ตัดคำอย่างง่าย: เอาคำหลัก เช่น "มหาเวทย์ผนึกมาร" จาก "มหาเวทย์ผนึกมาร S2"
-    tokens = query.split()
-    keywords = [t for t in tokens if not re.fullmatch(r"[sS]\d+", t)]
-    main_keyword = max(keywords, key=len) if keywords else query
+def _proxy_cache_dir(video_url: str) -> str:
+    key = hashlib.sha1(video_url.encode("utf-8")).hexdigest()
+    return os.path.join(PROXY_CACHE_ROOT, key[:2], key)
 
-    conn = get_db_connection()
-    series_rows = conn.execute("SELECT * FROM series").fetchall()
-    conn.close()
 
-    def score(row):
-        title = (row["title"] or "").lower()
-        desc = (row["description"] or "").lower()
-        q = query.lower()
-        mk = main_keyword.lower()
+def _proxy_drop_chunks(cache_dir: str):
+    """ลบ chunk ทั้งหมดของไฟล์ต้นทางหนึ่งไฟล์ (ใช้เมื่อไฟล์ต้นทางเปลี่ยน)"""
+    global _proxy_lru_bytes
+    with _proxy_lock:
+        _proxy_load_index()
+        prefix = cache_dir + os.sep
+        for path in [p for p in _proxy_lru if p.startswith(prefix)]:
+            _proxy_lru_bytes -= _proxy_lru.pop(path)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
 
-        if title == q:
+
+def _proxy_meta(video_url: str):
+    """อ่านขนาดไฟล์ทั้งหมดของต้นทาง (จากแคชที่อายุไม่เกิน PROXY_META_TTL หรือถามต้นทางด้วย Range ไบต์แรก)
+    คืนค่า None ถ้าต้นทางไม่รองรับ Range"""
+    cache_dir = _proxy_cache_dir(video_url)
+    meta_path = os.path.join(cache_dir, "meta.json")
+    cached = None
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        pass
+    if cached is not None and time.time() - cached.get("checked_at", 0) < PROXY_META_TTL:
+        return cached
+
+    try:
+        resp = _proxy_http.get(
+            video_url, headers={"Range": "bytes=0-0"}, stream=True, timeout=10
+        )
+    except requests.RequestException:
+        # ต้นทางติดต่อไม่ได้ชั่วคราว: ใช้ข้อมูลเดิมไปก่อน
+        if cached is not None:
+            return cached
+        raise
+    try:
+        content_range = resp.headers.get("Content-Range", "")
+        if resp.status_code != 206 or "/" not in content_range:
+            return None
+        total = content_range.rsplit("/", 1)[1]
+        if not total.isdigit():
+            return None
+        meta = {
+            "url": video_url,
+            "size": int(total),
+            "content_type": resp.headers.get("Content-Type") or "video/mp4",
+            "etag": resp.headers.get("ETag"),
+            "last_modified": resp.headers.get("Last-Modified"),
+            "checked_at": time.time(),
+        }
+    finally:
+        resp.close()
+
+    if cached is not None and any(cached.get(k) != meta[k] for k in ("size", "etag", "last_modified")):
+        _proxy_drop_chunks(cache_dir)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{meta_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, meta_path)
+    return meta
+
+
+@contextmanager
+def _proxy_chunk_lock(chunk_path: str):
+    with _proxy_inflight_guard:
+        entry = _proxy_inflight.setdefault(chunk_path, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _proxy_inflight_guard:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _proxy_inflight[chunk_path]
+
+
+def _proxy_open_chunk(video_url: str, index: int, total: int):
+    """เปิดไฟล์ chunk ที่ index จากดิสก์ ถ้าไม่มีให้ดึงจากต้นทางลงแคชก่อน
+    คืน file object ที่เปิดไว้แล้ว (ถูกลบออกจาก LRU ระหว่างอ่านก็ยังอ่านต่อได้)"""
+    cache_dir = _proxy_cache_dir(video_url)
+    chunk_path = os.path.join(cache_dir, f"{index}.bin")
+    try:
+        f = open(chunk_path, "rb")
+    except OSError:
+        pass
+    else:
+        _proxy_touch(chunk_path)
+        return f
+
+    with _proxy_chunk_lock(chunk_path):
+        # คนที่รออยู่: คนก่อนหน้าอาจดึงเสร็จแล้ว
+        try:
+            f = open(chunk_path, "rb")
+        except OSError:
+            pass
+        else:
+            _proxy_touch(chunk_path)
+            return f
+
+        start = index * PROXY_CHUNK_SIZE
+        end = min(start + PROXY_CHUNK_SIZE, total) - 1
+        expected = end - start + 1
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{chunk_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        resp = _proxy_http.get(
+            video_url, headers={"Range": f"bytes={start}-{end}"}, stream=True, timeout=30
+        )
+        try:
+            if resp.status_code != 206:
+                raise RuntimeError(f"ต้นทางตอบกลับ {resp.status_code}")
+            written = 0
+            with open(tmp_path, "wb") as out:
+                for data in resp.iter_content(PROXY_READ_SIZE):
+                    written += len(data)
+                    if written > expected:
+                        break
+                    out.write(data)
+            if written != expected:
+                raise RuntimeError("ข้อมูลจากต้นทางไม่ครบ")
+            os.replace(tmp_path, chunk_path)
+        finally:
+            resp.close()
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        f = open(chunk_path, "rb")
+        _proxy_touch(chunk_path, expected)
+        return f
+
+
+def parse_range_header(range_header, total: int):
+    """แปลง header Range แบบ bytes=a-b (ช่วงเดียว) เป็น (start, end)
+    คืนค่า None ถ้าไม่มี Range และ raise ValueError ถ้าช่วงไม่ถูกต้อง"""
+    if not range_header:
+        return None
+    m = re.fullmatch(r"\s*bytes=(\d*)-(\d*)\s*", range_header)
+    if not m or (not m.group(1) and not m.group(2)):
+        raise ValueError("invalid range")
+    if m.group(1):
+        start = int(m.group(1))
+        end = int(m.group(2)) if m.group(2) else total - 1
+    else:
+        # bytes=-N หมายถึง N ไบต์สุดท้าย
+        start = max(total - int(m.group(2)), 0)
+        end = total - 1
+    end = min(end, total - 1)
+    if start > end:
+        raise ValueError("invalid range")
+    return start, end
+
+
+def proxy_direct_response(video_url: str):
+    """เสิร์ฟวิดีโอแบบ direct ผ่านแคช chunk รองรับ Range request"""
+    try:
+        meta = _proxy_meta(video_url)
+    except requests.RequestException:
+        meta = None
+    if meta is None:
+        # ต้นทางไม่รองรับ Range หรือติดต่อไม่ได้: ส่งผู้ชมไปที่ต้นทางตรง ๆ ตามเดิม
+        return redirect(video_url)
+
+    total = meta["size"]
+    try:
+        byte_range = parse_range_header(request.headers.get("Range"), total)
+    except ValueError:
+        return Response(status=416, headers={"Content-Range": f"bytes */{total}"})
+
+    if byte_range is None:
+        start, end, status = 0, total - 1, 200
+    else:
+        start, end = byte_range
+        status = 206
+
+    def generate():
+        pos = start
+        while pos <= end:
+            index = pos // PROXY_CHUNK_SIZE
+            chunk_end = min((index + 1) * PROXY_CHUNK_SIZE, end + 1)
+            with _proxy_open_chunk(video_url, index, total) as f:
+                f.seek(pos - index * PROXY_CHUNK_SIZE)
+                while pos < chunk_end:
+                    piece = f.read(min(PROXY_READ_SIZE, chunk_end - pos))
+                    if not piece:
+                        raise RuntimeError("chunk ในแคชไม่ครบ")
+                    yield piece
+                    pos += len(piece)
+
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Length": str(end - start + 1),
+    }
+    if status == 206:
+        headers["Content-Range"] = f"bytes {start}-{end}/{total}"
+    return Response(
+        generate(),
+        status=status,
+        mimetype=meta.get("content_type") or "video/mp4",
+        headers=headers,
+        direct_passthrough=True,
+    )
+
+
+# ---------- จำกัดพื้นที่ดิสก์ของไฟล์วิดีโอ (ลบไฟล์ gdrive ที่ไม่ได้ดูนานที่สุด) ----------
+# VIDEO_DISK_BUDGET_MB=0 คือไม่จำกัด ไฟล์ที่อัปโหลดเองจะไม่ถูกลบเด็ดขาด
+# เพราะไฟล์ gdrive โหลดใหม่ได้เสมอผ่าน fetch_drive_file
+VIDEO_DISK_BUDGET_BYTES = int(os.getenv("VIDEO_DISK_BUDGET_MB", "0")) * 1024 * 1024
+# เขียนเวลาเข้าถึงลงไฟล์ (mtime) อย่างมากทุก ๆ กี่วินาทีต่อไฟล์
+VIDEO_ACCESS_FLUSH_SECONDS = 60
+
+# path เต็มของไฟล์ -> เวลาที่ถูกสตรีมล่าสุด (เฉพาะใน worker นี้)
+_video_last_access = {}
+_video_access_lock = threading.Lock()
+
+
+def touch_video_file(abs_path: str):
+    """บันทึกว่าไฟล์วิดีโอนี้เพิ่งถูกดู (ในหน่วยความจำ และลง mtime เป็นระยะ ๆ
+    เพื่อให้ worker อื่นและหลังรีสตาร์ทเห็นลำดับเดียวกัน)"""
+    now = time.time()
+    with _video_access_lock:
+        previous = _video_last_access.get(abs_path, 0)
+        _video_last_access[abs_path] = now
+    if now - previous >= VIDEO_ACCESS_FLUSH_SECONDS:
+        try:
+            os.utime(abs_path, (now, now))
+        except OSError:
+            pass
+
+
+def _video_disk_usage() -> int:
+    total = 0
+    for root, _dirs, files in os.walk(VIDEO_ROOT):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def enforce_video_disk_budget(keep=None) -> int:
+    """ถ้าไฟล์ใน VIDEO_ROOT ใหญ่เกินงบ ให้ลบไฟล์ gdrive ที่ไม่ได้ดูนานที่สุดออก
+    แล้วล้าง file_path ของตอนที่ใช้ไฟล์นั้น (ตอนดูครั้งหน้าจะโหลดใหม่เอง)
+    keep คือ path (หรือชุดของ path) ที่ห้ามลบ เช่นไฟล์ที่เพิ่งโหลดมา คืนค่าจำนวนไบต์ที่ลบไป"""
+    if VIDEO_DISK_BUDGET_BYTES <= 0:
+        return 0
+
+    usage = _video_disk_usage()
+    if usage <= VIDEO_DISK_BUDGET_BYTES:
+        return 0
+
+    if isinstance(keep, str):
+        keep = (keep,)
+    keep_abs = {os.path.abspath(path) for path in keep or ()}
+
+    conn = get_db_connection()
+    rows = conn.execute(
+        """
+        SELECT DISTINCT file_path FROM episodes
+        WHERE source_type = 'gdrive' AND file_path IS NOT NULL AND file_path != ''
+        """
+    ).fetchall()
+    protected = {
+        r["file_path"]
+        for r in conn.execute(
+            "SELECT DISTINCT file_path FROM episodes WHERE source_type != 'gdrive' AND file_path IS NOT NULL"
+        ).fetchall()
+    }
+
+    candidates = []
+    for row in rows:
+        fp = row["file_path"]
+        if fp in protected:
+            continue
+        abs_path = os.path.abspath(fp if os.path.isabs(fp) else os.path.join(BASE_DIR, fp))
+        if abs_path in keep_abs:
+            continue
+        try:
+            st = os.stat(abs_path)
+        except OSError:
+            continue
+        last = max(st.st_mtime, _video_last_access.get(abs_path, 0))
+        candidates.append((last, abs_path, fp, st.st_size))
+    candidates.sort()
+
+    freed = 0
+    for _last, abs_path, fp, size in candidates:
+        if usage - freed <= VIDEO_DISK_BUDGET_BYTES:
+            break
+        try:
+            os.remove(abs_path)
+        except OSError:
+            continue
+        # ไม่แตะตอนแบบ upload แม้จะชี้ไฟล์เดียวกัน
+        conn.execute(
+            "UPDATE episodes SET file_path = NULL WHERE file_path = ? AND source_type = 'gdrive'",
+            (fp,),
+        )
+        with _video_access_lock:
+            _video_last_access.pop(abs_path, None)
+        freed += size
+
+    conn.commit()
+    conn.close()
+    return freed
+
+
+# ---------- แฮชรหัสผ่านใน process pool แบบจำกัดคิว ----------
+# scrypt/pbkdf2 ตั้งใจให้ช้า ถ้าคำนวณใน worker โดยตรง ช่วงที่มีคนล็อกอินพร้อมกันเยอะ ๆ
+# หน้าเว็บและวิดีโอจะช้าไปด้วย จึงส่งไปทำใน process pool ขนาดคงที่
+# ถ้าคิวเต็มจะปฏิเสธทันที (PasswordHasherBusy) แทนที่จะรอจนหมดเวลา
+PASSWORD_HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", "scrypt:32768:8:1")
+PASSWORD_POOL_WORKERS = int(os.getenv("PASSWORD_POOL_WORKERS", "2"))
+PASSWORD_QUEUE_LIMIT = int(os.getenv("PASSWORD_QUEUE_LIMIT", "16"))
+PASSWORD_HASH_TIMEOUT = float(os.getenv("PASSWORD_HASH_TIMEOUT", "10"))
+
+
+class PasswordHasherBusy(Exception):
+    """คิวแฮชรหัสผ่านเต็ม ให้ผู้ใช้ลองใหม่ภายหลัง"""
+
+
+_password_pool = None
+_password_pool_lock = threading.Lock()
+_password_slots = threading.BoundedSemaphore(PASSWORD_QUEUE_LIMIT)
+# rejected = คิวเต็ม, timeouts = รอผลเกิน PASSWORD_HASH_TIMEOUT, pool_broken = process ใน pool ตาย
+# ทุกค่าแก้ภายใต้ _password_metrics_lock (หลาย thread ใน worker เดียวกันเขียนพร้อมกัน)
+_password_metrics_lock = threading.Lock()
+password_metrics = {
+    "jobs": 0,
+    "in_flight": 0,
+    "rejected": 0,
+    "timeouts": 0,
+    "pool_broken": 0,
+    "rehashed": 0,
+    "total_seconds": 0.0,
+    "max_seconds": 0.0,
+}
+
+
+def _get_password_pool():
+    # สร้างตอนใช้ครั้งแรก แต่ละ worker มี pool ของตัวเอง
+    # ใช้ forkserver / spawn ไม่ใช้ fork: worker มีหลาย thread ถ้า fork ตอนที่ thread อื่นถือ lock อยู่
+    # process ลูกจะได้ lock ที่ไม่มีวันถูกปล่อยติดไปด้วย งานที่ส่งไปคือฟังก์ชันของ werkzeug.security
+    # process ลูกจึง import แค่โมดูลนั้น ไม่ต้อง import app ทั้งไฟล์
+    global _password_pool
+    with _password_pool_lock:
+        if _password_pool is None:
+            methods = multiprocessing.get_all_start_methods()
+            ctx = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            _password_pool = ProcessPoolExecutor(
+                max_workers=PASSWORD_POOL_WORKERS, mp_context=ctx
+            )
+        return _password_pool
+
+
+def _count_password_metric(key, amount=1):
+    with _password_metrics_lock:
+        password_metrics[key] += amount
+
+
+def _discard_broken_password_pool(pool):
+    # pool ที่ process ตายใช้ต่อไม่ได้อีก ทิ้งไปให้ครั้งถัดไปสร้างใหม่
+    global _password_pool
+    with _password_pool_lock:
+        if _password_pool is pool:
+            _password_pool = None
+    pool.shutdown(wait=False)
+
+
+def _release_password_slot(_future):
+    with _password_metrics_lock:
+        password_metrics["in_flight"] -= 1
+    _password_slots.release()
+
+
+def _run_password_job(func, *args):
+    if not _password_slots.acquire(blocking=False):
+        _count_password_metric("rejected")
+        raise PasswordHasherBusy()
+    started = time.monotonic()
+    pool = _get_password_pool()
+    try:
+        future = pool.submit(func, *args)
+    except (BrokenProcessPool, RuntimeError):
+        # pool พังหรือถูกปิดไปแล้วระหว่างนั้น งานไม่ได้เข้าคิว คืน slot ทันที
+        _password_slots.release()
+        _count_password_metric("pool_broken")
+        _discard_broken_password_pool(pool)
+        raise PasswordHasherBusy()
+    _count_password_metric("in_flight")
+    # คืน slot เมื่องานใน pool จบจริง ไม่ใช่ตอนเลิกรอ งานที่หมดเวลายังนับอยู่ในคิวจนกว่าจะเสร็จ
+    # PASSWORD_QUEUE_LIMIT จึงจำกัดงานที่ค้างใน pool จริง ๆ
+    future.add_done_callback(_release_password_slot)
+    try:
+        return future.result(timeout=PASSWORD_HASH_TIMEOUT)
+    except FuturesTimeout:
+        _count_password_metric("timeouts")
+        raise PasswordHasherBusy()
+    except BrokenProcessPool:
+        _count_password_metric("pool_broken")
+        _discard_broken_password_pool(pool)
+        raise PasswordHasherBusy()
+    finally:
+        elapsed = time.monotonic() - started
+        with _password_metrics_lock:
+            password_metrics["jobs"] += 1
+            password_metrics["total_seconds"] += elapsed
+            password_metrics["max_seconds"] = max(password_metrics["max_seconds"], elapsed)
+
+
+def hash_password(password: str) -> str:
+    return _run_password_job(generate_password_hash, password, PASSWORD_HASH_METHOD)
+
+
+def verify_password(pwhash: str, password: str) -> bool:
+    if not pwhash:
+        return False
+    return _run_password_job(check_password_hash, pwhash, password)
+
+
+PASSWORD_BUSY_MESSAGE = "ขณะนี้มีผู้ใช้งานจำนวนมาก กรุณาลองใหม่อีกครั้งในอีกสักครู่"
+
+
+def password_needs_rehash(pwhash: str) -> bool:
+    """แฮชเดิมใช้วิธี/พารามิเตอร์ต่างจาก PASSWORD_HASH_METHOD หรือไม่"""
+    return (pwhash or "").split("$", 1)[0] != PASSWORD_HASH_METHOD
+
+
+# ---------- จำกัดความถี่คำขอ (token bucket) ----------
+# ตรวจใน before_request ก่อน Turnstile / KDF / อ่านไฟล์ คำขอที่เกินจะได้ 429 ทันที
+# RATE_LIMIT_BACKEND=memory  เก็บ bucket ใน process (เร็วสุด แต่แยกกันต่อ worker)
+# RATE_LIMIT_BACKEND=sqlite  เก็บใน RATE_LIMIT_DB ใช้ร่วมกันทุก worker (UPSERT คำสั่งเดียวต่อ bucket)
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT", "1") == "1"
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_DB = os.getenv("RATE_LIMIT_DB", "ratelimit.db")
+# ใช้ IP แรกใน X-Forwarded-For (เปิดเฉพาะเมื่ออยู่หลัง reverse proxy ที่เชื่อถือได้)
+RATE_LIMIT_TRUST_FORWARDED = os.getenv("RATE_LIMIT_TRUST_FORWARDED", "0") == "1"
+
+# endpoint -> รายการนโยบาย: (methods, ขอบเขต "ip"/"user", ความจุ bucket, เติมกี่ token ต่อวินาที)
+RATE_LIMIT_POLICIES = {
+    "user_login": [(("POST",), "ip", 10, 10 / 60)],
+    "user_register": [(("POST",), "ip", 5, 5 / 3600)],
+    "admin_login": [(("POST",), "ip", 5, 5 / 300)],
+    "stream_episode": [
+        (("GET", "HEAD"), "ip", 240, 8),
+        (("GET", "HEAD"), "user", 240, 8),
+    ],
+    # ช่องค้นหายิงทุกครั้งที่พิมพ์ ให้ burst ได้แต่ไม่ปล่อยให้ใช้แทนการดูดทั้งแคตตาล็อก
+    "search_suggest": [(("GET",), "ip", 60, 10)],
+}
+if os.getenv("RATE_LIMITS_JSON"):
+    # เช่น {"user_login": [[["POST"], "ip", 20, 0.5]]}
+    RATE_LIMIT_POLICIES.update(
+        {
+            endpoint: [(tuple(m), scope, float(cap), float(rate)) for m, scope, cap, rate in rules]
+            for endpoint, rules in json.loads(os.environ["RATE_LIMITS_JSON"]).items()
+        }
+    )
+
+_memory_buckets = {}
+_memory_buckets_lock = threading.Lock()
+_MEMORY_BUCKETS_MAX = 100000
+_ratelimit_local = threading.local()
+rate_limit_rejections = {}  # endpoint -> จำนวนคำขอที่ถูกตอบ 429 (ต่อ worker)
+
+
+def _take_token_memory(key, capacity, rate, now):
+    with _memory_buckets_lock:
+        bucket = _memory_buckets.get(key)
+        if bucket is None:
+            if len(_memory_buckets) >= _MEMORY_BUCKETS_MAX:
+                # ทิ้ง bucket ที่เต็มแล้ว (ไม่มีผลต่อการจำกัด) เพื่อไม่ให้ใช้หน่วยความจำไม่จำกัด
+                for k in [k for k, (t, u, c, r) in _memory_buckets.items() if t + (now - u) * r >= c]:
+                    del _memory_buckets[k]
+            bucket = [capacity, now, capacity, rate]
+            _memory_buckets[key] = bucket
+        tokens = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            return 0.0
+        bucket[0] = tokens
+        return (1 - tokens) / rate
+
+
+def _ratelimit_conn():
+    conn = getattr(_ratelimit_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(RATE_LIMIT_DB, timeout=1, isolation_level=None)
+        conn.execute("PRAGMA journal_mode = WAL;")
+        conn.execute("PRAGMA synchronous = OFF;")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS buckets (
+                key TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated REAL NOT NULL
+            ) WITHOUT ROWID
+            """
+        )
+        _ratelimit_local.conn = conn
+    return conn
+
+
+def _take_token_sqlite(key, capacity, rate, now):
+    # เติม token ตามเวลาที่ผ่านไปแล้วหักหนึ่ง ในคำสั่งเดียว (atomic ระหว่าง worker)
+    # ถ้าไม่พอ WHERE จะไม่ผ่าน และ RETURNING จะไม่คืนแถว
+    conn = _ratelimit_conn()
+    row = conn.execute(
+        """
+        INSERT INTO buckets (key, tokens, updated) VALUES (?1, ?2 - 1, ?4)
+        ON CONFLICT(key) DO UPDATE SET
+            tokens = MIN(?2, tokens + (?4 - updated) * ?3) - 1,
+            updated = ?4
+        WHERE MIN(?2, tokens + (?4 - updated) * ?3) >= 1
+        RETURNING tokens
+        """,
+        (key, capacity, rate, now),
+    ).fetchone()
+    if row is not None:
+        return 0.0
+    current = conn.execute(
+        "SELECT tokens, updated FROM buckets WHERE key = ?", (key,)
+    ).fetchone()
+    tokens = min(capacity, current[0] + (now - current[1]) * rate) if current else 0
+    return max((1 - tokens) / rate, 0.0)
+
+
+def client_ip(headers_get, remote_addr):
+    if RATE_LIMIT_TRUST_FORWARDED:
+        forwarded = headers_get("X-Forwarded-For")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return remote_addr or "-"
+
+
+def check_rate_limit(endpoint, method, ip, user_id):
+    """คืนจำนวนวินาทีที่ต้องรอ ถ้าเกินโควตา หรือ None ถ้าผ่าน"""
+    if not RATE_LIMIT_ENABLED:
+        return None
+    policies = RATE_LIMIT_POLICIES.get(endpoint)
+    if not policies:
+        return None
+
+    take = _take_token_sqlite if RATE_LIMIT_BACKEND == "sqlite" else _take_token_memory
+    now = time.time()
+    for methods, scope, capacity, rate in policies:
+        if method not in methods:
+            continue
+        if scope == "user":
+            if not user_id:
+                continue
+            key = f"{endpoint}|u|{user_id}"
+        else:
+            key = f"{endpoint}|ip|{ip}"
+        try:
+            wait = take(key, capacity, rate, now)
+        except sqlite3.Error:
+            # backend ร่วมมีปัญหา: ไม่บล็อกผู้ใช้
+            wait = 0.0
+        if wait > 0:
+            rate_limit_rejections[endpoint] = rate_limit_rejections.get(endpoint, 0) + 1
+            return wait
+    return None
+
+
+@app.before_request
+def rate_limit_guard():
+    wait = check_rate_limit(
+        request.endpoint,
+        request.method,
+        client_ip(request.headers.get, request.remote_addr),
+        session.get("user_id"),
+    )
+    if wait is not None:
+        return Response(
+            "Too Many Requests",
+            status=429,
+            mimetype="text/plain",
+            headers={"Retry-After": str(max(1, int(wait + 0.999)))},
+        )
+    return None
+
+
+def is_admin() -> bool:
+    return bool(session.get("is_admin"))
+
+
+def admin_required():
+    if not is_admin():
+        flash("ต้องเข้าสู่ระบบแอดมินก่อน", "error")
+        return False
+    return True
+
+
+
+# ฟังก์ชันจัดการสถานะผู้ใช้ทั่วไป
+def get_current_user():
+    user_id = session.get("user_id")
+    if not user_id:
+        return None
+    conn = get_db_connection()
+    user = conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
+    conn.close()
+    return user
+
+
+def login_user(user_row):
+    session["user_id"] = user_row["id"]
+    session["username"] = user_row["username"]
+
+
+def logout_user():
+    session.pop("user_id", None)
+    session.pop("username", None)
+
+
+def user_login_required(view_func):
+    @wraps(view_func)
+    def wrapped_view(*args, **kwargs):
+        if not session.get("user_id"):
+            # ถ้ายังไม่ได้ล็อกอิน ให้ไปหน้าเข้าสู่ระบบผู้ใช้
+            flash("กรุณาเข้าสู่ระบบก่อนดูวิดีโอ", "error")
+            return redirect(url_for("user_login", next=request.path))
+        return view_func(*args, **kwargs)
+
+    return wrapped_view
+
+# ---------- ตำแหน่งดูต่อ (resume) ----------
+# ตัวเล่นส่ง heartbeat มาเป็นระยะ เราเก็บเฉพาะค่าล่าสุดต่อ (user, episode) ในหน่วยความจำ
+# แล้วเขียนลง DB เป็นชุดทุก RESUME_FLUSH_SECONDS วินาที
+# จำนวนการเขียนจึงขึ้นกับจำนวนคนที่กำลังดู ไม่ใช่ความถี่ของ heartbeat
+RESUME_FLUSH_SECONDS = int(os.getenv("RESUME_FLUSH_SECONDS", "15"))
+
+_pending_positions = {}
+_pending_positions_lock = threading.Lock()
+_resume_flusher_started = False
+
+
+def flush_playback_positions():
+    """เขียนตำแหน่งที่ค้างอยู่ทั้งหมดลง DB ใน transaction เดียว"""
+    with _pending_positions_lock:
+        if not _pending_positions:
+            return 0
+        batch = [
+            (user_id, episode_id, position, updated_at)
+            for (user_id, episode_id), (position, updated_at) in _pending_positions.items()
+        ]
+        _pending_positions.clear()
+
+    conn = get_db_connection()
+    try:
+        conn.executemany(
+            """
+            INSERT INTO playback_positions (user_id, episode_id, position, updated_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(user_id, episode_id) DO UPDATE SET
+                position = excluded.position,
+                updated_at = excluded.updated_at
+            WHERE excluded.updated_at >= playback_positions.updated_at
+            """,
+            batch,
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    return len(batch)
+
+
+def _resume_flush_loop():
+    while True:
+        time.sleep(RESUME_FLUSH_SECONDS)
+        try:
+            flush_playback_positions()
+        except Exception:
+            pass
+
+
+def _start_resume_flusher():
+    # เริ่ม thread ตอนมี heartbeat ครั้งแรก (หลัง gunicorn fork แล้ว)
+    global _resume_flusher_started
+    with _pending_positions_lock:
+        if _resume_flusher_started:
+            return
+        _resume_flusher_started = True
+    threading.Thread(target=_resume_flush_loop, daemon=True).start()
+
+
+atexit.register(flush_playback_positions)
+
+
+def record_playback_position(user_id, episode_id, position):
+    with _pending_positions_lock:
+        _pending_positions[(user_id, episode_id)] = (position, datetime.utcnow().isoformat())
+    _start_resume_flusher()
+
+
+def get_playback_position(user_id, episode_id) -> float:
+    """คืนตำแหน่งล่าสุด (วินาที) ดูค่าที่ยังไม่ flush ใน worker นี้ก่อน"""
+    with _pending_positions_lock:
+        pending = _pending_positions.get((user_id, episode_id))
+    if pending is not None:
+        return pending[0]
+
+    conn = get_db_connection()
+    row = conn.execute(
+        "SELECT position FROM playback_positions WHERE user_id = ? AND episode_id = ?",
+        (user_id, episode_id),
+    ).fetchone()
+    conn.close()
+    return float(row["position"]) if row else 0.0
+
+
+# รหัสของชุด template/โค้ดที่ใช้อยู่ (เหมือนกันทุก worker) เปลี่ยนเมื่อ deploy ใหม่
+_PAGE_BUILD_ID = hashlib.sha1(
+    repr(
+        sorted(
+            (name, os.path.getmtime(os.path.join(root, name)))
+            for root, _dirs, files in os.walk(os.path.join(BASE_DIR, "templates"))
+            for name in files
+        )
+        + [os.path.getmtime(__file__)]
+    ).encode("utf-8")
+).hexdigest()[:8]
+
+
+def conditional_catalog_page(view_func):
+    """ETag / Last-Modified ของหน้า HTML แคตตาล็อก ตอบ 304 ก่อนรัน SQL หรือ Jinja
+    ETag ผูกกับเวอร์ชันแคตตาล็อก, URL และสถานะล็อกอิน (เมนูในหน้าต่างกันตามผู้ใช้)"""
+
+    @wraps(view_func)
+    def wrapped_view(*args, **kwargs):
+        # มีข้อความ flash ค้างอยู่: หน้าไม่เหมือนเดิม ข้ามการใช้แคช
+        if session.get("_flashes"):
+            return view_func(*args, **kwargs)
+
+        version, updated_at = get_catalog_state()
+        identity = f"{session.get('user_id') or ''}:{1 if session.get('is_admin') else 0}"
+        etag = "page-" + hashlib.sha1(
+            f"{_PAGE_BUILD_ID}|{version}|{identity}|{request.full_path}".encode("utf-8")
+        ).hexdigest()[:16]
+        last_modified = datetime.utcfromtimestamp(updated_at) if updated_at else None
+
+        if request.if_none_match:
+            not_modified = etag_matches(etag)
+        else:
+            ims = request.if_modified_since
+            not_modified = bool(
+                last_modified and ims and ims.replace(tzinfo=None) >= last_modified
+            )
+        if not_modified:
+            response = Response(status=304)
+            response.set_etag(etag)
+            response.headers["Cache-Control"] = "private, no-cache"
+            response.vary.add("Cookie")
+            return response
+
+        response = app.make_response(view_func(*args, **kwargs))
+        if response.status_code == 200 and not session.get("_flashes"):
+            response.set_etag(etag)
+            if last_modified:
+                response.last_modified = last_modified
+            response.headers["Cache-Control"] = "private, no-cache"
+            response.vary.add("Cookie")
+        return response
+
+    return wrapped_view
+
+
+@app.route("/")
+@conditional_catalog_page
+def index():
+    # sort=recent เรียงตามเรื่องที่มีตอนใหม่ล่าสุด (ใช้คอลัมน์สถิติ ไม่ต้องสแกน episodes)
+    sort = request.args.get("sort", "")
+    catalog = get_catalog()
+    if sort == "recent":
+        series_list = catalog.series_by_recent
+    else:
+        series_list = catalog.series_by_created
+    return render_template("index.html", series_list=series_list, sort=sort)
+
+
+
+
+def rank_series(series_rows, query: str):
+    """จัดอันดับเรื่องตามความตรงกับคำค้น คืนค่า (คำหลัก, รายการที่เรียงแล้ว)"""
+    # ตัดคำอย่างง่าย: เอาคำหลัก เช่น "มหาเวทย์ผนึกมาร" จาก "มหาเวทย์ผนึกมาร S2"
+    tokens = query.split()
+    keywords = [t for t in tokens if not re.fullmatch(r"[sS]\d+", t)]
+    main_keyword = max(keywords, key=len) if keywords else query
+
+    def score(row):
+        title = (row["title"] or "").lower()
+        desc = (row["description"] or "").lower()
+        q = query.lower()
+        mk = main_keyword.lower()
+
+        if title == q:
             base = 4
         elif q in title:
             base = 3
@@ -375,7 +2206,17 @@ def search():
         return base
 
     sorted_rows = sorted(series_rows, key=score, reverse=True)
-    results = sorted_rows  # แสดงทุกเรื่อง แต่จัดอันดับให้เรื่องที่ตรงสุดอยู่ด้านบน
+    # แสดงทุกเรื่อง แต่จัดอันดับให้เรื่องที่ตรงสุดอยู่ด้านบน
+    return main_keyword, sorted_rows
+
+
+@app.route("/search")
+def search():
+    query = request.args.get("q", "").strip()
+    if not query:
+        return redirect(url_for("index"))
+
+    main_keyword, results = rank_series(get_catalog().series_by_id_order, query)
 
     return render_template(
         "search_results.html",
@@ -384,118 +2225,382 @@ def search():
         series_list=results,
     )
 
+
+# ---------- คำแนะนำขณะพิมพ์ค้นหา (/search/suggest) ----------
+# ดัชนี prefix ในหน่วยความจำ: เก็บชื่อเรื่องที่ normalize แล้วเป็น list เรียงลำดับ
+# แล้วหาด้วย bisect ไม่ต้องสแกนทุกเรื่องเหมือน /search
+# ชื่อถูกตัดเป็นคำตามช่องว่าง และเก็บ key เริ่มจากทุกคำ พิมพ์ "S2" หรือคำที่สองก็เจอ
+# ดัชนีตาม catalog_version: เมื่อแอดมินเพิ่ม/แก้ไข/ลบเรื่อง จะอัปเดตเฉพาะเรื่องที่เปลี่ยน
+SUGGEST_LIMIT_DEFAULT = 8
+SUGGEST_LIMIT_MAX = 20
+# "ซีซั่น 2", "season 02", "ภาค 2", "S2" -> "s2"
+SEASON_TOKEN_RE = re.compile(r"(?<![a-z0-9])(?:season|s|ซีซั่น|ซีซัน|ภาค)\s*0*(\d+)(?![0-9])")
+_ZERO_WIDTH = dict.fromkeys(map(ord, "\u200b\u200c\u200d\ufeff"))
+
+
+def normalize_title(text: str) -> str:
+    """ทำชื่อเรื่อง/คำค้นให้อยู่รูปเดียวกัน: NFKC, ตัวพิมพ์เล็ก, ตัดเครื่องหมายวรรคตอน
+    และรวมคำบอกซีซั่นเป็น s<เลข> (สระและวรรณยุกต์ไทยยังอยู่ครบ)"""
+    text = unicodedata.normalize("NFKC", text or "").translate(_ZERO_WIDTH).casefold()
+    text = "".join(" " if unicodedata.category(ch)[0] in "PSZC" else ch for ch in text)
+    text = SEASON_TOKEN_RE.sub(r" s\1 ", text)
+    return " ".join(text.split())
+
+
+class SuggestIndex:
+    def __init__(self):
+        self.version = None
+        self._lock = threading.Lock()
+        # (key, series_id) เรียงตาม key: ชื่อเต็มอยู่ใน _titles, key ที่เริ่มจากคำถัด ๆ ไปอยู่ใน _tokens
+        self._titles = []
+        self._tokens = []
+        # series_id -> (ชื่อเรื่อง, key ชื่อเต็ม, key ของคำถัด ๆ ไป)
+        self._series = {}
+
+    @staticmethod
+    def _keys(title):
+        words = normalize_title(title).split()
+        return " ".join(words), [" ".join(words[i:]) for i in range(1, len(words))]
+
+    @staticmethod
+    def _remove(entries, entry):
+        i = bisect.bisect_left(entries, entry)
+        if i < len(entries) and entries[i] == entry:
+            del entries[i]
+
+    def _drop(self, series_id):
+        _title, full, rest = self._series.pop(series_id)
+        if full:
+            self._remove(self._titles, (full, series_id))
+        for key in rest:
+            self._remove(self._tokens, (key, series_id))
+
+    def _add(self, series_id, title):
+        full, rest = self._keys(title)
+        self._series[series_id] = (title, full, rest)
+        if full:
+            bisect.insort(self._titles, (full, series_id))
+        for key in rest:
+            bisect.insort(self._tokens, (key, series_id))
+
+    def sync(self, catalog: "CatalogSnapshot"):
+        """ตามแคตตาล็อกให้ทัน แก้เฉพาะเรื่องที่เพิ่ม ลบ เปลี่ยนชื่อ หรือเปิด/ปิดการดู"""
+        if self.version == catalog.version:
+            return
+        with self._lock:
+            if self.version == catalog.version:
+                return
+            visible = {
+                s.id: s.title or ""
+                for s in catalog.series_by_id_order
+                if s.is_active is None or int(s.is_active) == 1
+            }
+            for series_id in [sid for sid in self._series if sid not in visible]:
+                self._drop(series_id)
+            for series_id, title in visible.items():
+                current = self._series.get(series_id)
+                if current is not None and current[0] == title:
+                    continue
+                if current is not None:
+                    self._drop(series_id)
+                self._add(series_id, title)
+            self.version = catalog.version
+
+    def suggest(self, query: str, limit: int):
+        """เรื่องที่ชื่อขึ้นต้นด้วยคำค้นมาก่อน ตามด้วยเรื่องที่มีคำในชื่อขึ้นต้นด้วยคำค้น"""
+        q = normalize_title(query)
+        if not q:
+            return []
+        found = []
+        seen = set()
+        with self._lock:
+            for entries in (self._titles, self._tokens):
+                i = bisect.bisect_left(entries, (q,))
+                while i < len(entries) and len(found) < limit:
+                    key, series_id = entries[i]
+                    if not key.startswith(q):
+                        break
+                    if series_id not in seen:
+                        seen.add(series_id)
+                        found.append((series_id, self._series[series_id][0]))
+                    i += 1
+        return found
+
+
+_suggest_index = SuggestIndex()
+
+
+@app.route("/search/suggest")
+def search_suggest():
+    query = request.args.get("q", "").strip()
+    limit = min(max(request.args.get("limit", type=int) or SUGGEST_LIMIT_DEFAULT, 1), SUGGEST_LIMIT_MAX)
+
+    def build():
+        _suggest_index.sync(get_catalog())
+        return {
+            "query": query,
+            "items": [
+                {"id": series_id, "title": title, "url": url_for("series_detail", series_id=series_id)}
+                for series_id, title in _suggest_index.suggest(query, limit)
+            ],
+        }
+
+    return catalog_api_response(build)
+
 @app.route("/series/<int:series_id>")
+@conditional_catalog_page
 def series_detail(series_id):
-    conn = get_db_connection()
-    series = conn.execute(
-        "SELECT * FROM series WHERE id = ?", (series_id,)
-    ).fetchone()
+    catalog = get_catalog()
+    series = catalog.series(series_id)
     if series is None:
-        conn.close()
         flash("ไม่พบเรื่องนี้", "error")
         return redirect(url_for("index"))
 
-    episodes = conn.execute(
-        """
-        SELECT * FROM episodes
-        WHERE series_id = ?
-        ORDER BY episode_number IS NULL, episode_number, datetime(created_at)
-        """,
-        (series_id,),
-    ).fetchall()
-    conn.close()
+    episodes = catalog.episodes_of(series_id)
     return render_template("series_detail.html", series=series, episodes=episodes)
 
 
 @app.route("/series/<int:series_id>/episode/<int:episode_id>")
 @user_login_required
 def watch_episode(series_id, episode_id):
-    conn = get_db_connection()
-    series = conn.execute(
-        "SELECT * FROM series WHERE id = ?", (series_id,)
-    ).fetchone()
-    episode = conn.execute(
-        "SELECT * FROM episodes WHERE id = ? AND series_id = ?",
-        (episode_id, series_id),
-    ).fetchone()
-    conn.close()
+    catalog = get_catalog()
+    series = catalog.series(series_id)
+    episode = catalog.episode(episode_id)
+    if episode is not None and episode["series_id"] != series_id:
+        episode = None
 
     if series is None or episode is None:
         flash("ไม่พบตอนนี้", "error")
         return redirect(url_for("index"))
 
     # ตรวจสอบสถานะเปิด/ปิด
-    series_active = 1
-    try:
-        if "is_active" in series.keys() and series["is_active"] is not None:
-            series_active = int(series["is_active"])
-    except Exception:
-        series_active = 1
-
-    episode_active = 1
-    try:
-        if "is_active" in episode.keys() and episode["is_active"] is not None:
-            episode_active = int(episode["is_active"])
-    except Exception:
-        episode_active = 1
-
-    blocked = (series_active == 0) or (episode_active == 0)
+    blocked = not is_episode_visible(series_id, episode_id)
 
     # บันทึกประวัติการดู (เฉพาะเมื่อผู้ใช้ล็อกอินแล้ว)
     user_id = session.get("user_id")
     if user_id and not blocked:
+        conn = get_db_connection()
         try:
-            conn = get_db_connection()
-            conn.execute(
-                "INSERT INTO watch_history (user_id, series_id, episode_id, watched_at) VALUES (?, ?, ?, ?)",
-                (user_id, series_id, episode_id, datetime.utcnow().isoformat()),
-            )
+            record_watch(conn, user_id, series_id, episode_id)
             conn.commit()
+        except Exception:
+            conn.rollback()
+        finally:
             conn.close()
+
+    resume_position = 0.0
+    if user_id and not blocked:
+        try:
+            resume_position = get_playback_position(user_id, episode_id)
         except Exception:
-            pass
+            resume_position = 0.0
+
+    # ออก stream token เฉพาะตอนที่มีไฟล์อยู่ในเครื่องแล้ว
+    stream_token = None
+    if user_id and not blocked and episode["file_path"]:
+        fp = episode["file_path"]
+        abs_path = fp if os.path.isabs(fp) else os.path.join(BASE_DIR, fp)
+        if os.path.exists(abs_path):
+            stream_token = make_stream_token(
+                user_id, episode_id, abs_path, episode["source_type"] == "gdrive"
+            )
 
     # ผู้ใช้ยังเข้าได้ปกติ แต่ถ้า blocked == True จะขึ้นข้อความในหน้า watch.html แทนวิดีโอ
-    return render_template("watch.html", series=series, episode=episode, blocked=blocked)
+    return render_template(
+        "watch.html",
+        series=series,
+        episode=episode,
+        blocked=blocked,
+        resume_position=resume_position,
+        stream_token=stream_token,
+    )
+
+
+@app.route("/api/progress/<int:episode_id>", methods=["POST"])
+def save_progress(episode_id):
+    """รับ heartbeat ตำแหน่งการดูจากตัวเล่น (JSON หรือ form: position เป็นวินาที)"""
+    user_id = session.get("user_id")
+    if not user_id:
+        return Response(status=401)
+
+    data = request.get_json(silent=True) or request.form
+    try:
+        position = float(data.get("position"))
+    except (TypeError, ValueError):
+        return Response(status=400)
+    if position < 0 or position != position:
+        return Response(status=400)
+
+    record_playback_position(user_id, episode_id, position)
+    return Response(status=204)
+
+
+# ---------- stream token แบบลงลายเซ็น HMAC ----------
+# watch_episode ออก token อายุสั้นที่ผูก user, ตอน, path ของไฟล์ และ generation ปัจจุบัน
+# range request ทุกครั้งของ /stream ตรวจ token ด้วย CPU ล้วน ๆ ไม่ต้อง SELECT episodes/series
+# ถ้าแอดมินเปิด/ปิด/ลบอะไร generation จะเปลี่ยน token เก่าจะกลับไปใช้ทางตรวจแบบเต็มตามเดิม
+STREAM_TOKEN_TTL = int(os.getenv("STREAM_TOKEN_TTL", str(4 * 3600)))
+VISIBILITY_GENERATION_TTL = float(os.getenv("VISIBILITY_GENERATION_TTL", "1.0"))
+
+_visibility_generation_cache = {"value": None, "checked_at": 0.0}
+
+
+def get_visibility_generation() -> int:
+    now = time.monotonic()
+    cached = _visibility_generation_cache["value"]
+    if cached is not None and now - _visibility_generation_cache["checked_at"] < VISIBILITY_GENERATION_TTL:
+        return cached
+    conn = get_db_connection()
+    row = conn.execute(
+        "SELECT value FROM app_state WHERE key = 'visibility_generation'"
+    ).fetchone()
+    conn.close()
+    value = int(row["value"]) if row else 0
+    _visibility_generation_cache["value"] = value
+    _visibility_generation_cache["checked_at"] = now
+    return value
+
+
+# ดัชนีสถานะเปิด/ปิดในหน่วยความจำ: เก็บเฉพาะ id ที่ถูกปิด (ปกติมีน้อยมาก)
+# โหลดใหม่เมื่อ visibility_generation ใน SQLite เปลี่ยน ทุก worker จึงเห็นตรงกัน
+# (ช้าได้ไม่เกิน VISIBILITY_GENERATION_TTL วินาที)
+_visibility_index = {"generation": None, "series": frozenset(), "episodes": frozenset()}
+_visibility_index_lock = threading.Lock()
+
+
+def _get_visibility_index():
+    global _visibility_index
+    generation = get_visibility_generation()
+    index = _visibility_index
+    if index["generation"] == generation:
+        return index
+
+    with _visibility_index_lock:
+        if _visibility_index["generation"] == generation:
+            return _visibility_index
+        conn = get_db_connection()
+        hidden_series = frozenset(
+            r[0] for r in conn.execute("SELECT id FROM series WHERE is_active = 0")
+        )
+        hidden_episodes = frozenset(
+            r[0] for r in conn.execute("SELECT id FROM episodes WHERE is_active = 0")
+        )
+        conn.close()
+        _visibility_index = {
+            "generation": generation,
+            "series": hidden_series,
+            "episodes": hidden_episodes,
+        }
+        return _visibility_index
+
+
+def is_episode_visible(series_id, episode_id) -> bool:
+    """ตอนนี้ (และเรื่องของมัน) เปิดให้ดูอยู่หรือไม่ ตรวจจากดัชนีในหน่วยความจำ"""
+    index = _get_visibility_index()
+    return series_id not in index["series"] and episode_id not in index["episodes"]
+
+
+def _stream_token_key() -> bytes:
+    return hashlib.sha256(b"stream-token|" + str(app.config["SECRET_KEY"]).encode("utf-8")).digest()
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def make_stream_token(user_id, episode_id, abs_path: str, is_gdrive: bool) -> str:
+    payload = {
+        "u": user_id,
+        "e": episode_id,
+        "p": os.path.relpath(abs_path, BASE_DIR),
+        "d": 1 if is_gdrive else 0,
+        "x": int(time.time()) + STREAM_TOKEN_TTL,
+        "g": get_visibility_generation(),
+    }
+    body = _b64encode(json.dumps(payload, separators=(",", ":")).encode("utf-8"))
+    sig = hmac.new(_stream_token_key(), body.encode("ascii"), hashlib.sha256).digest()
+    return f"{body}.{_b64encode(sig)}"
+
+
+def verify_stream_token(token: str, user_id, episode_id):
+    """ตรวจ token โดยไม่แตะ DB (ยกเว้นอ่าน generation และแคตตาล็อกที่แคชไว้)
+    คืนค่า (path เต็ม, เป็นไฟล์ gdrive หรือไม่) หรือ None ถ้าใช้ไม่ได้"""
+    try:
+        body, sig = token.split(".", 1)
+        expected = hmac.new(_stream_token_key(), body.encode("ascii"), hashlib.sha256).digest()
+        if not hmac.compare_digest(expected, _b64decode(sig)):
+            return None
+        payload = json.loads(_b64decode(body))
+    except (ValueError, UnicodeError):
+        return None
+
+    if payload.get("u") != user_id or payload.get("e") != episode_id:
+        return None
+    if payload.get("x", 0) < time.time():
+        return None
+    if payload.get("g") != get_visibility_generation():
+        return None
+    path = payload.get("p") or ""
+    abs_path = path if os.path.isabs(path) else os.path.join(BASE_DIR, path)
+    # ไฟล์ของตอนถูกเปลี่ยนหลังออก token: ให้ไปหา path ใหม่ตามทางปกติ
+    episode = get_catalog().episode(episode_id)
+    current = episode["file_path"] if episode is not None else None
+    if not current:
+        return None
+    if not os.path.isabs(current):
+        current = os.path.join(BASE_DIR, current)
+    if os.path.abspath(current) != os.path.abspath(abs_path):
+        return None
+    return abs_path, bool(payload.get("d"))
 
 
-@app.route("/stream/<int:episode_id>")
-@user_login_required
-def stream_episode(episode_id):
-    conn = get_db_connection()
-    episode = conn.execute(
-        "SELECT * FROM episodes WHERE id = ?", (episode_id,)
-    ).fetchone()
+# ---------- ส่งไฟล์วิดีโอผ่าน front proxy (X-Accel-Redirect / X-Sendfile) ----------
+# VIDEO_OFFLOAD=nginx   -> ตอบ header X-Accel-Redirect ชี้ไป internal location เช่น
+#     location /_protected_videos/ { internal; alias /path/to/video_files/; }
+# VIDEO_OFFLOAD=sendfile -> ตอบ header X-Sendfile (Apache mod_xsendfile / lighttpd)
+# Python ตรวจสิทธิ์เสร็จแล้วคืน worker ทันที ส่วน proxy ส่งไฟล์แบบ zero-copy เอง
+VIDEO_OFFLOAD = os.getenv("VIDEO_OFFLOAD", "").strip().lower()
+VIDEO_ACCEL_PREFIX = "/" + os.getenv("VIDEO_ACCEL_PREFIX", "/_protected_videos/").strip("/") + "/"
 
-    series = None
-    if episode is not None:
-        series = conn.execute(
-            "SELECT * FROM series WHERE id = ?",
-            (episode["series_id"],),
-        ).fetchone()
 
-    conn.close()
+def video_offload_headers(abs_path: str):
+    """คืน header สำหรับให้ front proxy ส่งไฟล์แทน หรือ None ถ้าไม่ได้เปิดโหมดนี้
+    (หรือไฟล์อยู่นอก VIDEO_ROOT ซึ่ง internal location มองไม่เห็น)"""
+    if VIDEO_OFFLOAD not in ("nginx", "sendfile"):
+        return None
+    abs_path = os.path.abspath(abs_path)
+    rel = os.path.relpath(abs_path, os.path.abspath(VIDEO_ROOT))
+    if rel.startswith(os.pardir):
+        return None
+    if VIDEO_OFFLOAD == "nginx":
+        return {
+            "X-Accel-Redirect": VIDEO_ACCEL_PREFIX + quote(rel.replace(os.sep, "/")),
+            "Content-Type": "video/mp4",
+        }
+    try:
+        # header ต้องเป็น latin-1 ชื่อไฟล์ภาษาไทยจึงส่งเองผ่าน send_file แทน
+        abs_path.encode("latin-1")
+    except UnicodeEncodeError:
+        return None
+    return {"X-Sendfile": abs_path, "Content-Type": "video/mp4"}
 
-    if episode is None or series is None:
-        abort(404)
 
-    # ถ้าเรื่องหรืออตอนถูกปิด จะไม่ให้สตรีมวิดีโอ
-    series_active = 1
-    try:
-        if "is_active" in series.keys() and series["is_active"] is not None:
-            series_active = int(series["is_active"])
-    except Exception:
-        series_active = 1
+def resolve_episode_stream(episode_id):
+    """หาแหล่งไฟล์สำหรับสตรีมตอนนี้ (ใช้ร่วมกันระหว่าง Flask และโหมดสตรีม ASGI)
+    คืนค่า ("file", path เต็ม), ("proxy", video_url) หรือ ("error", HTTP status)"""
+    episode = get_catalog().episode(episode_id)
 
-    episode_active = 1
-    try:
-        if "is_active" in episode.keys() and episode["is_active"] is not None:
-            episode_active = int(episode["is_active"])
-    except Exception:
-        episode_active = 1
+    # ลบเรื่องแล้วตอนจะถูกลบตาม (ON DELETE CASCADE) มีตอนก็แปลว่ามีเรื่อง
+    if episode is None:
+        return "error", 404
 
-    if series_active == 0 or episode_active == 0:
-        abort(403)
+    # ถ้าเรื่องหรืออตอนถูกปิด จะไม่ให้สตรีมวิดีโอ
+    if not is_episode_visible(episode["series_id"], episode_id):
+        return "error", 403
 
     # ---------------------------
     # เตรียม path ของไฟล์วิดีโอ
@@ -503,6 +2608,13 @@ def stream_episode(episode_id):
     # และเป็นตอนแบบ Google Drive ให้ลองโหลดใหม่อัตโนมัติ
     # ---------------------------
     file_path = episode["file_path"]
+
+    # ตอนแบบลิงก์ตรง: ถ้าเปิดโหมดพร็อกซี ให้เสิร์ฟผ่านแคชของเรา
+    if not file_path and episode["source_type"] == "direct" and episode["video_url"]:
+        if not DIRECT_PROXY_ENABLED:
+            return "error", 404
+        return "proxy", episode["video_url"]
+
     if file_path and not os.path.isabs(file_path):
         abs_path = os.path.join(BASE_DIR, file_path)
     else:
@@ -524,25 +2636,597 @@ def stream_episode(episode_id):
         if source_type == "gdrive" and drive_id:
             try:
                 # ดาวน์โหลดไฟล์ใหม่
-                new_file = download_drive_file(drive_id, episode["series_id"])
+                new_file, size, digest = fetch_drive_file(
+                    drive_id,
+                    episode["series_id"],
+                    known_size=episode["file_size"],
+                    known_sha256=episode["file_sha256"],
+                    priority=DOWNLOAD_PRIORITY_VIEWER,
+                )
                 # เก็บ path แบบ relative ลง DB เพื่อใช้ครั้งต่อไป
                 rel_path = os.path.relpath(new_file, BASE_DIR)
                 conn2 = get_db_connection()
                 conn2.execute(
-                    "UPDATE episodes SET file_path = ? WHERE id = ?",
-                    (rel_path, episode["id"]),
+                    """
+                    UPDATE episodes SET file_path = ?, file_size = ?, file_sha256 = ?, download_state = NULL
+                    WHERE id = ?
+                    """,
+                    (rel_path, size, digest, episode["id"]),
                 )
                 conn2.commit()
                 conn2.close()
+                invalidate_catalog_version_cache()
                 abs_path = new_file
+                enforce_video_disk_budget(keep=new_file)
             except Exception:
-                abort(404)
+                return "error", 404
+        else:
+            return "error", 404
+
+    if episode["source_type"] == "gdrive":
+        touch_video_file(os.path.abspath(abs_path))
+
+    return "file", abs_path
+
+
+@app.route("/stream/<int:episode_id>")
+@user_login_required
+def stream_episode(episode_id):
+    # ทางลัด: token ที่ยังใช้ได้ ไม่ต้อง query DB เลย
+    token = request.args.get("t")
+    verified = verify_stream_token(token, session.get("user_id"), episode_id) if token else None
+    if verified is not None and os.path.exists(verified[0]):
+        abs_path, is_gdrive = verified
+        if is_gdrive:
+            touch_video_file(os.path.abspath(abs_path))
+        offload = video_offload_headers(abs_path)
+        if offload is not None:
+            return Response(status=200, headers=offload)
+        return send_file(abs_path, mimetype="video/mp4", as_attachment=False)
+
+    kind, value = resolve_episode_stream(episode_id)
+    if kind == "error":
+        abort(value)
+    if kind == "proxy":
+        return proxy_direct_response(value)
+
+    offload = video_offload_headers(value)
+    if offload is not None:
+        return Response(status=200, headers=offload)
+    return send_file(value, mimetype="video/mp4", as_attachment=False)
+
+
+
+
+# ---------- บีบอัด response (gzip / brotli / zstd) ----------
+# บีบอัดเฉพาะ response ที่เป็นข้อความและใหญ่กว่า COMPRESS_MIN_BYTES ไม่แตะไฟล์วิดีโอเด็ดขาด
+# brotli และ zstandard เป็นแพ็กเกจเสริม ถ้าไม่ได้ติดตั้งจะใช้ gzip อย่างเดียว
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESS_ENABLED = os.getenv("COMPRESS", "1") == "1"
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "500"))
+COMPRESS_MIMETYPES = {
+    "text/html",
+    "text/css",
+    "text/plain",
+    "text/javascript",
+    "application/javascript",
+    "application/json",
+    "application/xml",
+    "image/svg+xml",
+}
+# นามสกุลไฟล์ static ที่สร้าง .gz / .br เก็บไว้ล่วงหน้า
+PRECOMPRESS_EXTENSIONS = (".css", ".js", ".svg", ".json", ".txt", ".html")
+
+# ลำดับความชอบเมื่อ client รับได้หลายแบบ
+_ENCODING_SUFFIX = {"br": ".br", "zstd": ".zst", "gzip": ".gz"}
+
+
+def available_encodings():
+    encodings = []
+    if brotli is not None:
+        encodings.append("br")
+    if zstandard is not None:
+        encodings.append("zstd")
+    encodings.append("gzip")
+    return encodings
+
+
+def choose_encoding(candidates=None):
+    """เลือก encoding ที่ดีที่สุดที่ client ยอมรับ (q > 0) คืนค่า None ถ้าไม่มี"""
+    accept = request.accept_encodings
+    for enc in candidates or available_encodings():
+        if accept.quality(enc) > 0:
+            return enc
+    return None
+
+
+def etag_matches(etag: str) -> bool:
+    """เทียบ If-None-Match กับ etag รวมถึงแบบที่ถูกเติมชื่อ encoding ตอนบีบอัด"""
+    inm = request.if_none_match
+    if inm.contains(etag):
+        return True
+    return any(inm.contains(f"{etag}-{enc}") for enc in _ENCODING_SUFFIX)
+
+
+class _StreamEncoder:
+    """ตัวบีบอัดแบบทีละชิ้น ใช้ได้ทั้งกับ response ปกติและแบบ stream"""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == "br":
+            self._obj = brotli.Compressor(quality=5)
+        elif encoding == "zstd":
+            self._obj = zstandard.ZstdCompressor(level=3).compressobj()
         else:
-            abort(404)
+            self._obj = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        if self.encoding == "br":
+            return self._obj.process(data)
+        return self._obj.compress(data)
+
+    def flush(self) -> bytes:
+        # ดันข้อมูลที่ค้างในตัวบีบอัดออกไปโดยยังไม่ปิด stream
+        if self.encoding == "br":
+            return self._obj.flush()
+        if self.encoding == "zstd":
+            return self._obj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        return self._obj.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        if self.encoding == "br":
+            return self._obj.finish()
+        return self._obj.flush()
+
+
+def _compress_stream(iterable, encoder):
+    try:
+        for chunk in iterable:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            if not chunk:
+                continue
+            yield encoder.compress(chunk) + encoder.flush()
+        yield encoder.finish()
+    finally:
+        close = getattr(iterable, "close", None)
+        if close is not None:
+            close()
+
+
+@app.after_request
+def compress_response(response):
+    if not COMPRESS_ENABLED:
+        return response
+    if response.status_code != 200 or "Content-Encoding" in response.headers:
+        return response
+    if request.method == "HEAD" or "Range" in request.headers:
+        return response
+    if response.mimetype not in COMPRESS_MIMETYPES:
+        return response
+
+    response.vary.add("Accept-Encoding")
+    encoding = choose_encoding()
+    if encoding is None:
+        return response
+
+    encoder = _StreamEncoder(encoding)
+    if response.is_streamed:
+        # stream ยังเป็น stream: บีบอัดทีละชิ้นแล้ว flush ทันที
+        response.response = _compress_stream(response.response, encoder)
+        response.direct_passthrough = False
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_BYTES:
+            return response
+        response.set_data(encoder.compress(data) + encoder.finish())
+
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f"{etag}-{encoding}", weak=weak)
+    return response
+
+
+def build_precompressed_static(static_dir=None):
+    """สร้างไฟล์ .gz (และ .br ถ้ามี brotli) ข้างไฟล์ static ที่เป็นข้อความ
+    สร้างใหม่เฉพาะเมื่อไฟล์ต้นฉบับใหม่กว่า รันครั้งเดียวต่อการ deploy ด้วย flask compress-static
+    คืน (จำนวนไฟล์ที่สร้าง, จำนวนไฟล์ที่ผิดพลาด)"""
+    static_dir = static_dir or app.static_folder
+    built = failed = 0
+    for root, _dirs, files in os.walk(static_dir):
+        for name in files:
+            if not name.endswith(PRECOMPRESS_EXTENSIONS):
+                continue
+            src = os.path.join(root, name)
+            try:
+                src_mtime = os.path.getmtime(src)
+                with open(src, "rb") as f:
+                    raw = f.read()
+            except OSError as e:
+                app.logger.warning("compress-static: อ่าน %s ไม่ได้: %s", src, e)
+                failed += 1
+                continue
+            variants = [(".gz", lambda d: gzip.compress(d, compresslevel=9, mtime=0))]
+            if brotli is not None:
+                variants.append((".br", lambda d: brotli.compress(d, quality=11)))
+            for suffix, compress in variants:
+                dst = src + suffix
+                try:
+                    if os.path.exists(dst) and os.path.getmtime(dst) >= src_mtime:
+                        continue
+                    tmp = f"{dst}.{os.getpid()}.tmp"
+                    with open(tmp, "wb") as f:
+                        f.write(compress(raw))
+                    os.replace(tmp, dst)
+                    built += 1
+                except OSError as e:
+                    app.logger.warning("compress-static: เขียน %s ไม่ได้: %s", dst, e)
+                    failed += 1
+    return built, failed
+
+
+def _precompressed_is_fresh(compressed, source):
+    # ไฟล์ .gz/.br ที่เก่ากว่าต้นฉบับ (แก้ไฟล์แล้วยังไม่ได้รัน compress-static) ต้องไม่ถูกส่ง
+    try:
+        return os.path.getmtime(compressed) >= os.path.getmtime(source)
+    except OSError:
+        return False
+
+
+def precompressed_static(filename):
+    """แทน view static ของ Flask: ถ้ามีไฟล์ .br/.gz ที่สร้างไว้และ client รับได้ ให้ส่งไฟล์นั้นเลย"""
+    if COMPRESS_ENABLED and filename.endswith(PRECOMPRESS_EXTENSIONS) and "Range" not in request.headers:
+        candidates = ["br", "gzip"] if brotli is not None else ["gzip"]
+        for enc in candidates:
+            if request.accept_encodings.quality(enc) <= 0:
+                continue
+            compressed = safe_join(app.static_folder, filename + _ENCODING_SUFFIX[enc])
+            if compressed and _precompressed_is_fresh(compressed, safe_join(app.static_folder, filename)):
+                mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+                response = send_from_directory(
+                    app.static_folder,
+                    filename + _ENCODING_SUFFIX[enc],
+                    mimetype=mimetype,
+                    max_age=app.get_send_file_max_age(filename),
+                )
+                response.headers["Content-Encoding"] = enc
+                response.vary.add("Accept-Encoding")
+                return response
+    response = app.send_static_file(filename)
+    if filename.endswith(PRECOMPRESS_EXTENSIONS):
+        response.vary.add("Accept-Encoding")
+    return response
+
+
+app.view_functions["static"] = precompressed_static
+
+
+@app.cli.command("compress-static")
+def compress_static_command():
+    """สร้างไฟล์ .gz / .br ของไฟล์ static (รันครั้งเดียวต่อการ deploy ไม่ใช่ทุก worker)"""
+    built, failed = build_precompressed_static()
+    click.echo(f"สร้าง {built} ไฟล์")
+    if failed:
+        raise click.ClickException(f"ผิดพลาด {failed} ไฟล์ (ดูรายละเอียดใน log)")
+
+
+# ---------- JSON API สำหรับแอป (อ่านอย่างเดียว) ----------
+# ETag มาจากเลขเวอร์ชันแคตตาล็อกใน app_state และจำค่าไว้ในหน่วยความจำ CATALOG_VERSION_TTL วินาที
+# ไคลเอนต์ที่ poll ซ้ำจึงได้ 304 โดยไม่แตะ DB เลยเกือบทุกครั้ง
+CATALOG_VERSION_TTL = float(os.getenv("CATALOG_VERSION_TTL", "1.0"))
+API_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 200
+
+_catalog_version_cache = {"value": None, "updated_at": 0, "checked_at": 0.0}
+
+
+def get_catalog_state():
+    """คืนค่า (เวอร์ชันแคตตาล็อก, เวลาแก้ไขล่าสุดเป็นวินาที) อ่านจาก DB อย่างมากทุก CATALOG_VERSION_TTL"""
+    now = time.monotonic()
+    cached = _catalog_version_cache["value"]
+    if cached is not None and now - _catalog_version_cache["checked_at"] < CATALOG_VERSION_TTL:
+        return cached, _catalog_version_cache["updated_at"]
+
+    conn = get_db_connection()
+    rows = conn.execute(
+        "SELECT key, value FROM app_state WHERE key IN ('catalog_version', 'catalog_updated_at')"
+    ).fetchall()
+    conn.close()
+    state = {r["key"]: int(r["value"]) for r in rows}
+    version = state.get("catalog_version", 0)
+    _catalog_version_cache["value"] = version
+    _catalog_version_cache["updated_at"] = state.get("catalog_updated_at", 0)
+    _catalog_version_cache["checked_at"] = now
+    return version, _catalog_version_cache["updated_at"]
+
+
+def get_catalog_version() -> int:
+    return get_catalog_state()[0]
+
+
+def invalidate_catalog_version_cache():
+    _catalog_version_cache["value"] = None
+
+
+@app.after_request
+def _reset_catalog_version_after_admin_write(response):
+    # route แอดมินที่แก้ข้อมูลใน worker นี้: ให้คำขอถัดไปอ่านเวอร์ชันใหม่ทันที
+    if request.method == "POST" and (request.endpoint or "").startswith("admin_"):
+        invalidate_catalog_version_cache()
+        _visibility_generation_cache["value"] = None
+    return response
+
+
+def api_json(data, status=200, headers=None):
+    body = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+    return Response(body, status=status, mimetype="application/json", headers=headers)
+
+
+def catalog_api_response(build):
+    """ตอบ 304 ถ้า If-None-Match ตรงกับเวอร์ชันปัจจุบัน (ก่อนจะ query ใด ๆ)
+    ไม่อย่างนั้นเรียก build() เพื่อสร้างข้อมูลแล้วส่งพร้อม ETag"""
+    etag = f"catalog-{get_catalog_version()}"
+    headers = {"ETag": f'"{etag}"', "Cache-Control": "no-cache"}
+    if etag_matches(etag):
+        return Response(status=304, headers=headers)
+    data = build()
+    if data is None:
+        return api_json({"error": "not_found"}, status=404, headers=headers)
+    return api_json(data, headers=headers)
+
+
+# ---------- แคตตาล็อกในหน่วยความจำ (ใช้ร่วมกันทุก worker ผ่าน catalog_version) ----------
+# แต่ละ worker เก็บ series/episodes ทั้งหมดเป็น record แบบ __slots__ (เล็กกว่า sqlite3.Row + dict)
+# ทุกคำขอเทียบ catalog_version ใน app_state (แคช CATALOG_VERSION_TTL วินาที) ถ้าเปลี่ยน
+# จึงโหลดใหม่ครั้งเดียวตอนมีคนอ่านครั้งถัดไป trigger เพิ่มเวอร์ชันทุกครั้งที่ series/episodes เปลี่ยน
+# ทุก worker จึงเห็นข้อมูลเดียวกันโดยไม่ต้องมีช่องทางสื่อสารเพิ่ม
+# (ไม่ใช้ PRAGMA data_version เพราะค่านั้นเปลี่ยนทุกครั้งที่เขียน watch_history ด้วย)
+CATALOG_CACHE_ENABLED = os.getenv("CATALOG_CACHE", "1") == "1"
+
+
+class CatalogRecord:
+    """แถวของแคตตาล็อกแบบอ่านอย่างเดียว ใช้ได้ทั้ง row["title"] และ row.title เหมือน sqlite3.Row"""
+
+    __slots__ = ()
+    _columns = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            key = self._columns[key]
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise IndexError(f"No item with that key: {key}") from None
+
+    def keys(self):
+        return list(self._columns)
+
+    def __iter__(self):
+        return (getattr(self, c) for c in self._columns)
+
+    def __len__(self):
+        return len(self._columns)
+
+    def __repr__(self):
+        return f"<{type(self).__name__} id={getattr(self, 'id', None)}>"
+
+
+_record_classes = {}
+
+
+def _record_class(name, columns):
+    # คอลัมน์อาจเพิ่มขึ้นจาก ensure_* จึงสร้าง class ตามชุดคอลัมน์จริงของตาราง
+    key = (name, columns)
+    cls = _record_classes.get(key)
+    if cls is None:
+        cls = type(name, (CatalogRecord,), {"__slots__": columns, "_columns": columns})
+        _record_classes[key] = cls
+    return cls
+
+
+def _load_records(conn, name, sql):
+    cur = conn.execute(sql)
+    columns = tuple(d[0] for d in cur.description)
+    cls = _record_class(name, columns)
+    records = []
+    for values in cur:
+        rec = cls.__new__(cls)
+        for col, value in zip(columns, values):
+            object.__setattr__(rec, col, value)
+        records.append(rec)
+    return records
+
+
+class CatalogSnapshot:
+    """ภาพแคตตาล็อก ณ เวอร์ชันหนึ่ง ห้ามแก้ไขหลังสร้าง (แชร์ระหว่าง thread)"""
+
+    __slots__ = (
+        "version",
+        "series_by_id",
+        "series_by_id_order",
+        "series_ids",
+        "series_by_created",
+        "series_by_recent",
+        "episodes_by_id",
+        "episodes_by_series",
+    )
+
+    def __init__(self, conn, version):
+        self.version = version
+        series = _load_records(conn, "SeriesRecord", "SELECT * FROM series ORDER BY id")
+        self.series_by_id = {s.id: s for s in series}
+        self.series_by_id_order = tuple(series)
+        # id เรียงจากน้อยไปมาก (ตามลำดับ series_by_id_order) สำหรับ bisect ตอนแบ่งหน้า
+        self.series_ids = tuple(s.id for s in series)
+        # ใช้ ORDER BY ชุดเดียวกับที่หน้าเว็บเคยใช้ ลำดับจึงเหมือนเดิมทุกประการ
+        self.series_by_created = tuple(
+            self.series_by_id[r[0]]
+            for r in conn.execute("SELECT id FROM series ORDER BY datetime(created_at) DESC")
+        )
+        self.series_by_recent = tuple(
+            self.series_by_id[r[0]]
+            for r in conn.execute(
+                "SELECT id FROM series ORDER BY COALESCE(last_episode_at, created_at) DESC"
+            )
+        )
+        episodes = _load_records(
+            conn,
+            "EpisodeRecord",
+            """
+            SELECT * FROM episodes
+            ORDER BY series_id, episode_number IS NULL, episode_number, datetime(created_at)
+            """,
+        )
+        self.episodes_by_id = {e.id: e for e in episodes}
+        by_series = {}
+        for e in episodes:
+            by_series.setdefault(e.series_id, []).append(e)
+        self.episodes_by_series = {sid: tuple(eps) for sid, eps in by_series.items()}
+
+    def series(self, series_id):
+        return self.series_by_id.get(series_id)
+
+    def episode(self, episode_id):
+        return self.episodes_by_id.get(episode_id)
+
+    def episodes_of(self, series_id):
+        return self.episodes_by_series.get(series_id, ())
+
+    def series_after(self, after_id, limit):
+        start = bisect.bisect_right(self.series_ids, after_id)
+        return self.series_by_id_order[start:start + limit]
+
+
+_catalog_snapshot = None
+_catalog_snapshot_lock = threading.Lock()
+catalog_cache_metrics = {"rebuilds": 0, "last_rebuild_seconds": 0.0}
+
+
+def get_catalog() -> CatalogSnapshot:
+    """คืนแคตตาล็อกเวอร์ชันปัจจุบัน ภายในคำขอเดียวกันได้ snapshot เดิมเสมอ"""
+    if has_request_context() and "catalog" in g:
+        return g.catalog
+
+    global _catalog_snapshot
+    version = get_catalog_version()
+    snapshot = _catalog_snapshot
+    if snapshot is None or snapshot.version != version or not CATALOG_CACHE_ENABLED:
+        with _catalog_snapshot_lock:
+            snapshot = _catalog_snapshot
+            if snapshot is None or snapshot.version != version or not CATALOG_CACHE_ENABLED:
+                started = time.perf_counter()
+                conn = get_db_connection()
+                try:
+                    # อ่านเวอร์ชันกับข้อมูลใน transaction เดียว เวอร์ชันจึงตรงกับข้อมูลที่โหลด
+                    conn.execute("BEGIN")
+                    row = conn.execute(
+                        "SELECT value FROM app_state WHERE key = 'catalog_version'"
+                    ).fetchone()
+                    snapshot = CatalogSnapshot(conn, int(row["value"]) if row else 0)
+                finally:
+                    conn.rollback()
+                    conn.close()
+                _catalog_snapshot = snapshot
+                catalog_cache_metrics["rebuilds"] += 1
+                catalog_cache_metrics["last_rebuild_seconds"] = time.perf_counter() - started
+                if snapshot.version != version:
+                    _catalog_version_cache["value"] = snapshot.version
+
+    if has_request_context():
+        g.catalog = snapshot
+    return snapshot
+
+
+def _api_series_dict(row):
+    return {
+        "id": row["id"],
+        "title": row["title"],
+        "description": row["description"],
+        "thumbnail_url": row["thumbnail_url"],
+        "created_at": row["created_at"],
+        "is_active": int(row["is_active"]) if row["is_active"] is not None else 1,
+        "episode_count": row["episode_count"],
+        "active_episode_count": row["active_episode_count"],
+        "last_episode_at": row["last_episode_at"],
+    }
+
+
+def _api_episode_dict(row):
+    return {
+        "id": row["id"],
+        "title": row["title"],
+        "description": row["description"],
+        "episode_number": row["episode_number"],
+        "thumbnail_url": row["thumbnail_url"],
+        "created_at": row["created_at"],
+        "is_active": int(row["is_active"]) if row["is_active"] is not None else 1,
+    }
+
+
+def _api_limit() -> int:
+    limit = request.args.get("limit", type=int) or API_PAGE_SIZE
+    return max(1, min(limit, API_MAX_PAGE_SIZE))
+
+
+@app.route("/api/v1/series")
+def api_series_list():
+    # แบ่งหน้าแบบ keyset: ?after=<id สุดท้ายของหน้าก่อน>
+    def build():
+        after = request.args.get("after", type=int) or 0
+        limit = _api_limit()
+        rows = get_catalog().series_after(after, limit + 1)
+        items = [_api_series_dict(r) for r in rows[:limit]]
+        next_after = items[-1]["id"] if len(rows) > limit else None
+        return {"items": items, "next_after": next_after}
+
+    return catalog_api_response(build)
+
+
+@app.route("/api/v1/series/<int:series_id>")
+def api_series_detail(series_id):
+    def build():
+        catalog = get_catalog()
+        series = catalog.series(series_id)
+        if series is None:
+            return None
+        data = _api_series_dict(series)
+        data["episodes"] = [_api_episode_dict(e) for e in catalog.episodes_of(series_id)]
+        return data
+
+    return catalog_api_response(build)
 
-    return send_file(abs_path, mimetype="video/mp4", as_attachment=False)
 
+@app.route("/api/v1/search")
+def api_search():
+    query = request.args.get("q", "").strip()
+    if not query:
+        return api_json({"error": "missing_query"}, status=400)
 
+    def build():
+        offset = request.args.get("offset", type=int) or 0
+        limit = _api_limit()
+        main_keyword, ranked = rank_series(get_catalog().series_by_id_order, query)
+        page = ranked[offset:offset + limit]
+        next_offset = offset + limit if offset + limit < len(ranked) else None
+        return {
+            "query": query,
+            "main_keyword": main_keyword,
+            "items": [_api_series_dict(r) for r in page],
+            "next_offset": next_offset,
+        }
+
+    return catalog_api_response(build)
 
 
 # ------------- ระบบผู้ใช้ทั่วไป: สมัคร, ล็อกอิน, เปลี่ยนรหัส, ประวัติการดู -------------
@@ -568,9 +3252,14 @@ def user_register():
         elif password != password_confirm:
             flash("รหัสผ่านใหม่และยืนยันรหัสผ่านไม่ตรงกัน", "error")
         else:
+            try:
+                hashed = hash_password(password)
+            except PasswordHasherBusy:
+                flash(PASSWORD_BUSY_MESSAGE, "error")
+                return render_template("user_register.html"), 503
+
             conn = get_db_connection()
             try:
-                hashed = generate_password_hash(password)
                 user_key = generate_user_key()
                 conn.execute(
                     "INSERT INTO users (username, password, plain_password, user_key, created_at) VALUES (?, ?, ?, ?, ?)",
@@ -612,9 +3301,31 @@ def user_login():
 
         if user is None:
             flash("ไม่พบบัญชีผู้ใช้นี้", "error")
-        elif not check_password_hash(user["password"], password):
+            return render_template("user_login.html")
+
+        try:
+            password_ok = verify_password(user["password"], password)
+        except PasswordHasherBusy:
+            flash(PASSWORD_BUSY_MESSAGE, "error")
+            return render_template("user_login.html"), 503
+
+        if not password_ok:
             flash("รหัสผ่านไม่ถูกต้อง", "error")
         else:
+            # แฮชเดิมใช้พารามิเตอร์เก่า: แฮชใหม่ตามค่าปัจจุบันตอนที่รู้รหัสผ่านจริง
+            if password_needs_rehash(user["password"]):
+                try:
+                    new_hash = hash_password(password)
+                    conn = get_db_connection()
+                    conn.execute(
+                        "UPDATE users SET password = ? WHERE id = ?",
+                        (new_hash, user["id"]),
+                    )
+                    conn.commit()
+                    conn.close()
+                    _count_password_metric("rehashed")
+                except PasswordHasherBusy:
+                    pass
             login_user(user)
             flash("เข้าสู่ระบบสำเร็จ", "success")
             return redirect(next_url)
@@ -646,15 +3357,25 @@ def user_account():
 
             if not current_password or not new_password or not confirm_password:
                 flash("กรุณากรอกข้อมูลให้ครบ", "error")
-            elif not check_password_hash(user["password"], current_password):
-                flash("รหัสผ่านเดิมไม่ถูกต้อง", "error")
-            elif new_password != confirm_password:
+                return render_template("user_account.html", user=user)
+            if new_password != confirm_password:
                 flash("รหัสผ่านใหม่และยืนยันรหัสผ่านไม่ตรงกัน", "error")
+                return render_template("user_account.html", user=user)
+
+            try:
+                current_ok = verify_password(user["password"], current_password)
+                new_hash = hash_password(new_password) if current_ok else None
+            except PasswordHasherBusy:
+                flash(PASSWORD_BUSY_MESSAGE, "error")
+                return render_template("user_account.html", user=user), 503
+
+            if not current_ok:
+                flash("รหัสผ่านเดิมไม่ถูกต้อง", "error")
             else:
                 conn = get_db_connection()
                 conn.execute(
                     "UPDATE users SET password = ?, plain_password = ? WHERE id = ?",
-                    (generate_password_hash(new_password), new_password, user["id"]),
+                    (new_hash, new_password, user["id"]),
                 )
                 conn.commit()
                 conn.close()
@@ -685,22 +3406,66 @@ def my_page():
     if user is None:
         return redirect(url_for("user_login"))
 
+    # "ดูต่อ" อ่านจากตารางสรุป (หนึ่งแถวต่อเรื่อง) แทนการไล่ watch_history ทั้งหมด
     conn = get_db_connection()
-    history = conn.execute(
+    continue_list = conn.execute(
         """
+        SELECT r.series_id, r.last_episode_id AS episode_id, r.last_watched_at, r.view_count,
+               s.title AS series_title, e.title AS episode_title, e.episode_number
+        FROM series_watch_rollup r
+        JOIN series s ON s.id = r.series_id
+        LEFT JOIN episodes e ON e.id = r.last_episode_id
+        WHERE r.user_id = ?
+        ORDER BY r.last_watched_at DESC
+        LIMIT 50
+        """,
+        (user["id"],),
+    ).fetchall()
+    conn.close()
+
+    return render_template("my_page.html", user=user, continue_list=continue_list)
+
+
+HISTORY_PAGE_SIZE = 50
+ADMIN_HISTORY_LIMIT = int(os.getenv("ADMIN_HISTORY_LIMIT", "200"))
+
+
+@app.route("/me/history")
+@user_login_required
+def my_history():
+    user = get_current_user()
+    if user is None:
+        return redirect(url_for("user_login"))
+
+    # แบ่งหน้าด้วย id (เรียงตามเวลาที่บันทึกอยู่แล้ว) ไม่ต้องใช้ OFFSET
+    before = request.args.get("before", type=int)
+    params = [user["id"]]
+    where = "wh.user_id = ?"
+    if before:
+        where += " AND wh.id < ?"
+        params.append(before)
+
+    conn = get_db_connection()
+    rows = conn.execute(
+        f"""
         SELECT wh.*, s.title AS series_title, e.title AS episode_title, e.episode_number
         FROM watch_history wh
         JOIN series s ON s.id = wh.series_id
         JOIN episodes e ON e.id = wh.episode_id
-        WHERE wh.user_id = ?
-        ORDER BY datetime(wh.watched_at) DESC
-        LIMIT 50
+        WHERE {where}
+        ORDER BY wh.id DESC
+        LIMIT ?
         """,
-        (user["id"],),
+        (*params, HISTORY_PAGE_SIZE + 1),
     ).fetchall()
     conn.close()
 
-    return render_template("my_page.html", user=user, history=history)
+    history = rows[:HISTORY_PAGE_SIZE]
+    next_before = history[-1]["id"] if len(rows) > HISTORY_PAGE_SIZE else None
+
+    return render_template(
+        "my_history.html", user=user, history=history, next_before=next_before
+    )
 
 
 @app.route("/admin/login", methods=["GET", "POST"])
@@ -762,6 +3527,38 @@ def admin_account():
     )
 
 
+@app.route("/admin/metrics")
+def admin_metrics():
+    """ค่าสถิติภายในของ worker นี้ (JSON) สำหรับดูภาระงาน"""
+    if not admin_required():
+        return redirect(url_for("admin_login"))
+
+    with _password_metrics_lock:
+        hashing = dict(password_metrics)
+    jobs = hashing["jobs"]
+    data = {
+        "pid": os.getpid(),
+        "password_hashing": dict(
+            hashing,
+            queue_limit=PASSWORD_QUEUE_LIMIT,
+            pool_workers=PASSWORD_POOL_WORKERS,
+            avg_seconds=(hashing["total_seconds"] / jobs) if jobs else 0.0,
+        ),
+        "rate_limit": {
+            "enabled": RATE_LIMIT_ENABLED,
+            "backend": RATE_LIMIT_BACKEND,
+            "rejections": dict(rate_limit_rejections),
+        },
+        "catalog_cache": dict(
+            catalog_cache_metrics,
+            enabled=CATALOG_CACHE_ENABLED,
+            version=_catalog_snapshot.version if _catalog_snapshot else None,
+        ),
+        "downloads": download_scheduler.snapshot(),
+    }
+    return api_json(data)
+
+
 @app.route("/admin/users")
 def admin_users():
     if not admin_required():
@@ -807,7 +3604,7 @@ def admin_user_detail(user_id):
             else:
                 try:
                     if new_password:
-                        hashed = generate_password_hash(new_password)
+                        hashed = hash_password(new_password)
                         conn.execute(
                             "UPDATE users SET username = ?, password = ?, plain_password = ? WHERE id = ?",
                             (new_username, hashed, new_password, user_id),
@@ -821,6 +3618,8 @@ def admin_user_detail(user_id):
                     flash("อัปเดตบัญชีผู้ใช้เรียบร้อยแล้ว", "success")
                 except sqlite3.IntegrityError:
                     flash("ชื่อผู้ใช้นี้มีอยู่ในระบบแล้ว", "error")
+                except PasswordHasherBusy:
+                    flash(PASSWORD_BUSY_MESSAGE, "error")
 
         elif action == "reset_key":
             new_key = generate_user_key()
@@ -841,6 +3640,7 @@ def admin_user_detail(user_id):
         elif action == "clear_history_all":
             # ลบประวัติการดูทั้งหมดของผู้ใช้นี้
             conn.execute("DELETE FROM watch_history WHERE user_id = ?", (user_id,))
+            conn.execute("DELETE FROM series_watch_rollup WHERE user_id = ?", (user_id,))
             conn.commit()
             flash("ลบประวัติการดูทั้งหมดของผู้ใช้นี้เรียบร้อยแล้ว", "success")
 
@@ -852,6 +3652,7 @@ def admin_user_detail(user_id):
                     "DELETE FROM watch_history WHERE id = ? AND user_id = ?",
                     (history_id, user_id),
                 )
+                rebuild_watch_rollup(conn, user_id)
                 conn.commit()
                 flash("ลบประวัติการดูตอนนี้เรียบร้อยแล้ว", "success")
 
@@ -863,12 +3664,17 @@ def admin_user_detail(user_id):
                     "DELETE FROM watch_history WHERE user_id = ? AND series_id = ?",
                     (user_id, series_id),
                 )
+                conn.execute(
+                    "DELETE FROM series_watch_rollup WHERE user_id = ? AND series_id = ?",
+                    (user_id, series_id),
+                )
                 conn.commit()
                 flash("ลบประวัติการดูทั้งหมดของเรื่องนี้เรียบร้อยแล้ว", "success")
 
         # โหลดข้อมูล user ใหม่ล่าสุดหลังอัปเดต
         user = conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
 
+    # แสดงเฉพาะ ADMIN_HISTORY_LIMIT รายการล่าสุด (ใช้ index user_id, id)
     history = conn.execute(
         """
         SELECT wh.*, s.title AS series_title, e.title AS episode_title, e.episode_number
@@ -876,14 +3682,20 @@ def admin_user_detail(user_id):
         JOIN series s ON s.id = wh.series_id
         JOIN episodes e ON e.id = wh.episode_id
         WHERE wh.user_id = ?
-        ORDER BY datetime(wh.watched_at) DESC
+        ORDER BY wh.id DESC
+        LIMIT ?
         """
         ,
-        (user_id,),
+        (user_id, ADMIN_HISTORY_LIMIT),
     ).fetchall()
+    history_total = conn.execute(
+        "SELECT COUNT(*) FROM watch_history WHERE user_id = ?", (user_id,)
+    ).fetchone()[0]
     conn.close()
 
-    return render_template("admin_user_detail.html", user=user, history=history)
+    return render_template(
+        "admin_user_detail.html", user=user, history=history, history_total=history_total
+    )
 @app.route("/admin/series", methods=["GET", "POST"])
 def admin_series():
     if not admin_required():
@@ -1068,6 +3880,48 @@ def admin_edit_series(series_id):
     return render_template("admin_edit_series.html", series=series)
 
 
+def remove_episode_files(file_path, thumb=None):
+    """ลบไฟล์วิดีโอ และไฟล์ปกตอน (ถ้าเป็นไฟล์ใน static) ของตอนหนึ่ง"""
+    if file_path:
+        if not os.path.isabs(file_path):
+            fp_full = os.path.join(BASE_DIR, file_path)
+        else:
+            fp_full = file_path
+        try:
+            if os.path.exists(fp_full):
+                os.remove(fp_full)
+        except Exception:
+            pass
+
+    # ลบไฟล์ปกตอนถ้าเป็นไฟล์ใน static
+    if thumb and not str(thumb).startswith("http"):
+        thumb_full = os.path.join(BASE_DIR, "static", thumb)
+        try:
+            if os.path.exists(thumb_full):
+                os.remove(thumb_full)
+            # ลบโฟลเดอร์เปล่า ep_... ด้วย
+            ep_dir = os.path.dirname(thumb_full)
+            if os.path.isdir(ep_dir) and not os.listdir(ep_dir):
+                os.rmdir(ep_dir)
+        except Exception:
+            pass
+
+
+def remove_series_dirs(series_id):
+    """ลบโฟลเดอร์วิดีโอและโฟลเดอร์ปกของเรื่อง"""
+    import shutil
+
+    for path in (
+        os.path.join(VIDEO_ROOT, f"series_{series_id}"),
+        os.path.join(COVER_ROOT, f"series_{series_id}"),
+    ):
+        if os.path.isdir(path):
+            try:
+                shutil.rmtree(path)
+            except Exception:
+                pass
+
+
 @app.route("/admin/series/<int:series_id>/delete", methods=["POST"])
 def admin_delete_series(series_id):
     if not admin_required():
@@ -1079,40 +3933,316 @@ def admin_delete_series(series_id):
     ).fetchall()
 
     for ep in episodes:
-        fp = ep["file_path"]
-        if fp:
-            if not os.path.isabs(fp):
-                fp_full = os.path.join(BASE_DIR, fp)
+        remove_episode_files(ep["file_path"])
+
+    conn.execute("DELETE FROM series WHERE id = ?", (series_id,))
+    conn.commit()
+    conn.close()
+
+    remove_series_dirs(series_id)
+
+    flash("ลบเรื่องและตอนทั้งหมดเรียบร้อยแล้ว", "success")
+    return redirect(url_for("admin_series"))
+
+
+# ---------- นำเข้าตอนทีละหลายตอนจาก manifest (CSV / JSON) ----------
+# แต่ละแถว: episode_number, title, description, drive (ลิงก์หรือ FILE_ID), video_url, thumbnail_url
+# เพิ่มทุกแถวลง DB ใน transaction เดียว (ตอน Drive มี download_state='pending') แล้วตอบกลับทันที
+# ไฟล์ Drive และรูปปกโหลดต่อในคิวเบื้องหลัง (BULK_IMPORT_WORKERS thread ผ่าน download_scheduler)
+# คำขอของแอดมินจึงไม่ค้างจน worker timeout แม้ทั้งซีซันจะใหญ่
+BULK_IMPORT_WORKERS = int(os.getenv("BULK_IMPORT_WORKERS", "4"))
+BULK_IMPORT_MAX_ROWS = int(os.getenv("BULK_IMPORT_MAX_ROWS", "500"))
+COVER_FETCH_MAX_BYTES = int(os.getenv("COVER_FETCH_MAX_MB", "10")) * 1024 * 1024
+
+# ชื่อคอลัมน์ที่ยอมรับ -> ชื่อฟิลด์มาตรฐาน
+_MANIFEST_ALIASES = {
+    "episode_number": "episode_number",
+    "episode": "episode_number",
+    "ep": "episode_number",
+    "title": "title",
+    "description": "description",
+    "drive": "drive",
+    "drive_link": "drive",
+    "drive_id": "drive",
+    "video_url": "video_url",
+    "url": "video_url",
+    "thumbnail_url": "thumbnail_url",
+    "cover_url": "thumbnail_url",
+    "cover": "thumbnail_url",
+}
+
+
+def parse_episode_manifest(text: str, filename: str = ""):
+    """แปลง manifest เป็นรายการ dict ของตอน เดารูปแบบจากนามสกุลหรือตัวอักษรแรก"""
+    text = text.lstrip("\ufeff")
+    if filename.lower().endswith(".json") or text.lstrip()[:1] in ("[", "{"):
+        data = json.loads(text)
+        if isinstance(data, dict):
+            data = data.get("episodes", [])
+        if not isinstance(data, list):
+            raise ValueError("manifest JSON ต้องเป็นรายการของตอน")
+        raw_rows = data
+    else:
+        raw_rows = list(csv.DictReader(StringIO(text)))
+
+    if len(raw_rows) > BULK_IMPORT_MAX_ROWS:
+        raise ValueError(f"manifest มีได้ไม่เกิน {BULK_IMPORT_MAX_ROWS} แถว")
+
+    items = []
+    for row in raw_rows:
+        if not isinstance(row, dict):
+            raise ValueError("แต่ละแถวของ manifest ต้องเป็น object")
+        item = {}
+        for key, value in row.items():
+            field = _MANIFEST_ALIASES.get((key or "").strip().lower())
+            if field and value is not None:
+                item[field] = str(value).strip()
+        items.append(item)
+    return items
+
+
+def _fetch_episode_cover(episode_id: int, url: str) -> str:
+    """โหลดรูปปกจาก URL มาเก็บในเครื่อง คืน path สำหรับ thumbnail_url"""
+    with requests.get(url, stream=True, timeout=(5, 30)) as r:
+        r.raise_for_status()
+        ext = os.path.splitext(urlparse(url).path)[1].lower()
+        if ext not in (".jpg", ".jpeg", ".png", ".webp", ".gif"):
+            ext = mimetypes.guess_extension((r.headers.get("Content-Type") or "").split(";")[0].strip()) or ".jpg"
+
+        ep_dir = os.path.join(EPISODE_COVER_ROOT, f"ep_{episode_id}")
+        os.makedirs(ep_dir, exist_ok=True)
+        safe_name = f"ep_{episode_id}_{int(datetime.utcnow().timestamp())}{ext}"
+        save_path = os.path.join(ep_dir, safe_name)
+        size = 0
+        try:
+            with open(save_path, "wb") as f:
+                for chunk in r.iter_content(64 * 1024):
+                    size += len(chunk)
+                    if size > COVER_FETCH_MAX_BYTES:
+                        raise RuntimeError("รูปปกใหญ่เกินกำหนด")
+                    f.write(chunk)
+        except Exception:
+            try:
+                os.remove(save_path)
+            except OSError:
+                pass
+            raise
+    return f"covers/episodes/ep_{episode_id}/{safe_name}"
+
+
+def _ingest_cover(conn, episode_id: int, url: str) -> str:
+    """โหลดรูปปกของตอนเดียวแล้วเขียน thumbnail_url คืนสถานะสำหรับรายงาน"""
+    try:
+        local = _fetch_episode_cover(episode_id, url)
+    except Exception:
+        # โหลดไม่ได้ก็ใช้ลิงก์เดิมเป็นปกเหมือนฟอร์มเพิ่มตอนปกติ (แถวเก็บลิงก์ไว้ตั้งแต่ตอนเพิ่ม)
+        return "linked"
+    conn.execute("UPDATE episodes SET thumbnail_url = ? WHERE id = ?", (local, episode_id))
+    conn.commit()
+    return "downloaded"
+
+
+def _ingest_episode_files(series_id: int, job: dict, keep: set, keep_lock) -> dict:
+    """งานในคิวนำเข้า: โหลดรูปปกและไฟล์ Drive ของตอนเดียว แล้วอัปเดตแถวทีละตอน
+    keep คือไฟล์ที่การนำเข้าครั้งนี้โหลดมาแล้ว (ห้ามให้งบดิสก์ลบระหว่างนำเข้า)"""
+    status = {"episode_id": job["episode_id"], "video": None, "cover": None, "error": None}
+    conn = get_db_connection()
+    try:
+        if job["thumbnail_url"]:
+            status["cover"] = _ingest_cover(conn, job["episode_id"], job["thumbnail_url"])
+        if job["drive_id"]:
+            try:
+                # นำเข้าเป็นกลุ่มเป็นงานเบื้องหลัง ให้คนดูและฟอร์มแอดมินได้ connection ก่อน
+                file_real, size, digest = fetch_drive_file(
+                    job["drive_id"], series_id, priority=DOWNLOAD_PRIORITY_PREFETCH
+                )
+            except Exception as e:
+                app.logger.warning("นำเข้าตอน %s: โหลดไฟล์ Drive ไม่สำเร็จ: %s", job["episode_id"], e)
+                conn.execute("UPDATE episodes SET download_state = 'failed' WHERE id = ?", (job["episode_id"],))
+                conn.commit()
+                status.update(video="failed", error=str(e))
+            else:
+                conn.execute(
+                    """
+                    UPDATE episodes SET file_path = ?, file_size = ?, file_sha256 = ?, download_state = NULL
+                    WHERE id = ?
+                    """,
+                    (os.path.relpath(file_real, BASE_DIR), size, digest, job["episode_id"]),
+                )
+                conn.commit()
+                status["video"] = "downloaded"
+                with keep_lock:
+                    keep.add(file_real)
+                    protected = set(keep)
+                enforce_video_disk_budget(keep=protected)
+    finally:
+        conn.close()
+    return status
+
+
+_import_download_pool = ThreadPoolExecutor(max_workers=BULK_IMPORT_WORKERS, thread_name_prefix="episode-import")
+
+
+def queue_manifest_downloads(series_id: int, jobs, executor=None):
+    """ส่งงานโหลดไฟล์ / รูปปกของตอนที่เพิ่มแล้วเข้าคิว คืนรายการ future (ผลของแต่ละงานเป็น dict สถานะ)
+    แต่ละไฟล์ Drive ยังต้องรอ slot จาก download_scheduler ที่ระดับ prefetch เหมือนงานเบื้องหลังอื่น"""
+    keep = set()
+    keep_lock = threading.Lock()
+    executor = executor or _import_download_pool
+    return [executor.submit(_ingest_episode_files, series_id, job, keep, keep_lock) for job in jobs]
+
+
+def import_episode_manifest(series_id: int, items, executor=None, wait=False):
+    """เพิ่มตอนจาก manifest ที่แปลงแล้วทั้งหมดใน transaction เดียว คืนรายการสถานะทีละแถว
+    status: ok / error / skipped (แถวที่เลขตอนมีอยู่แล้วจะข้าม จึงรันซ้ำได้หลังแก้แถวที่พัง)
+    ตอนแบบ Google Drive ถูกเพิ่มพร้อม download_state='pending' แล้วโหลดไฟล์ในคิวเบื้องหลัง
+    (ระหว่างนั้นคนดูเปิดตอนได้ ไฟล์จะถูกโหลดทันทีด้วย priority ของคนดู)
+    รันซ้ำจะส่งตอน Drive ที่ยัง pending / failed เข้าคิวอีกครั้ง
+    wait=True รอจนโหลดครบแล้วใส่ผลลงรายงาน (ใช้กับคำสั่ง CLI)"""
+    results = []
+    jobs = []
+
+    conn = get_db_connection()
+    try:
+        existing = {
+            r["episode_number"]: r
+            for r in conn.execute(
+                """
+                SELECT id, episode_number, drive_id, download_state FROM episodes
+                WHERE series_id = ? AND episode_number IS NOT NULL
+                """,
+                (series_id,),
+            )
+        }
+        now = datetime.utcnow().isoformat()
+        for row_no, item in enumerate(items, start=1):
+            title = item.get("title", "")
+            number_raw = item.get("episode_number", "")
+            episode_number = int(number_raw) if number_raw.isdigit() else None
+            result = {
+                "row": row_no,
+                "episode_number": episode_number,
+                "title": title,
+                "status": "ok",
+                "episode_id": None,
+                "video": None,
+                "cover": None,
+                "error": None,
+            }
+            results.append(result)
+
+            if not title:
+                result.update(status="error", error="ไม่มีชื่อตอน")
+                continue
+            if episode_number is not None and episode_number in existing:
+                result["status"] = "skipped"
+                row = existing[episode_number]
+                if row is not None and row["drive_id"] and row["download_state"] in ("pending", "failed"):
+                    # ตอนที่เคยนำเข้าแต่ไฟล์ยังไม่มา: ส่งเข้าคิวใหม่
+                    result.update(episode_id=row["id"], video="queued")
+                    jobs.append(
+                        {"episode_id": row["id"], "drive_id": row["drive_id"], "thumbnail_url": None, "result": result}
+                    )
+                continue
+
+            drive_text = item.get("drive", "")
+            video_url = item.get("video_url", "")
+            if not drive_text and "drive.google.com" in video_url:
+                drive_text, video_url = video_url, ""
+            if drive_text:
+                drive_id = extract_drive_id(drive_text)
+                if not drive_id:
+                    result.update(status="error", error="ไม่สามารถดึง Drive ID จากลิงก์ได้")
+                    continue
+                source_type, video_url, state = "gdrive", None, "pending"
+                result["video"] = "queued"
+            elif video_url:
+                drive_id, source_type, state = None, "direct", None
+                result["video"] = "linked"
             else:
-                fp_full = fp
-            try:
-                if os.path.exists(fp_full):
-                    os.remove(fp_full)
-            except Exception:
-                pass
+                result.update(status="error", error="ไม่มีลิงก์วิดีโอหรือลิงก์ Google Drive")
+                continue
 
-    conn.execute("DELETE FROM series WHERE id = ?", (series_id,))
-    conn.commit()
-    conn.close()
+            thumbnail_url = item.get("thumbnail_url") or None
+            cur = conn.execute(
+                """
+                INSERT INTO episodes (
+                    series_id, title, description, episode_number,
+                    source_type, video_url, drive_id, thumbnail_url, download_state, created_at
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    series_id,
+                    title,
+                    item.get("description", ""),
+                    episode_number,
+                    source_type,
+                    video_url,
+                    drive_id,
+                    thumbnail_url,
+                    state,
+                    now,
+                ),
+            )
+            result["episode_id"] = cur.lastrowid
+            if episode_number is not None:
+                existing[episode_number] = None
+            if thumbnail_url:
+                result["cover"] = "queued"
+            if drive_id or thumbnail_url:
+                jobs.append(
+                    {"episode_id": cur.lastrowid, "drive_id": drive_id, "thumbnail_url": thumbnail_url, "result": result}
+                )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
 
-    series_dir = os.path.join(VIDEO_ROOT, f"series_{series_id}")
-    if os.path.isdir(series_dir):
-        try:
-            import shutil
-            shutil.rmtree(series_dir)
-        except Exception:
-            pass
+    futures = queue_manifest_downloads(series_id, jobs, executor=executor)
+    if wait:
+        for job, future in zip(jobs, futures):
+            done = future.result()
+            result = job["result"]
+            result["video"] = done["video"] or result["video"]
+            result["cover"] = done["cover"] or result["cover"]
+            if done["error"]:
+                result.update(status="error", error=done["error"])
+    return results
+
+
+@app.cli.command("import-episodes")
+@click.argument("series_id", type=int)
+@click.argument("manifest", type=click.Path(exists=True, dir_okay=False))
+@click.option("--workers", type=int, default=None, help="จำนวนงานโหลดพร้อมกัน")
+def import_episodes_command(series_id, manifest, workers):
+    """นำเข้าตอนของเรื่อง SERIES_ID จากไฟล์ manifest (.csv หรือ .json)"""
+    conn = get_db_connection()
+    series = conn.execute("SELECT id FROM series WHERE id = ?", (series_id,)).fetchone()
+    conn.close()
+    if series is None:
+        raise click.ClickException("ไม่พบเรื่องนี้")
 
-    cover_dir = os.path.join(COVER_ROOT, f"series_{series_id}")
-    if os.path.isdir(cover_dir):
+    with open(manifest, encoding="utf-8") as f:
         try:
-            import shutil
-            shutil.rmtree(cover_dir)
-        except Exception:
-            pass
-
-    flash("ลบเรื่องและตอนทั้งหมดเรียบร้อยแล้ว", "success")
-    return redirect(url_for("admin_series"))
+            items = parse_episode_manifest(f.read(), manifest)
+        except ValueError as e:
+            raise click.ClickException(f"อ่าน manifest ไม่ได้: {e}")
+
+    # CLI รอจนโหลดครบ ใช้ pool ของตัวเองตามจำนวน --workers
+    with ThreadPoolExecutor(max_workers=max(1, workers or BULK_IMPORT_WORKERS)) as pool:
+        results = import_episode_manifest(series_id, items, executor=pool, wait=True)
+    for r in results:
+        line = f"[{r['status']}] แถว {r['row']}: {r['title']}"
+        if r["episode_id"]:
+            line += f" (id {r['episode_id']})"
+        if r["error"]:
+            line += f" - {r['error']}"
+        click.echo(line)
+    ok = sum(1 for r in results if r["status"] == "ok")
+    click.echo(f"สำเร็จ {ok} จาก {len(results)} แถว")
 
 
 @app.route("/admin/series/<int:series_id>/episodes", methods=["GET", "POST"])
@@ -1147,6 +4277,8 @@ def admin_episodes(series_id):
         video_url = None
         drive_id = None
         file_path = None
+        file_size = None
+        file_sha256 = None
 
         if mode == "direct":
             video_url = request.form.get("video_url", "").strip()
@@ -1163,7 +4295,7 @@ def admin_episodes(series_id):
                 return redirect(url_for("admin_episodes", series_id=series_id))
 
             try:
-                file_real = download_drive_file(drive_id, series_id)
+                file_real, file_size, file_sha256 = fetch_drive_file(drive_id, series_id)
             except Exception as e:
                 flash(str(e), "error")
                 return redirect(url_for("admin_episodes", series_id=series_id))
@@ -1171,6 +4303,7 @@ def admin_episodes(series_id):
             rel_path = os.path.relpath(file_real, BASE_DIR)
             file_path = rel_path
             source_type = "gdrive"
+            enforce_video_disk_budget(keep=file_real)
 
         elif mode == "upload":
             file = request.files.get("file")
@@ -1204,9 +4337,9 @@ def admin_episodes(series_id):
             INSERT INTO episodes (
                 id, series_id, title, description, episode_number,
                 source_type, video_url, drive_id, file_path,
-                thumbnail_url, created_at
+                file_size, file_sha256, thumbnail_url, created_at
             )
-            VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             """,
             (
                 series_id,
@@ -1217,6 +4350,8 @@ def admin_episodes(series_id):
                 video_url,
                 drive_id,
                 file_path,
+                file_size,
+                file_sha256,
                 None,
                 datetime.utcnow().isoformat(),
             ),
@@ -1270,6 +4405,63 @@ def admin_episodes(series_id):
 
 
 
+@app.route("/admin/series/<int:series_id>/episodes/import", methods=["POST"])
+def admin_import_episodes(series_id):
+    if not admin_required():
+        return redirect(url_for("admin_login"))
+
+    conn = get_db_connection()
+    series = conn.execute(
+        "SELECT * FROM series WHERE id = ?", (series_id,)
+    ).fetchone()
+    conn.close()
+    if series is None:
+        flash("ไม่พบเรื่องนี้", "error")
+        return redirect(url_for("admin_series"))
+
+    manifest_file = request.files.get("manifest")
+    if manifest_file and manifest_file.filename:
+        text = manifest_file.read().decode("utf-8", errors="replace")
+        filename = manifest_file.filename
+    else:
+        text = request.form.get("manifest_text", "")
+        filename = ""
+    if not text.strip():
+        flash("กรุณาเลือกไฟล์ manifest หรือวางข้อมูล", "error")
+        return redirect(url_for("admin_episodes", series_id=series_id))
+
+    try:
+        items = parse_episode_manifest(text, filename)
+    except (ValueError, csv.Error) as e:
+        flash(f"อ่าน manifest ไม่ได้: {e}", "error")
+        return redirect(url_for("admin_episodes", series_id=series_id))
+
+    results = import_episode_manifest(series_id, items)
+    if request.args.get("format") == "json":
+        return api_json({"series_id": series_id, "results": results})
+
+    ok = sum(1 for r in results if r["status"] == "ok")
+    queued = sum(1 for r in results if r["video"] == "queued")
+    message = f"นำเข้าสำเร็จ {ok} จาก {len(results)} แถว"
+    if queued:
+        message += f" (ไฟล์ Drive {queued} ไฟล์กำลังโหลดอยู่เบื้องหลัง)"
+    flash(message, "success" if ok == len(results) else "error")
+
+    conn = get_db_connection()
+    episodes = conn.execute(
+        """
+        SELECT * FROM episodes
+        WHERE series_id = ?
+        ORDER BY episode_number IS NULL, episode_number, datetime(created_at)
+        """,
+        (series_id,),
+    ).fetchall()
+    conn.close()
+    return render_template(
+        "admin_episodes.html", series=series, episodes=episodes, import_results=results
+    )
+
+
 @app.route("/admin/episodes/<int:episode_id>/toggle_visibility", methods=["POST"])
 def admin_toggle_episode(episode_id):
     if not admin_required():
@@ -1351,6 +4543,8 @@ def admin_edit_episode(episode_id):
         new_video_url = ep["video_url"]
         new_drive_id = ep["drive_id"]
         new_file_path = ep["file_path"]
+        new_file_size = ep["file_size"]
+        new_file_sha256 = ep["file_sha256"]
 
         def delete_old_file(path):
             if not path:
@@ -1381,6 +4575,7 @@ def admin_edit_episode(episode_id):
             new_source_type = "direct"
             new_video_url = video_url
             new_drive_id = None
+            new_file_size = new_file_sha256 = None
 
         elif mode == "gdrive":
             drive_link = request.form.get("drive_link", "").strip()
@@ -1399,7 +4594,7 @@ def admin_edit_episode(episode_id):
                 delete_old_file(new_file_path)
 
             try:
-                file_real = download_drive_file(drive_id, ep["series_id"])
+                file_real, new_file_size, new_file_sha256 = fetch_drive_file(drive_id, ep["series_id"])
             except Exception as e:
                 flash(str(e), "error")
                 conn.close()
@@ -1408,6 +4603,7 @@ def admin_edit_episode(episode_id):
             rel_path = os.path.relpath(file_real, BASE_DIR)
             new_file_path = rel_path
             new_source_type = "gdrive"
+            enforce_video_disk_budget(keep=file_real)
             new_drive_id = drive_id
             new_video_url = None
 
@@ -1437,6 +4633,7 @@ def admin_edit_episode(episode_id):
             new_source_type = "upload"
             new_video_url = None
             new_drive_id = None
+            new_file_size = new_file_sha256 = None
         else:
             flash("โหมดที่เลือกไม่ถูกต้อง", "error")
             conn.close()
@@ -1445,7 +4642,8 @@ def admin_edit_episode(episode_id):
         conn.execute(
             """
             UPDATE episodes
-            SET title = ?, description = ?, episode_number = ?, source_type = ?, video_url = ?, drive_id = ?, file_path = ?
+            SET title = ?, description = ?, episode_number = ?, source_type = ?, video_url = ?, drive_id = ?, file_path = ?,
+                file_size = ?, file_sha256 = ?
             WHERE id = ?
             """,
             (
@@ -1456,6 +4654,8 @@ def admin_edit_episode(episode_id):
                 new_video_url,
                 new_drive_id,
                 new_file_path,
+                new_file_size,
+                new_file_sha256,
                 episode_id,
             ),
         )
@@ -1519,33 +4719,8 @@ def admin_delete_episode(episode_id):
         flash("ไม่พบตอนนี้", "error")
         return redirect(url_for("admin_series"))
 
-    file_path = ep["file_path"]
-    thumb = ep["thumbnail_url"]
     series_id = ep["series_id"]
-
-    if file_path:
-        if not os.path.isabs(file_path):
-            fp_full = os.path.join(BASE_DIR, file_path)
-        else:
-            fp_full = file_path
-        try:
-            if os.path.exists(fp_full):
-                os.remove(fp_full)
-        except Exception:
-            pass
-
-    # ลบไฟล์ปกตอนถ้าเป็นไฟล์ใน static
-    if thumb and not str(thumb).startswith("http"):
-        thumb_full = os.path.join(BASE_DIR, "static", thumb)
-        try:
-            if os.path.exists(thumb_full):
-                os.remove(thumb_full)
-            # ลบโฟลเดอร์เปล่า ep_... ด้วย
-            ep_dir = os.path.dirname(thumb_full)
-            if os.path.isdir(ep_dir) and not os.listdir(ep_dir):
-                os.rmdir(ep_dir)
-        except Exception:
-            pass
+    remove_episode_files(ep["file_path"], ep["thumbnail_url"])
 
     conn.execute("DELETE FROM episodes WHERE id = ?", (episode_id,))
     conn.commit()
@@ -1555,6 +4730,259 @@ def admin_delete_episode(episode_id):
     return redirect(url_for("admin_episodes", series_id=series_id))
 
 
+# ---------- งานแอดมินแบบกลุ่ม (หลาย id ในคำขอเดียว) ----------
+# แต่ละคำขอทำใน transaction เดียวด้วย executemany แล้วรายงานจำนวนแถวที่ถูกแก้
+# เลือกแถวด้วย ids (หลายค่า หรือคั่นด้วยจุลภาค) หรือด้วยตัวกรอง เช่น series_id
+# ส่ง format=json เพื่อรับผลเป็น JSON แทนการ redirect
+
+
+def _bulk_ids(name="ids"):
+    ids = []
+    for value in request.form.getlist(name) or request.args.getlist(name):
+        for part in str(value).split(","):
+            part = part.strip()
+            if part.isdigit():
+                ids.append(int(part))
+    return list(dict.fromkeys(ids))
+
+
+def _bulk_response(action, affected, fallback_url, message):
+    if request.values.get("format") == "json":
+        return api_json({"action": action, "affected": affected})
+    flash(message.format(affected), "success")
+    next_url = request.form.get("next") or ""
+    if not next_url.startswith("/") or next_url.startswith("//"):
+        next_url = fallback_url
+    return redirect(next_url)
+
+
+def bulk_set_visibility(conn, table, ids, action):
+    """เปิด (show) / ปิด (hide) / สลับ (toggle) หลายแถวในคำสั่งเดียว ไม่ commit เอง"""
+    if table not in ("series", "episodes"):
+        raise ValueError(table)
+    if action == "show":
+        sql = f"UPDATE {table} SET is_active = 1 WHERE id = ? AND COALESCE(is_active, 1) != 1"
+    elif action == "hide":
+        sql = f"UPDATE {table} SET is_active = 0 WHERE id = ? AND COALESCE(is_active, 1) != 0"
+    elif action == "toggle":
+        sql = f"UPDATE {table} SET is_active = CASE WHEN COALESCE(is_active, 1) = 1 THEN 0 ELSE 1 END WHERE id = ?"
+    else:
+        raise ValueError(action)
+    return conn.executemany(sql, [(i,) for i in ids]).rowcount
+
+
+def bulk_delete_episodes(conn, ids):
+    """ลบหลายตอน คืนค่า (จำนวนที่ลบ, รายการไฟล์ที่ต้องลบหลัง commit) ไม่ commit เอง"""
+    files = []
+    for chunk_start in range(0, len(ids), 500):
+        chunk = ids[chunk_start:chunk_start + 500]
+        rows = conn.execute(
+            f"SELECT file_path, thumbnail_url FROM episodes WHERE id IN ({','.join('?' * len(chunk))})",
+            chunk,
+        ).fetchall()
+        files.extend((r["file_path"], r["thumbnail_url"]) for r in rows)
+    affected = conn.executemany(
+        "DELETE FROM episodes WHERE id = ?", [(i,) for i in ids]
+    ).rowcount
+    return affected, files
+
+
+def renumber_episodes(conn, series_id, ids=None, start=1):
+    """ใส่เลขตอนใหม่เรียงกันตั้งแต่ start ตามลำดับของ ids ที่ส่งมา
+    หรือตามลำดับปัจจุบันของเรื่องถ้าไม่ระบุ ไม่ commit เอง"""
+    current = [
+        r["id"]
+        for r in conn.execute(
+            """
+            SELECT id FROM episodes
+            WHERE series_id = ?
+            ORDER BY episode_number IS NULL, episode_number, datetime(created_at)
+            """,
+            (series_id,),
+        )
+    ]
+    if ids:
+        in_series = set(current)
+        ordered = [i for i in ids if i in in_series]
+    else:
+        ordered = current
+    params = [(start + n, episode_id) for n, episode_id in enumerate(ordered)]
+    return conn.executemany(
+        "UPDATE episodes SET episode_number = ? WHERE id = ? AND episode_number IS NOT ?",
+        [(num, eid, num) for num, eid in params],
+    ).rowcount
+
+
+def purge_watch_history(conn, user_ids=None, series_id=None, before=None, ids=None):
+    """ลบประวัติการดูตามตัวกรอง แล้วคำนวณตารางสรุปใหม่เฉพาะผู้ใช้ที่โดน ไม่ commit เอง"""
+    if ids:
+        affected_users = set()
+        for chunk_start in range(0, len(ids), 500):
+            chunk = ids[chunk_start:chunk_start + 500]
+            affected_users.update(
+                r[0]
+                for r in conn.execute(
+                    f"SELECT DISTINCT user_id FROM watch_history WHERE id IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                )
+            )
+        affected = conn.executemany(
+            "DELETE FROM watch_history WHERE id = ?", [(i,) for i in ids]
+        ).rowcount
+    else:
+        where = []
+        params = []
+        if user_ids:
+            where.append(f"user_id IN ({','.join('?' * len(user_ids))})")
+            params.extend(user_ids)
+        if series_id:
+            where.append("series_id = ?")
+            params.append(series_id)
+        if before:
+            where.append("watched_at < ?")
+            params.append(before)
+        if not where:
+            raise ValueError("ต้องระบุตัวกรองอย่างน้อยหนึ่งอย่าง")
+        clause = " AND ".join(where)
+        affected_users = {
+            r[0] for r in conn.execute(f"SELECT DISTINCT user_id FROM watch_history WHERE {clause}", params)
+        }
+        affected = conn.execute(f"DELETE FROM watch_history WHERE {clause}", params).rowcount
+
+    for uid in affected_users:
+        rebuild_watch_rollup(conn, uid)
+    return affected
+
+
+@app.route("/admin/bulk/episodes", methods=["POST"])
+def admin_bulk_episodes():
+    if not admin_required():
+        return redirect(url_for("admin_login"))
+
+    action = request.form.get("action", "")
+    series_id = request.form.get("series_id", type=int)
+    ids = _bulk_ids()
+    fallback = url_for("admin_episodes", series_id=series_id) if series_id else url_for("admin_series")
+
+    # เปิด/ปิด/ลบ ต้องเลือกตอนเองเสมอ มีแต่ renumber ที่ไม่เลือกแล้วจะเรียงทั้งเรื่อง
+    if not ids and action != "renumber":
+        flash("กรุณาเลือกตอนอย่างน้อยหนึ่งตอน", "error")
+        return redirect(fallback)
+
+    conn = get_db_connection()
+    try:
+        files = []
+        if action in ("show", "hide", "toggle"):
+            affected = bulk_set_visibility(conn, "episodes", ids, action)
+            message = "อัปเดตสถานะการเปิด/ปิด {} ตอนเรียบร้อยแล้ว"
+        elif action == "delete":
+            affected, files = bulk_delete_episodes(conn, ids)
+            message = "ลบ {} ตอนเรียบร้อยแล้ว"
+        elif action == "renumber" and series_id:
+            start = request.form.get("start", type=int) or 1
+            affected = renumber_episodes(conn, series_id, ids, start)
+            message = "เรียงเลขตอนใหม่ {} ตอนเรียบร้อยแล้ว"
+        else:
+            conn.close()
+            flash("คำสั่งไม่ถูกต้อง", "error")
+            return redirect(fallback)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        conn.close()
+        raise
+    conn.close()
+
+    for file_path, thumb in files:
+        remove_episode_files(file_path, thumb)
+    return _bulk_response(action, affected, fallback, message)
+
+
+@app.route("/admin/bulk/series", methods=["POST"])
+def admin_bulk_series():
+    if not admin_required():
+        return redirect(url_for("admin_login"))
+
+    action = request.form.get("action", "")
+    ids = _bulk_ids()
+    fallback = url_for("admin_series")
+
+    conn = get_db_connection()
+    try:
+        episode_files = []
+        if action in ("show", "hide", "toggle"):
+            affected = bulk_set_visibility(conn, "series", ids, action)
+            message = "อัปเดตสถานะการเปิด/ปิด {} เรื่องเรียบร้อยแล้ว"
+        elif action == "delete":
+            for chunk_start in range(0, len(ids), 500):
+                chunk = ids[chunk_start:chunk_start + 500]
+                episode_files.extend(
+                    r[0]
+                    for r in conn.execute(
+                        f"SELECT file_path FROM episodes WHERE series_id IN ({','.join('?' * len(chunk))})",
+                        chunk,
+                    )
+                )
+            affected = conn.executemany(
+                "DELETE FROM series WHERE id = ?", [(i,) for i in ids]
+            ).rowcount
+            message = "ลบ {} เรื่องพร้อมตอนทั้งหมดเรียบร้อยแล้ว"
+        else:
+            conn.close()
+            flash("คำสั่งไม่ถูกต้อง", "error")
+            return redirect(fallback)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        conn.close()
+        raise
+    conn.close()
+
+    if action == "delete":
+        for file_path in episode_files:
+            remove_episode_files(file_path)
+        for series_id in ids:
+            remove_series_dirs(series_id)
+    return _bulk_response(action, affected, fallback, message)
+
+
+@app.route("/admin/bulk/history", methods=["POST"])
+def admin_bulk_history():
+    if not admin_required():
+        return redirect(url_for("admin_login"))
+
+    user_ids = _bulk_ids("user_id")
+    series_id = request.form.get("series_id", type=int)
+    before = request.form.get("before", "").strip() or None
+    ids = _bulk_ids()
+    fallback = (
+        url_for("admin_user_detail", user_id=user_ids[0]) if len(user_ids) == 1 else url_for("admin_users")
+    )
+    if before:
+        try:
+            # รับทั้งแบบวันที่ (YYYY-MM-DD) และ ISO เต็ม เทียบกับ watched_at แบบ ISO
+            before = datetime.fromisoformat(before).isoformat()
+        except ValueError:
+            flash("รูปแบบวันที่ไม่ถูกต้อง", "error")
+            return redirect(fallback)
+
+    conn = get_db_connection()
+    try:
+        affected = purge_watch_history(conn, user_ids, series_id, before, ids)
+        conn.commit()
+    except ValueError as e:
+        conn.rollback()
+        conn.close()
+        flash(str(e), "error")
+        return redirect(fallback)
+    except Exception:
+        conn.rollback()
+        conn.close()
+        raise
+    conn.close()
+    return _bulk_response("purge", affected, fallback, "ลบประวัติการดู {} รายการเรียบร้อยแล้ว")
+
+
 # ---------- ระบบสำรอง/คืนค่า ----------
 @app.route("/admin/backup", methods=["GET", "POST"])
 def admin_backup():
@@ -1562,16 +4990,33 @@ def admin_backup():
         return redirect(url_for("admin_login"))
 
     if request.method == "POST":
-        file = request.files.get("backup_file")
-        if not file or not file.filename:
+        files = [f for f in request.files.getlist("backup_file") if f and f.filename]
+        if not files:
             flash("กรุณาเลือกไฟล์สำรอง (.json) ก่อน", "error")
             return redirect(url_for("admin_backup"))
 
-        try:
-            data = json.load(file.stream)
-        except Exception:
-            flash("ไฟล์ไม่อยู่ในรูปแบบ JSON ที่ถูกต้อง", "error")
-            return redirect(url_for("admin_backup"))
+        datas = []
+        for file in files:
+            try:
+                datas.append(json.load(file.stream))
+            except Exception:
+                flash("ไฟล์ไม่อยู่ในรูปแบบ JSON ที่ถูกต้อง", "error")
+                return redirect(url_for("admin_backup"))
+            try:
+                check_backup_payload(datas[-1])
+            except ValueError as e:
+                flash(f"{file.filename}: {e}", "error")
+                return redirect(url_for("admin_backup"))
+
+        # หลายไฟล์ หรือมีไฟล์ส่วนต่าง: เรียง base -> delta ตามสาย manifest
+        # ไฟล์แรกคืนค่าตามประเภทของมัน ไฟล์ส่วนต่างที่เหลือใช้ต่อใน transaction เดียวกัน
+        if len(datas) > 1 or any(d.get("type") == "users_delta" for d in datas):
+            try:
+                datas = order_backup_chain(datas)
+            except ValueError as e:
+                flash(str(e), "error")
+                return redirect(url_for("admin_backup"))
+        data, deltas = datas[0], datas[1:]
 
         backup_type = data.get("type")
         if not backup_type:
@@ -1705,6 +5150,8 @@ def admin_backup():
                             row,
                         )
 
+                refresh_series_stats(conn)
+                rebuild_watch_rollup(conn)
                 msg = "คืนค่าข้อมูลวิดีโอจากไฟล์สำเร็จแล้ว"
 
             elif backup_type == "users":
@@ -1811,44 +5258,390 @@ def admin_backup():
                             row,
                         )
 
-                msg = "คืนค่าข้อมูลบัญชีผู้ใช้และประวัติการดูจากไฟล์สำเร็จแล้ว"
+                rebuild_watch_rollup(conn)
+                msg = "คืนค่าข้อมูลบัญชีผู้ใช้และประวัติการดูจากไฟล์สำเร็จแล้ว"
+
+            elif backup_type == "users_delta":
+                ensure_user_extra_columns(conn)
+                apply_users_delta(conn, data)
+                rebuild_watch_rollup(conn)
+                msg = "คืนค่าข้อมูลสมาชิกแบบส่วนต่างสำเร็จแล้ว"
+
+            else:
+                msg = "ไฟล์สำรองประเภทอื่นๆ ถูกอ่านสำเร็จ (ยังไม่มีข้อมูลอื่นให้คืนค่าในระบบนี้)"
+
+            mark_backup_restored(conn, data.get("manifest"))
+            for delta in deltas:
+                apply_users_delta(conn, delta)
+                mark_backup_restored(conn, delta.get("manifest"))
+            if deltas:
+                rebuild_watch_rollup(conn)
+                msg = f"คืนค่า {len(datas)} ไฟล์ตามลำดับสำเร็จแล้ว"
+
+            conn.commit()
+            flash(msg, "success")
+        except Exception as e:
+            conn.rollback()
+            flash("เกิดข้อผิดพลาดระหว่างคืนค่าข้อมูล: {}".format(e), "error")
+        finally:
+            conn.close()
+
+        return redirect(url_for("admin_backup"))
+
+    conn = get_db_connection()
+    pending_deltas = pending_backup_deltas(conn)
+    conn.close()
+    return render_template("admin_backup.html", snapshots=list_db_snapshots(), pending_deltas=pending_deltas)
+
+
+@app.route("/admin/backup/download/videos")
+def admin_backup_download_videos():
+    if not admin_required():
+        return redirect(url_for("admin_login"))
+
+    conn = get_db_connection()
+    series = conn.execute("SELECT * FROM series").fetchall()
+    episodes = conn.execute("SELECT * FROM episodes").fetchall()
+    conn.close()
+
+    data = {
+        "version": "myseries_backup_v2",
+        "type": "videos",
+        "exported_at": datetime.utcnow().isoformat(),
+        "series": [dict(row) for row in series],
+        "episodes": [dict(row) for row in episodes],
+    }
+
+    json_bytes = json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+    filename = f"Video-{datetime.now().strftime('%Y%m%d')}.json"  # รูปแบบ: Video-YYYYMMDD.json
+    return Response(
+        json_bytes,
+        mimetype="application/json",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@app.route("/admin/backup/download/users")
+def admin_backup_download_users():
+    if not admin_required():
+        return redirect(url_for("admin_login"))
+
+    conn = get_db_connection()
+    ensure_user_extra_columns(conn)
+    try:
+        # อ่านข้อมูลกับ high-water mark ใน transaction เดียว delta ถัดไปจึงต่อกันพอดี
+        conn.execute("BEGIN IMMEDIATE")
+        users = conn.execute("SELECT * FROM users").fetchall()
+        history = conn.execute("SELECT * FROM watch_history").fetchall()
+        manifest = record_backup_manifest(conn, "base", None)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    data = {
+        "version": "myseries_backup_v2",
+        "type": "users",
+        "exported_at": datetime.utcnow().isoformat(),
+        "manifest": manifest,
+        "users": [dict(row) for row in users],
+        "watch_history": [dict(row) for row in history],
+    }
+
+    json_bytes = json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+    filename = f"user-{datetime.now().strftime('%Y%m%d')}.json"  # รูปแบบ: user-YYYYMMDD.json
+    return Response(
+        json_bytes,
+        mimetype="application/json",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+# ---------- สำรองข้อมูลสมาชิกแบบส่วนต่าง (delta) ----------
+# ไฟล์แบบเต็ม (base) และไฟล์ส่วนต่าง (delta) มี manifest ที่มี id และ parent_id ต่อกันเป็นสาย
+# delta มีเฉพาะ watch_history ที่ id มากกว่า history_hwm ของไฟล์ก่อนหน้า
+# users ที่ถูกเพิ่ม/แก้ และแถวที่ถูกลบตั้งแต่ changes_hwm ของไฟล์ก่อนหน้า (จาก backup_changelog)
+# ขนาดไฟล์รายวันจึงขึ้นกับกิจกรรมของวันนั้น ไม่ใช่ขนาดข้อมูลทั้งหมด
+# ดาวน์โหลด delta ไม่ลบอะไร: delta ต่อจากไฟล์ล่าสุดที่ยืนยันแล้ว (ไฟล์หายก็ดาวน์โหลดใหม่ได้)
+# ผู้ดูแลกดยืนยันว่าเก็บไฟล์แล้ว (POST) จึงเลื่อนสายไปต่อจากไฟล์นั้นและลบ changelog ที่ต่ำกว่า high-water mark
+# คืนค่า: อัปโหลด base ตามด้วย delta (เลือกหลายไฟล์พร้อมกันได้) ระบบเรียงตามสายให้เอง
+
+
+def _latest_backup_manifest(conn):
+    return conn.execute(
+        """
+        SELECT * FROM backup_chain
+        WHERE restored_at IS NULL AND confirmed_at IS NOT NULL
+        ORDER BY confirmed_at DESC, rowid DESC LIMIT 1
+        """
+    ).fetchone()
+
+
+def pending_backup_deltas(conn):
+    """delta ที่ดาวน์โหลดแล้วแต่ยังไม่ยืนยัน (ต่อจากไฟล์ล่าสุดที่ยืนยันแล้ว)"""
+    parent = _latest_backup_manifest(conn)
+    if parent is None:
+        return []
+    return conn.execute(
+        """
+        SELECT * FROM backup_chain
+        WHERE parent_id = ? AND kind = 'delta' AND confirmed_at IS NULL AND restored_at IS NULL
+        ORDER BY created_at DESC, rowid DESC
+        """,
+        (parent["id"],),
+    ).fetchall()
+
+
+def record_backup_manifest(conn, kind, parent_id):
+    """จด manifest ของไฟล์สำรองที่กำลังออก (ต้องอยู่ใน transaction เดียวกับการอ่านข้อมูล)"""
+    history_hwm = conn.execute("SELECT COALESCE(MAX(id), 0) FROM watch_history").fetchone()[0]
+    changes_hwm = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM backup_changelog").fetchone()[0]
+    manifest = {
+        "id": datetime.utcnow().strftime("%Y%m%d%H%M%S") + "-" + os.urandom(4).hex(),
+        "parent_id": parent_id,
+        "kind": kind,
+        "created_at": datetime.utcnow().isoformat(),
+        "history_hwm": history_hwm,
+        "changes_hwm": changes_hwm,
+    }
+    # ไฟล์แบบเต็มไม่ต้องพึ่ง changelog ถ้าหายก็ดาวน์โหลดใหม่ได้ จึงยืนยันทันที
+    # delta ต้องรอผู้ดูแลยืนยัน (confirm_backup_delta)
+    conn.execute(
+        """
+        INSERT INTO backup_chain (id, parent_id, kind, created_at, history_hwm, changes_hwm, confirmed_at)
+        VALUES (:id, :parent_id, :kind, :created_at, :history_hwm, :changes_hwm, :confirmed_at)
+        """,
+        dict(manifest, confirmed_at=manifest["created_at"] if kind == "base" else None),
+    )
+    return manifest
+
+
+def confirm_backup_delta(conn, manifest_id):
+    """ยืนยันว่าเก็บไฟล์ delta แล้ว: delta ถัดไปต่อจากไฟล์นี้ และลบ changelog ที่ไม่ต้องใช้แล้ว
+    ยก ValueError ถ้าไม่ใช่ delta ที่ต่อจากไฟล์ล่าสุดที่ยืนยันแล้ว (ต้องอยู่ใน transaction)"""
+    parent = _latest_backup_manifest(conn)
+    row = conn.execute(
+        "SELECT * FROM backup_chain WHERE id = ? AND kind = 'delta' AND restored_at IS NULL", (manifest_id,)
+    ).fetchone()
+    if row is None or parent is None or row["parent_id"] != parent["id"] or row["confirmed_at"]:
+        raise ValueError("ไฟล์ส่วนต่างนี้ไม่ได้ต่อจากไฟล์ล่าสุดที่ยืนยันแล้ว กรุณาดาวน์โหลดใหม่")
+    conn.execute(
+        "UPDATE backup_chain SET confirmed_at = ? WHERE id = ?", (datetime.utcnow().isoformat(), manifest_id)
+    )
+    # delta อื่นที่ต่อจากไฟล์เดียวกันแต่ไม่ได้ยืนยันใช้ไม่ได้แล้ว
+    conn.execute(
+        "DELETE FROM backup_chain WHERE parent_id = ? AND id != ? AND confirmed_at IS NULL AND restored_at IS NULL",
+        (parent["id"], manifest_id),
+    )
+    # delta ถัดไปอ่านเฉพาะ seq > changes_hwm ของไฟล์นี้
+    conn.execute("DELETE FROM backup_changelog WHERE seq <= ?", (row["changes_hwm"],))
+
+
+def build_users_delta(conn):
+    """สร้างข้อมูล delta ต่อจากไฟล์สำรองล่าสุด คืน None ถ้ายังไม่เคยออกไฟล์แบบเต็ม"""
+    parent = _latest_backup_manifest(conn)
+    if parent is None:
+        return None
+
+    changes = conn.execute(
+        "SELECT table_name, row_id, op FROM backup_changelog WHERE seq > ? ORDER BY seq",
+        (parent["changes_hwm"],),
+    ).fetchall()
+    # เอาสถานะสุดท้ายของแต่ละแถว
+    last_op = {}
+    for c in changes:
+        last_op[(c["table_name"], c["row_id"])] = c["op"]
+
+    upsert_user_ids = [rid for (t, rid), op in last_op.items() if t == "users" and op == "upsert"]
+    users = []
+    for start in range(0, len(upsert_user_ids), 500):
+        chunk = upsert_user_ids[start:start + 500]
+        users.extend(
+            dict(r)
+            for r in conn.execute(
+                f"SELECT * FROM users WHERE id IN ({','.join('?' * len(chunk))})", chunk
+            )
+        )
+    history = [
+        dict(r)
+        for r in conn.execute(
+            "SELECT * FROM watch_history WHERE id > ? ORDER BY id", (parent["history_hwm"],)
+        )
+    ]
+    deleted = {
+        "users": sorted(rid for (t, rid), op in last_op.items() if t == "users" and op == "delete"),
+        # แถวที่เพิ่มแล้วลบภายในช่วงเดียวกันไม่ต้องส่ง
+        "watch_history": sorted(
+            rid
+            for (t, rid), op in last_op.items()
+            if t == "watch_history" and op == "delete" and rid <= parent["history_hwm"]
+        ),
+    }
+    manifest = record_backup_manifest(conn, "delta", parent["id"])
+    return {
+        "version": "myseries_backup_v2",
+        "type": "users_delta",
+        "exported_at": datetime.utcnow().isoformat(),
+        "manifest": manifest,
+        "users": users,
+        "watch_history": history,
+        "deleted": deleted,
+    }
 
-            else:
-                msg = "ไฟล์สำรองประเภทอื่นๆ ถูกอ่านสำเร็จ (ยังไม่มีข้อมูลอื่นให้คืนค่าในระบบนี้)"
 
-            conn.commit()
-            flash(msg, "success")
-        except Exception as e:
-            conn.rollback()
-            flash("เกิดข้อผิดพลาดระหว่างคืนค่าข้อมูล: {}".format(e), "error")
-        finally:
-            conn.close()
+def check_backup_payload(data):
+    """ตรวจโครงสร้างไฟล์สำรองก่อนคืนค่า ยก ValueError ถ้าไม่ถูกต้อง"""
+    if not isinstance(data, dict):
+        raise ValueError("ไฟล์สำรองต้องเป็น JSON object")
+    if data.get("type") is not None and not isinstance(data["type"], str):
+        raise ValueError("ชนิดไฟล์สำรองไม่ถูกต้อง")
+    for key in ("series", "episodes", "users", "watch_history"):
+        rows = data.get(key)
+        if rows is not None and not (isinstance(rows, list) and all(isinstance(r, dict) for r in rows)):
+            raise ValueError(f"ข้อมูล {key} ต้องเป็นรายการของ object")
+    manifest = data.get("manifest")
+    if manifest is not None and not isinstance(manifest, dict):
+        raise ValueError("manifest ไม่ถูกต้อง")
+    if data.get("type") == "users_delta":
+        if not manifest or not manifest.get("id"):
+            raise ValueError("ไฟล์ส่วนต่างไม่มี manifest")
+        deleted = data.get("deleted") or {}
+        if not isinstance(deleted, dict) or not all(
+            isinstance(ids, list) and all(isinstance(i, int) for i in ids) for ids in deleted.values()
+        ):
+            raise ValueError("ข้อมูล deleted ในไฟล์ส่วนต่างไม่ถูกต้อง")
+
+
+def order_backup_chain(items):
+    """เรียงไฟล์สำรองที่มี manifest ให้ base มาก่อนแล้วตามด้วย delta ตามสาย parent_id
+    ยก ValueError ถ้าสายขาด"""
+    by_parent = {}
+    bases = []
+    for data in items:
+        manifest = data.get("manifest") or {}
+        if data.get("type") not in ("users", "users_delta"):
+            raise ValueError("เลือกหลายไฟล์พร้อมกันได้เฉพาะไฟล์สมาชิก (แบบเต็มหนึ่งไฟล์กับไฟล์ส่วนต่าง)")
+        if manifest.get("kind") == "base" or data.get("type") == "users":
+            bases.append(data)
+        else:
+            by_parent[manifest.get("parent_id")] = data
+    if len(bases) > 1:
+        raise ValueError("เลือกไฟล์แบบเต็มได้ครั้งละไฟล์เดียว")
+
+    ordered = list(bases)
+    head = (bases[0].get("manifest") or {}).get("id") if bases else None
+    if head is None and by_parent:
+        # ไม่มี base ในชุดนี้: ต่อจากไฟล์ที่คืนค่าไว้ล่าสุดในระบบ
+        conn = get_db_connection()
+        row = conn.execute(
+            "SELECT id FROM backup_chain WHERE restored_at IS NOT NULL ORDER BY restored_at DESC, rowid DESC LIMIT 1"
+        ).fetchone()
+        conn.close()
+        head = row["id"] if row else None
+    while head in by_parent:
+        data = by_parent.pop(head)
+        ordered.append(data)
+        head = data["manifest"]["id"]
+    if by_parent:
+        missing = ", ".join(sorted(str(d["manifest"].get("parent_id")) for d in by_parent.values()))
+        raise ValueError(f"ไฟล์ส่วนต่างไม่ต่อกับสายที่มี (ต้องคืนค่าไฟล์ {missing} ก่อน)")
+    return ordered
+
+
+def apply_users_delta(conn, data):
+    """คืนค่า delta หนึ่งไฟล์ (ไม่ commit เอง) ลบก่อนแล้วค่อยเพิ่ม/แก้ เพื่อไม่ให้ username ชนกัน"""
+    deleted = data.get("deleted") or {}
+    conn.executemany(
+        "DELETE FROM watch_history WHERE id = ?", [(i,) for i in deleted.get("watch_history", [])]
+    )
+    conn.executemany("DELETE FROM users WHERE id = ?", [(i,) for i in deleted.get("users", [])])
+    conn.executemany(
+        """
+        INSERT INTO users (id, username, password, plain_password, user_key, created_at)
+        VALUES (:id, :username, :password, :plain_password, :user_key, :created_at)
+        ON CONFLICT(id) DO UPDATE SET
+            username = excluded.username,
+            password = excluded.password,
+            plain_password = excluded.plain_password,
+            user_key = excluded.user_key,
+            created_at = excluded.created_at
+        """,
+        [
+            {
+                "id": u.get("id"),
+                "username": u.get("username"),
+                "password": u.get("password"),
+                "plain_password": u.get("plain_password"),
+                "user_key": u.get("user_key"),
+                "created_at": u.get("created_at") or datetime.utcnow().isoformat(),
+            }
+            for u in data.get("users", []) or []
+        ],
+    )
+    conn.executemany(
+        """
+        INSERT OR REPLACE INTO watch_history (id, user_id, series_id, episode_id, watched_at)
+        VALUES (?, ?, ?, ?, ?)
+        """,
+        [
+            (
+                h.get("id"),
+                h.get("user_id"),
+                h.get("series_id"),
+                h.get("episode_id"),
+                h.get("watched_at") or datetime.utcnow().isoformat(),
+            )
+            for h in data.get("watch_history", []) or []
+        ],
+    )
 
-        return redirect(url_for("admin_backup"))
 
-    return render_template("admin_backup.html")
+def mark_backup_restored(conn, manifest):
+    if not manifest or not manifest.get("id"):
+        return
+    conn.execute(
+        """
+        INSERT INTO backup_chain (id, parent_id, kind, created_at, history_hwm, changes_hwm, restored_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(id) DO UPDATE SET restored_at = excluded.restored_at
+        """,
+        (
+            manifest["id"],
+            manifest.get("parent_id"),
+            manifest.get("kind", "base"),
+            manifest.get("created_at") or datetime.utcnow().isoformat(),
+            manifest.get("history_hwm", 0),
+            manifest.get("changes_hwm", 0),
+            datetime.utcnow().isoformat(),
+        ),
+    )
 
 
-@app.route("/admin/backup/download/videos")
-def admin_backup_download_videos():
+@app.route("/admin/backup/download/users/delta")
+def admin_backup_download_users_delta():
     if not admin_required():
         return redirect(url_for("admin_login"))
 
     conn = get_db_connection()
-    series = conn.execute("SELECT * FROM series").fetchall()
-    episodes = conn.execute("SELECT * FROM episodes").fetchall()
-    conn.close()
+    ensure_user_extra_columns(conn)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        data = build_users_delta(conn)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
 
-    data = {
-        "version": "myseries_backup_v2",
-        "type": "videos",
-        "exported_at": datetime.utcnow().isoformat(),
-        "series": [dict(row) for row in series],
-        "episodes": [dict(row) for row in episodes],
-    }
+    if data is None:
+        flash("ต้องดาวน์โหลดข้อมูลสมาชิกแบบเต็มก่อน แล้วจึงดาวน์โหลดแบบส่วนต่างได้", "error")
+        return redirect(url_for("admin_backup"))
 
-    json_bytes = json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
-    filename = f"Video-{datetime.now().strftime('%Y%m%d')}.json"  # รูปแบบ: Video-YYYYMMDD.json
+    json_bytes = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    filename = f"user-delta-{data['manifest']['id']}.json"
     return Response(
         json_bytes,
         mimetype="application/json",
@@ -1856,32 +5649,29 @@ def admin_backup_download_videos():
     )
 
 
-@app.route("/admin/backup/download/users")
-def admin_backup_download_users():
+@app.route("/admin/backup/users/delta/confirm", methods=["POST"])
+def admin_backup_confirm_users_delta():
     if not admin_required():
         return redirect(url_for("admin_login"))
 
+    manifest_id = (request.form.get("manifest_id") or "").strip()
     conn = get_db_connection()
-    ensure_user_extra_columns(conn)
-    users = conn.execute("SELECT * FROM users").fetchall()
-    history = conn.execute("SELECT * FROM watch_history").fetchall()
-    conn.close()
-
-    data = {
-        "version": "myseries_backup_v2",
-        "type": "users",
-        "exported_at": datetime.utcnow().isoformat(),
-        "users": [dict(row) for row in users],
-        "watch_history": [dict(row) for row in history],
-    }
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        confirm_backup_delta(conn, manifest_id)
+        conn.commit()
+    except ValueError as e:
+        conn.rollback()
+        flash(str(e), "error")
+        return redirect(url_for("admin_backup"))
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
 
-    json_bytes = json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
-    filename = f"user-{datetime.now().strftime('%Y%m%d')}.json"  # รูปแบบ: user-YYYYMMDD.json
-    return Response(
-        json_bytes,
-        mimetype="application/json",
-        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
-    )
+    flash("ยืนยันไฟล์ส่วนต่างแล้ว ครั้งต่อไปจะดาวน์โหลดเฉพาะส่วนที่เปลี่ยนหลังไฟล์นี้", "success")
+    return redirect(url_for("admin_backup"))
 
 
 @app.route("/admin/backup/download/other")
@@ -1913,6 +5703,898 @@ def admin_backup_download():
 
 
 
+# ---------- snapshot ฐานข้อมูลแบบออนไลน์ (sqlite3 backup API) ----------
+# คัดลอก videos.db ทีละ SNAPSHOT_PAGES_PER_STEP หน้า แล้วพัก SNAPSHOT_STEP_SLEEP วินาทีระหว่างรอบ
+# ผู้เขียนคนอื่นจึงไม่ถูกบล็อกนาน ได้สำเนาที่สอดคล้องกันทุกตาราง ณ เวลาเดียว
+# จากนั้นบีบอัดเป็น .db.gz พร้อมไฟล์ .sha256 (ตรวจได้ด้วย sha256sum -c) และเก็บไว้ SNAPSHOT_KEEP ชุดล่าสุด
+# ตั้ง SNAPSHOT_INTERVAL_HOURS > 0 เพื่อให้สร้างอัตโนมัติ หรือกดสร้างจากหน้าสำรองข้อมูล / flask snapshot-db
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", os.path.join(BASE_DIR, "snapshots"))
+SNAPSHOT_KEEP = int(os.getenv("SNAPSHOT_KEEP", "7"))
+SNAPSHOT_INTERVAL_HOURS = float(os.getenv("SNAPSHOT_INTERVAL_HOURS", "0"))
+SNAPSHOT_PAGES_PER_STEP = int(os.getenv("SNAPSHOT_PAGES_PER_STEP", "256"))
+SNAPSHOT_STEP_SLEEP = float(os.getenv("SNAPSHOT_STEP_SLEEP", "0.02"))
+SNAPSHOT_MAX_RESTARTS = int(os.getenv("SNAPSHOT_MAX_RESTARTS", "3"))
+SNAPSHOT_NAME_RE = re.compile(r"^videos-\d{8}-\d{6}\.db\.gz$")
+
+_snapshot_lock = threading.Lock()
+_snapshot_scheduler_started = False
+
+
+class SnapshotBusy(Exception):
+    """มี snapshot อื่นกำลังสร้างอยู่ (ใน worker นี้หรือ worker อื่น)"""
+
+
+def list_db_snapshots():
+    """รายการ snapshot ใหม่สุดก่อน: dict ของ name, size, created_at, sha256"""
+    if not os.path.isdir(SNAPSHOT_DIR):
+        return []
+    items = []
+    for name in os.listdir(SNAPSHOT_DIR):
+        if not SNAPSHOT_NAME_RE.match(name):
+            continue
+        path = os.path.join(SNAPSHOT_DIR, name)
+        try:
+            with open(path + ".sha256", encoding="ascii") as f:
+                digest = f.read().split()[0]
+        except (OSError, IndexError):
+            digest = None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        items.append(
+            {
+                "name": name,
+                "size": stat.st_size,
+                "created_at": datetime.utcfromtimestamp(stat.st_mtime).isoformat(),
+                "sha256": digest,
+            }
+        )
+    items.sort(key=lambda x: x["name"], reverse=True)
+    return items
+
+
+def _rotate_db_snapshots():
+    for item in list_db_snapshots()[max(SNAPSHOT_KEEP, 1):]:
+        for path in (
+            os.path.join(SNAPSHOT_DIR, item["name"]),
+            os.path.join(SNAPSHOT_DIR, item["name"] + ".sha256"),
+        ):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class _SnapshotRestarted(Exception):
+    pass
+
+
+def _backup_in_steps(src, dst):
+    """คัดลอกทีละช่วงแล้วพัก ถ้ามีคนเขียน DB ระหว่างทาง SQLite จะเริ่มคัดลอกใหม่
+    ถ้าเริ่มใหม่เกิน SNAPSHOT_MAX_RESTARTS ครั้ง (มีการเขียนตลอด) จะคัดลอกที่เหลือในรอบเดียว
+    ซึ่งบล็อกผู้เขียนแค่ช่วงคัดลอกไฟล์ (การบีบอัดทำหลังจากนั้น)"""
+    state = {"remaining": None, "restarts": 0}
+
+    def progress(status, remaining, total):
+        # remaining เพิ่มขึ้นแปลว่า backup ถูกเริ่มใหม่เพราะต้นฉบับเปลี่ยน
+        if state["remaining"] is not None and remaining > state["remaining"]:
+            state["restarts"] += 1
+            if state["restarts"] > SNAPSHOT_MAX_RESTARTS:
+                raise _SnapshotRestarted()
+        state["remaining"] = remaining
+        # progress ถูกเรียกหลังทุกรอบ: พักตรงนี้เพื่อปล่อยให้ผู้เขียนอื่นทำงาน
+        time.sleep(SNAPSHOT_STEP_SLEEP)
+
+    try:
+        src.backup(dst, pages=max(SNAPSHOT_PAGES_PER_STEP, 1), progress=progress)
+    except _SnapshotRestarted:
+        src.backup(dst, pages=-1)
+
+
+def create_db_snapshot():
+    """สร้าง snapshot หนึ่งชุด คืน dict ของ snapshot ที่สร้าง
+    ยก SnapshotBusy ถ้ามีอีกชุดกำลังสร้างอยู่"""
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    if not _snapshot_lock.acquire(blocking=False):
+        raise SnapshotBusy()
+    lock_file = open(os.path.join(SNAPSHOT_DIR, ".lock"), "w")
+    try:
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                raise SnapshotBusy()
+
+        stamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+        name = f"videos-{stamp}.db.gz"
+        final_path = os.path.join(SNAPSHOT_DIR, name)
+        raw_tmp = os.path.join(SNAPSHOT_DIR, f".{name}.{os.getpid()}.db")
+        gz_tmp = final_path + f".{os.getpid()}.part"
+
+        try:
+            src = sqlite3.connect(DB_PATH)
+            dst = sqlite3.connect(raw_tmp)
+            try:
+                _backup_in_steps(src, dst)
+                check = dst.execute("PRAGMA quick_check").fetchone()[0]
+                if check != "ok":
+                    raise RuntimeError(f"snapshot ไม่ผ่านการตรวจสอบ: {check}")
+            finally:
+                dst.close()
+                src.close()
+
+            digest = hashlib.sha256()
+            with open(raw_tmp, "rb") as raw, open(gz_tmp, "wb") as out:
+                gz = gzip.GzipFile(filename=f"videos-{stamp}.db", mode="wb", fileobj=_HashingWriter(out, digest), mtime=0)
+                with gz:
+                    while True:
+                        chunk = raw.read(1024 * 1024)
+                        if not chunk:
+                            break
+                        gz.write(chunk)
+                out.flush()
+                os.fsync(out.fileno())
+            with open(final_path + ".sha256", "w", encoding="ascii") as f:
+                f.write(f"{digest.hexdigest()}  {name}\n")
+            os.replace(gz_tmp, final_path)
+        finally:
+            for path in (raw_tmp, gz_tmp):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+        _rotate_db_snapshots()
+        return {
+            "name": name,
+            "size": os.path.getsize(final_path),
+            "sha256": digest.hexdigest(),
+        }
+    finally:
+        lock_file.close()
+        _snapshot_lock.release()
+
+
+class _HashingWriter:
+    """file object ที่คำนวณ sha256 ของข้อมูลที่เขียนผ่านไปพร้อมกัน"""
+
+    def __init__(self, fileobj, digest):
+        self._f = fileobj
+        self._digest = digest
+
+    def write(self, data):
+        self._digest.update(data)
+        return self._f.write(data)
+
+    def flush(self):
+        self._f.flush()
+
+
+def _snapshot_loop():
+    interval = SNAPSHOT_INTERVAL_HOURS * 3600
+    while True:
+        latest = list_db_snapshots()
+        age = None
+        if latest:
+            try:
+                age = time.time() - os.path.getmtime(os.path.join(SNAPSHOT_DIR, latest[0]["name"]))
+            except OSError:
+                age = None
+        # ทุก worker มี thread นี้ แต่สร้างจริงเฉพาะเมื่อชุดล่าสุดเก่ากว่ารอบที่ตั้งไว้ (และ flock กันชนกัน)
+        if age is None or age >= interval:
+            try:
+                create_db_snapshot()
+                age = 0
+            except Exception:
+                age = interval - 60
+        time.sleep(max(interval - age, 60))
+
+
+@app.before_request
+def _start_snapshot_scheduler():
+    # เริ่ม thread ตอนมีคำขอแรก (หลัง gunicorn fork แล้ว)
+    global _snapshot_scheduler_started
+    if _snapshot_scheduler_started or SNAPSHOT_INTERVAL_HOURS <= 0:
+        return None
+    with _snapshot_lock:
+        if _snapshot_scheduler_started:
+            return None
+        _snapshot_scheduler_started = True
+    threading.Thread(target=_snapshot_loop, daemon=True).start()
+    return None
+
+
+@app.route("/admin/backup/snapshots", methods=["POST"])
+def admin_create_snapshot():
+    if not admin_required():
+        return redirect(url_for("admin_login"))
+
+    try:
+        snap = create_db_snapshot()
+    except SnapshotBusy:
+        flash("มีการสร้าง snapshot อื่นอยู่ กรุณาลองใหม่อีกครั้ง", "error")
+    except Exception as e:
+        flash(f"สร้าง snapshot ไม่สำเร็จ: {e}", "error")
+    else:
+        flash(f"สร้าง snapshot {snap['name']} เรียบร้อยแล้ว", "success")
+    return redirect(url_for("admin_backup"))
+
+
+@app.route("/admin/backup/snapshots/<name>")
+def admin_download_snapshot(name):
+    if not admin_required():
+        return redirect(url_for("admin_login"))
+    if not SNAPSHOT_NAME_RE.match(name) and not (
+        name.endswith(".sha256") and SNAPSHOT_NAME_RE.match(name[: -len(".sha256")])
+    ):
+        abort(404)
+    # send_from_directory ส่งไฟล์แบบ stream ทีละส่วน ไม่โหลดทั้งไฟล์เข้าหน่วยความจำ
+    return send_from_directory(SNAPSHOT_DIR, name, as_attachment=True)
+
+
+@app.cli.command("snapshot-db")
+def snapshot_db_command():
+    """สร้าง snapshot ของฐานข้อมูลทันที (ใช้กับ cron ได้)"""
+    try:
+        snap = create_db_snapshot()
+    except SnapshotBusy:
+        raise click.ClickException("มีการสร้าง snapshot อื่นอยู่")
+    click.echo(f"{snap['name']} {snap['size']} bytes sha256={snap['sha256']}")
+
+# ---------- ย้ายทั้งเว็บ: ไฟล์ tar แบบ stream (DB + วิดีโอ + รูปปก) ----------
+# export สร้าง tar ทีละส่วนใน thread แยก ส่งผ่านคิวขนาดจำกัดไปยัง response
+# ใช้หน่วยความจำคงที่ ไฟล์ชั่วคราวมีแค่สำเนา DB (backup API) ซึ่งถูกอ่านเข้า tar ทีละส่วนแล้วลบทิ้ง
+# โครงสร้างในไฟล์: manifest.json, db/videos.db, media/video_files/... และ media/static/covers/...
+# import อ่าน tar แบบ stream ลงโฟลเดอร์พัก ตรวจ DB + manifest แล้วจึงย้ายไฟล์เข้าที่ คืนค่า DB และแก้ path ภายใต้ล็อก
+# ไฟล์สื่อเขียนลงได้เฉพาะใต้ VIDEO_ROOT และ COVER_ROOT
+SITE_ARCHIVE_VERSION = "myseries_site_v1"
+SITE_ARCHIVE_QUEUE_CHUNKS = 16
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+class _QueueWriter:
+    """file object ที่ส่งข้อมูลที่เขียนเข้า queue (บล็อกเมื่อฝั่งอ่านตามไม่ทัน)"""
+
+    def __init__(self, q):
+        self._q = q
+        self.cancelled = False
+
+    def write(self, data):
+        if self.cancelled:
+            raise BrokenPipeError("client disconnected")
+        if data:
+            self._q.put(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def _site_media_roots():
+    """prefix ของไฟล์สื่อใน archive กับโฟลเดอร์จริงที่ prefix นั้นเขียนลงได้ (ไม่มีที่อื่นนอกจากนี้)"""
+    return (("video_files/", VIDEO_ROOT), ("static/covers/", COVER_ROOT))
+
+
+def _local_media_path(path, static=False):
+    """แปลง file_path / thumbnail_url ใน DB เป็น (path เต็ม, path ใน archive) หรือ None
+    path ใน archive เริ่มด้วย video_files/ หรือ static/covers/ เสมอ"""
+    if not path or str(path).startswith(("http://", "https://")):
+        return None
+    if static:
+        full = os.path.join(BASE_DIR, "static", path)
+    else:
+        full = path if os.path.isabs(path) else os.path.join(BASE_DIR, path)
+    full = os.path.realpath(full)
+    if not os.path.isfile(full):
+        return None
+    prefix = "static/covers/" if static else "video_files/"
+    for root_prefix, root in _site_media_roots():
+        root = os.path.realpath(root)
+        if root_prefix == prefix and full.startswith(root + os.sep):
+            return full, prefix + os.path.relpath(full, root).replace(os.sep, "/")
+    # ไฟล์อยู่นอกโฟลเดอร์สื่อ: เก็บไว้ใต้ external/ โดยนำ hash ของ path ต้นทางมานำหน้า
+    # ไฟล์ชื่อซ้ำจากคนละเรื่อง (เช่น 1.mp4) จึงไม่ทับกัน
+    digest = hashlib.sha1(full.encode("utf-8")).hexdigest()[:12]
+    return full, f"{prefix}external/{digest}_{os.path.basename(full)}"
+
+
+def _site_archive_plan(conn):
+    """รายการไฟล์ที่ต้องใส่ใน archive และการแก้ path ของแต่ละแถว"""
+    files = {}
+    rewrites = []
+    for row in conn.execute("SELECT id, file_path, thumbnail_url FROM episodes"):
+        found = _local_media_path(row["file_path"])
+        if found:
+            files[found[1]] = found[0]
+            rewrites.append({"table": "episodes", "column": "file_path", "id": row["id"], "path": found[1]})
+        found = _local_media_path(row["thumbnail_url"], static=True)
+        if found:
+            files[found[1]] = found[0]
+            rewrites.append({"table": "episodes", "column": "thumbnail_url", "id": row["id"], "path": found[1]})
+    for row in conn.execute("SELECT id, thumbnail_url FROM series"):
+        found = _local_media_path(row["thumbnail_url"], static=True)
+        if found:
+            files[found[1]] = found[0]
+            rewrites.append({"table": "series", "column": "thumbnail_url", "id": row["id"], "path": found[1]})
+    return files, rewrites
+
+
+@contextmanager
+def _site_db_snapshot():
+    """สำเนา DB ผ่าน backup API ลงไฟล์ชั่วคราว คืน path ของไฟล์ (ลบทิ้งเมื่อออกจาก with)"""
+    fd, path = tempfile.mkstemp(prefix=".site-export-", suffix=".db", dir=BASE_DIR)
+    os.close(fd)
+    try:
+        src = sqlite3.connect(DB_PATH)
+        dst = sqlite3.connect(path)
+        try:
+            _backup_in_steps(src, dst)
+        finally:
+            dst.close()
+            src.close()
+        yield path
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _write_site_archive(out, compression):
+    conn = get_db_connection()
+    try:
+        files, rewrites = _site_archive_plan(conn)
+    finally:
+        conn.close()
+
+    if compression == "zstd":
+        compressor = zstandard.ZstdCompressor(level=3).stream_writer(out, closefd=False)
+        tar = tarfile.open(fileobj=compressor, mode="w|", format=tarfile.PAX_FORMAT)
+    else:
+        compressor = None
+        tar = tarfile.open(fileobj=out, mode="w|gz", format=tarfile.PAX_FORMAT)
+
+    def add_bytes(name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        tar.addfile(info, BytesIO(data))
+
+    with tar:
+        manifest = {
+            "version": SITE_ARCHIVE_VERSION,
+            "exported_at": datetime.utcnow().isoformat(),
+            "files": sorted(files),
+            "rewrites": rewrites,
+        }
+        add_bytes("manifest.json", json.dumps(manifest, ensure_ascii=False).encode("utf-8"))
+        with _site_db_snapshot() as db_path, open(db_path, "rb") as db_file:
+            info = tar.gettarinfo(fileobj=db_file, arcname="db/videos.db")
+            tar.addfile(info, db_file)
+        for rel, full in sorted(files.items()):
+            try:
+                # addfile อ่านไฟล์ทีละ bufsize ข้อมูลจึงไหลออกไปทีละส่วน
+                tar.add(full, arcname="media/" + rel, recursive=False)
+            except FileNotFoundError:
+                continue
+    if compressor is not None:
+        compressor.close()
+
+
+def stream_site_archive(compression="gzip"):
+    """generator ที่คืนไฟล์ tar ทีละส่วน"""
+    q = queue.Queue(maxsize=SITE_ARCHIVE_QUEUE_CHUNKS)
+    writer = _QueueWriter(q)
+    done = object()
+    errors = []
+
+    def produce():
+        try:
+            _write_site_archive(writer, compression)
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            q.put(done)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = q.get()
+            if item is done:
+                break
+            yield item
+        if errors and not isinstance(errors[0], BrokenPipeError):
+            raise errors[0]
+    finally:
+        # ผู้ใช้ยกเลิกดาวน์โหลด: ให้ thread ผลิตหยุด และระบายคิวเพื่อไม่ให้ค้าง
+        writer.cancelled = True
+        while thread.is_alive():
+            try:
+                q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+class _PrefixedStream:
+    """stream ที่อ่านข้อมูลส่วนหัวที่ peek ไปแล้วก่อน แล้วต่อด้วย stream เดิม"""
+
+    def __init__(self, prefix, stream):
+        self._prefix = prefix
+        self._stream = stream
+
+    def read(self, size=-1):
+        if self._prefix:
+            if size is None or size < 0:
+                data, self._prefix = self._prefix + self._stream.read(), b""
+                return data
+            data, self._prefix = self._prefix[:size], self._prefix[size:]
+            if len(data) < size:
+                data += self._stream.read(size - len(data))
+            return data
+        return self._stream.read(size)
+
+
+def _open_site_archive(stream):
+    head = stream.read(4)
+    stream = _PrefixedStream(head, stream)
+    if head == _ZSTD_MAGIC:
+        if zstandard is None:
+            raise ValueError("ไฟล์บีบอัดแบบ zstd แต่เครื่องนี้ไม่ได้ติดตั้ง zstandard")
+        stream = zstandard.ZstdDecompressor().stream_reader(stream)
+        return tarfile.open(fileobj=stream, mode="r|")
+    return tarfile.open(fileobj=stream, mode="r|*")
+
+
+def _safe_archive_target(rel):
+    """path จริงของไฟล์สื่อใน archive ต้องอยู่ใต้ VIDEO_ROOT หรือ COVER_ROOT เท่านั้น
+    (ตรวจด้วย realpath จึงออกนอกโฟลเดอร์ผ่าน .. หรือ symlink ไม่ได้)"""
+    for prefix, root in _site_media_roots():
+        if rel.startswith(prefix):
+            root = os.path.realpath(root)
+            target = os.path.realpath(os.path.join(root, rel[len(prefix):]))
+            if target.startswith(root + os.sep):
+                return target
+            break
+    raise ValueError(f"path ในไฟล์ไม่ปลอดภัย: {rel}")
+
+
+def _site_rewrite_value(column, rel):
+    """ค่าที่จะเขียนลงคอลัมน์สำหรับไฟล์ rel ใน archive (file_path เทียบ BASE_DIR, thumbnail_url เทียบ static)"""
+    target = _safe_archive_target(rel)
+    if column == "thumbnail_url":
+        return "covers/" + os.path.relpath(target, os.path.realpath(COVER_ROOT)).replace(os.sep, "/")
+    base = os.path.realpath(BASE_DIR)
+    if target.startswith(base + os.sep):
+        return os.path.relpath(target, base)
+    return target
+
+
+_SITE_REWRITE_COLUMNS = {("episodes", "file_path"), ("episodes", "thumbnail_url"), ("series", "thumbnail_url")}
+
+
+def _validate_site_import(manifest, db_path, staged):
+    """ตรวจ DB และ manifest ก่อนแตะของจริง: integrity_check ผ่าน มีตารางหลัก
+    และทุกไฟล์ / rewrite ต้องอยู่ในรายการของ manifest"""
+    listed = manifest.get("files")
+    rewrites = manifest.get("rewrites")
+    if not isinstance(listed, list) or not isinstance(rewrites, list):
+        raise ValueError("manifest ไม่ถูกต้อง")
+    listed = set(listed)
+    extra = set(staged) - listed
+    if extra:
+        raise ValueError(f"ไฟล์ไม่อยู่ใน manifest: {sorted(extra)[0]}")
+    for rw in rewrites:
+        if (
+            not isinstance(rw, dict)
+            or (rw.get("table"), rw.get("column")) not in _SITE_REWRITE_COLUMNS
+            or not isinstance(rw.get("id"), int)
+            or rw.get("path") not in listed
+        ):
+            raise ValueError("manifest ไม่ถูกต้อง (rewrites)")
+        # file_path ต้องชี้เข้า video_files/ ส่วนรูปปกต้องอยู่ใต้ static/covers/
+        expected = "static/covers/" if rw["column"] == "thumbnail_url" else "video_files/"
+        if not rw["path"].startswith(expected):
+            raise ValueError(f"path ในไฟล์ไม่ปลอดภัย: {rw['path']}")
+        _safe_archive_target(rw["path"])
+
+    conn = sqlite3.connect(db_path)
+    try:
+        check = conn.execute("PRAGMA integrity_check").fetchone()[0]
+        if check != "ok":
+            raise ValueError(f"ฐานข้อมูลในไฟล์เสีย: {check}")
+        tables = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    finally:
+        conn.close()
+    if not {"series", "episodes"} <= tables:
+        raise ValueError("ฐานข้อมูลในไฟล์ไม่มีตาราง series / episodes")
+
+
+@contextmanager
+def _site_publish_lock():
+    """กันไม่ให้ snapshot หรือการนำเข้าอื่นทำงานซ้อนระหว่างเขียนทับ DB
+    ใช้ _snapshot_lock ใน process และ flock บนไฟล์ .lock เดียวกับ create_db_snapshot ข้าม worker"""
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    with _snapshot_lock:
+        with open(os.path.join(SNAPSHOT_DIR, ".lock"), "w") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+
+def import_site_archive(stream):
+    """อ่าน archive แบบ stream ลงโฟลเดอร์พักก่อน ตรวจ DB และ manifest ให้ผ่าน
+    แล้วจึงย้ายไฟล์สื่อเข้าที่ คืนค่า DB และแก้ path ตาม manifest ภายใต้ล็อก
+    คืน dict จำนวนไฟล์และแถวที่แก้"""
+    manifest = None
+    # โฟลเดอร์พักอยู่ใน BASE_DIR (ระบบไฟล์เดียวกัน) os.replace ตอนย้ายเข้าที่จึงไม่ต้องคัดลอกซ้ำ
+    staging = tempfile.mkdtemp(prefix=".site-import-", dir=BASE_DIR)
+    db_tmp = os.path.join(staging, "videos.db")
+    have_db = False
+    staged = {}
+    try:
+        with _open_site_archive(stream) as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                name = member.name
+                if name == "manifest.json":
+                    manifest = json.loads(tar.extractfile(member).read().decode("utf-8"))
+                    if not isinstance(manifest, dict) or manifest.get("version") != SITE_ARCHIVE_VERSION:
+                        raise ValueError("ไม่ใช่ไฟล์ย้ายเว็บของระบบนี้")
+                    continue
+                if manifest is None:
+                    raise ValueError("ไม่พบ manifest.json ที่ต้นไฟล์")
+
+                if name == "db/videos.db":
+                    target = db_tmp
+                    have_db = True
+                elif name.startswith("media/"):
+                    rel = name[len("media/"):]
+                    _safe_archive_target(rel)
+                    target = os.path.join(staging, "media", str(len(staged)))
+                    staged[rel] = target
+                else:
+                    continue
+
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                src = tar.extractfile(member)
+                with open(target, "wb") as f:
+                    while True:
+                        chunk = src.read(1024 * 1024)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+
+        if manifest is None or not have_db:
+            raise ValueError("ไฟล์ไม่ครบ (ไม่มี manifest หรือฐานข้อมูล)")
+        _validate_site_import(manifest, db_tmp, staged)
+
+        with _site_publish_lock():
+            # ย้ายไฟล์สื่อก่อน ถ้าคืนค่า DB ไม่สำเร็จจะเหลือแค่ไฟล์เกิน ไม่มีแถวที่ชี้ไปยังไฟล์ที่ไม่มี
+            for rel, path in staged.items():
+                target = _safe_archive_target(rel)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(path, target)
+
+            live = get_db_connection()
+            try:
+                before = {
+                    r["key"]: r["value"]
+                    for r in live.execute(
+                        "SELECT key, value FROM app_state WHERE key IN ('catalog_version', 'visibility_generation')"
+                    )
+                }
+                imported = sqlite3.connect(db_tmp)
+                try:
+                    # เขียนทับ DB ปัจจุบันผ่าน backup API (worker อื่นเห็นข้อมูลใหม่ผ่าน locking ปกติของ SQLite)
+                    imported.backup(live)
+                finally:
+                    imported.close()
+            finally:
+                live.close()
+
+            # DB ที่นำเข้าอาจมาจากเวอร์ชันเก่า เติม schema ให้ครบก่อนแก้ข้อมูล
+            init_db()
+            conn = get_db_connection()
+            try:
+                updated = 0
+                for table, column in (("episodes", "file_path"), ("episodes", "thumbnail_url"), ("series", "thumbnail_url")):
+                    params = []
+                    for rw in manifest["rewrites"]:
+                        if rw["table"] != table or rw["column"] != column:
+                            continue
+                        params.append((_site_rewrite_value(column, rw["path"]), rw["id"]))
+                    if params:
+                        updated += conn.executemany(
+                            f"UPDATE {table} SET {column} = ? WHERE id = ? AND {column} IS NOT ?",
+                            [(path, row_id, path) for path, row_id in params],
+                        ).rowcount
+                # เลขเวอร์ชันต้องใหม่กว่าที่ worker ใด ๆ เคยแคชไว้ แคชทุกตัวจึงโหลดใหม่
+                for key in ("catalog_version", "visibility_generation"):
+                    conn.execute(
+                        "UPDATE app_state SET value = MAX(value, ?) + 1 WHERE key = ?",
+                        (int(before.get(key, 0)), key),
+                    )
+                conn.commit()
+            finally:
+                conn.close()
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    invalidate_catalog_version_cache()
+    _visibility_generation_cache["value"] = None
+    return {"media_files": len(staged), "paths_rewritten": updated}
+
+
+@app.route("/admin/backup/site")
+def admin_backup_download_site():
+    if not admin_required():
+        return redirect(url_for("admin_login"))
+
+    compression = request.args.get("compression", "gzip")
+    if compression == "zstd" and zstandard is not None:
+        ext = "tar.zst"
+    else:
+        compression, ext = "gzip", "tar.gz"
+    filename = f"site-{datetime.now().strftime('%Y%m%d')}.{ext}"
+    response = Response(
+        stream_site_archive(compression),
+        mimetype="application/zstd" if compression == "zstd" else "application/gzip",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+    return response
+
+
+@app.route("/admin/backup/site", methods=["POST"])
+def admin_backup_import_site():
+    if not admin_required():
+        return redirect(url_for("admin_login"))
+
+    # ส่งไฟล์ตรง ๆ เป็น body (curl -T) จะอ่านแบบ stream ไม่ต้องพักไฟล์
+    # ถ้ามาจากฟอร์มจะใช้ไฟล์ที่ werkzeug รับไว้
+    if request.mimetype == "multipart/form-data":
+        upload = request.files.get("site_archive")
+        if not upload or not upload.filename:
+            flash("กรุณาเลือกไฟล์ย้ายเว็บ (.tar.gz หรือ .tar.zst)", "error")
+            return redirect(url_for("admin_backup"))
+        stream = upload.stream
+    else:
+        stream = request.stream
+
+    try:
+        result = import_site_archive(stream)
+    except (ValueError, tarfile.TarError, sqlite3.DatabaseError) as e:
+        if request.mimetype != "multipart/form-data":
+            return api_json({"error": str(e)}, status=400)
+        flash(f"นำเข้าไม่สำเร็จ: {e}", "error")
+        return redirect(url_for("admin_backup"))
+
+    if request.mimetype != "multipart/form-data":
+        return api_json(result)
+    flash(
+        f"นำเข้าทั้งเว็บเรียบร้อยแล้ว (ไฟล์ {result['media_files']} ไฟล์, แก้ path {result['paths_rewritten']} รายการ)",
+        "success",
+    )
+    return redirect(url_for("admin_backup"))
+
+
+@app.cli.command("export-site")
+@click.argument("output", type=click.Path(dir_okay=False, allow_dash=True))
+@click.option("--zstd", "use_zstd", is_flag=True, help="บีบอัดแบบ zstd แทน gzip")
+def export_site_command(output, use_zstd):
+    """เขียนไฟล์ย้ายเว็บทั้งหมดไปที่ OUTPUT (ใช้ - เพื่อส่งออก stdout)"""
+    if use_zstd and zstandard is None:
+        raise click.ClickException("ยังไม่ได้ติดตั้ง zstandard")
+    with click.open_file(output, "wb") as f:
+        _write_site_archive(f, "zstd" if use_zstd else "gzip")
+
+
+@app.cli.command("import-site")
+@click.argument("archive", type=click.Path(exists=True, dir_okay=False, allow_dash=True))
+def import_site_command(archive):
+    """นำเข้าไฟล์ย้ายเว็บ (ใช้ - เพื่ออ่านจาก stdin)"""
+    with click.open_file(archive, "rb") as f:
+        result = import_site_archive(f)
+    click.echo(f"ไฟล์ {result['media_files']} ไฟล์, แก้ path {result['paths_rewritten']} รายการ")
+
+# ---------- เก็บกวาดประวัติการดูเก่า (retention) ----------
+# แถวที่เก่ากว่า HISTORY_RETENTION_DAYS วันจะถูกย้ายออกจาก watch_history ทีละ HISTORY_RETENTION_BATCH แถว
+# HISTORY_ARCHIVE_MODE=archive  ย้ายไปตารางใน HISTORY_ARCHIVE_DB (ATTACH) เก็บครบทุกแถว
+# HISTORY_ARCHIVE_MODE=rollup   รวมเป็นยอดดูต่อวันใน watch_history_daily แล้วลบแถวเดิม
+# แต่ละชุดเป็น transaction สั้น ๆ (BEGIN IMMEDIATE) และพักระหว่างชุด หลายคนรันพร้อมกันก็ไม่นับซ้ำ
+# จากนั้นคืนพื้นที่ว่างให้ระบบไฟล์ด้วย incremental_vacuum (DB เดิมต้องแปลงครั้งเดียวด้วย flask vacuum-db --convert)
+# ตาราง "ดูต่อ" (series_watch_rollup) ไม่ถูกแตะ ผู้ใช้จึงยังเห็นเรื่องที่ดูค้างไว้ตามเดิม
+HISTORY_RETENTION_DAYS = int(os.getenv("HISTORY_RETENTION_DAYS", "0"))
+HISTORY_ARCHIVE_MODE = os.getenv("HISTORY_ARCHIVE_MODE", "archive")
+HISTORY_ARCHIVE_DB = os.getenv("HISTORY_ARCHIVE_DB", os.path.join(BASE_DIR, "history_archive.db"))
+HISTORY_RETENTION_BATCH = int(os.getenv("HISTORY_RETENTION_BATCH", "500"))
+HISTORY_RETENTION_SLEEP = float(os.getenv("HISTORY_RETENTION_SLEEP", "0.05"))
+HISTORY_RETENTION_INTERVAL_HOURS = float(os.getenv("HISTORY_RETENTION_INTERVAL_HOURS", "24"))
+VACUUM_STEP_PAGES = int(os.getenv("VACUUM_STEP_PAGES", "1000"))
+
+_history_retention_started = False
+_history_retention_lock = threading.Lock()
+
+
+def _attach_history_archive(conn):
+    conn.execute("ATTACH DATABASE ? AS archive", (HISTORY_ARCHIVE_DB,))
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS archive.watch_history_archive (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            series_id INTEGER NOT NULL,
+            episode_id INTEGER NOT NULL,
+            watched_at TEXT NOT NULL
+        )
+        """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS archive.idx_archive_user ON watch_history_archive (user_id, id)"
+    )
+    conn.commit()
+
+
+def incremental_vacuum(conn, max_pages=None):
+    """คืนหน้าว่างของไฟล์ DB ทีละ VACUUM_STEP_PAGES หน้า คืนค่าจำนวนหน้าที่คืน
+    คืน None ถ้า DB ยังไม่ได้ตั้ง auto_vacuum=INCREMENTAL (ต้องแปลงด้วย flask vacuum-db --convert ก่อน
+    เพราะการแปลงคือ VACUUM เต็มไฟล์ซึ่งล็อก DB นาน ไม่ควรเกิดเองใน thread หรือใน request)"""
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        app.logger.warning(
+            "ข้าม incremental_vacuum: DB ยังไม่ได้ตั้ง auto_vacuum=INCREMENTAL (รัน flask vacuum-db --convert)"
+        )
+        return None
+
+    freed = 0
+    while True:
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if free <= 0 or (max_pages is not None and freed >= max_pages):
+            break
+        step = min(free, VACUUM_STEP_PAGES)
+        conn.execute(f"PRAGMA incremental_vacuum({int(step)})").fetchall()
+        conn.commit()
+        freed += step
+        time.sleep(HISTORY_RETENTION_SLEEP)
+    return freed
+
+
+def prune_watch_history(days=None, mode=None, batch=None):
+    """ย้าย/สรุปประวัติที่เก่ากว่า days วัน คืน dict จำนวนแถวที่ย้ายและหน้าที่คืน"""
+    days = HISTORY_RETENTION_DAYS if days is None else days
+    mode = mode or HISTORY_ARCHIVE_MODE
+    batch = max(1, batch or HISTORY_RETENTION_BATCH)
+    if days <= 0:
+        return {"moved": 0, "pages_freed": 0, "vacuum_skipped": False}
+    if mode not in ("archive", "rollup"):
+        raise ValueError(mode)
+
+    cutoff = (datetime.utcnow() - timedelta(days=days)).isoformat()
+    conn = get_db_connection()
+    moved = 0
+    try:
+        if mode == "archive":
+            # ATTACH ทำใน transaction ไม่ได้ จึงต่อไว้ก่อนเริ่มชุดแรก
+            _attach_history_archive(conn)
+        while True:
+            conn.execute("BEGIN IMMEDIATE")
+            ids = [
+                r[0]
+                for r in conn.execute(
+                    "SELECT id FROM watch_history WHERE watched_at < ? ORDER BY watched_at LIMIT ?",
+                    (cutoff, batch),
+                )
+            ]
+            if not ids:
+                conn.rollback()
+                break
+            marks = ",".join("?" * len(ids))
+            if mode == "archive":
+                conn.execute(
+                    f"""
+                    INSERT OR IGNORE INTO archive.watch_history_archive (id, user_id, series_id, episode_id, watched_at)
+                    SELECT id, user_id, series_id, episode_id, watched_at FROM watch_history WHERE id IN ({marks})
+                    """,
+                    ids,
+                )
+            else:
+                conn.execute(
+                    f"""
+                    INSERT INTO watch_history_daily (day, user_id, series_id, episode_id, view_count)
+                    SELECT substr(watched_at, 1, 10), user_id, series_id, episode_id, COUNT(*)
+                    FROM watch_history WHERE id IN ({marks})
+                    GROUP BY 1, 2, 3, 4
+                    ON CONFLICT(day, user_id, series_id, episode_id) DO UPDATE SET
+                        view_count = view_count + excluded.view_count
+                    """,
+                    ids,
+                )
+            # แถวที่ย้ายออกไม่ใช่การลบของผู้ใช้ ไม่ต้องให้ delta ส่งไปลบตอนคืนค่า
+            # ลบ changelog ที่ trigger เพิ่งจดใน transaction เดียวกัน (BEGIN IMMEDIATE จึงไม่มีใครเขียนแทรก)
+            seq_before = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM backup_changelog").fetchone()[0]
+            conn.execute(f"DELETE FROM watch_history WHERE id IN ({marks})", ids)
+            conn.execute(
+                "DELETE FROM backup_changelog WHERE seq > ? AND table_name = 'watch_history'", (seq_before,)
+            )
+            conn.commit()
+            moved += len(ids)
+            if len(ids) < batch:
+                break
+            time.sleep(HISTORY_RETENTION_SLEEP)
+
+        pages = incremental_vacuum(conn)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return {"moved": moved, "pages_freed": pages or 0, "vacuum_skipped": pages is None}
+
+
+def _history_retention_loop():
+    while True:
+        try:
+            prune_watch_history()
+        except Exception:
+            pass
+        time.sleep(max(HISTORY_RETENTION_INTERVAL_HOURS, 0.1) * 3600)
+
+
+@app.before_request
+def _start_history_retention():
+    # เริ่ม thread ตอนมีคำขอแรก (หลัง gunicorn fork แล้ว) เฉพาะเมื่อตั้ง HISTORY_RETENTION_DAYS
+    global _history_retention_started
+    if _history_retention_started or HISTORY_RETENTION_DAYS <= 0:
+        return None
+    with _history_retention_lock:
+        if _history_retention_started:
+            return None
+        _history_retention_started = True
+    threading.Thread(target=_history_retention_loop, daemon=True).start()
+    return None
+
+
+@app.route("/admin/history/retention", methods=["POST"])
+def admin_history_retention():
+    if not admin_required():
+        return redirect(url_for("admin_login"))
+
+    days = request.form.get("days", type=int)
+    try:
+        result = prune_watch_history(days=days)
+    except (ValueError, sqlite3.Error) as e:
+        return api_json({"error": str(e)}, status=400)
+    return api_json(result)
+
+
+@app.cli.command("prune-history")
+@click.option("--days", type=int, default=None, help="เก็บไว้กี่วัน (ค่าเริ่มต้น HISTORY_RETENTION_DAYS)")
+@click.option("--mode", type=click.Choice(["archive", "rollup"]), default=None)
+def prune_history_command(days, mode):
+    """ย้ายประวัติการดูเก่าออกจาก watch_history แล้วคืนพื้นที่ไฟล์ DB"""
+    result = prune_watch_history(days=days, mode=mode)
+    click.echo(f"ย้าย {result['moved']} แถว, คืนพื้นที่ {result['pages_freed']} หน้า")
+    if result["vacuum_skipped"]:
+        click.echo("ไม่ได้คืนพื้นที่: DB ยังไม่ได้ตั้ง auto_vacuum=INCREMENTAL ให้รัน flask vacuum-db --convert")
+
+
+@app.cli.command("vacuum-db")
+@click.option("--convert", is_flag=True, help="แปลง DB เป็น auto_vacuum=INCREMENTAL ด้วย VACUUM เต็มไฟล์ (ครั้งเดียว)")
+def vacuum_db_command(convert):
+    """คืนหน้าว่างของไฟล์ DB ให้ระบบไฟล์"""
+    conn = get_db_connection()
+    try:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            if not convert:
+                raise click.ClickException("DB ยังไม่ได้ตั้ง auto_vacuum=INCREMENTAL ใช้ --convert เพื่อแปลง (ล็อก DB ระหว่าง VACUUM)")
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+            click.echo("แปลงเป็น auto_vacuum=INCREMENTAL แล้ว")
+            return
+        click.echo(f"คืนพื้นที่ {incremental_vacuum(conn)} หน้า")
+    finally:
+        conn.close()
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port, debug=True)
\ No newline at end of file
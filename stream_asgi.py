@@ -0,0 +1,284 @@
+"""
+โหมดสตรีมวิดีโอแบบ async (ASGI) สำหรับ /stream/<episode_id>
+
+worker ของ gunicorn แบบ sync หนึ่งตัวถูกจองตลอดเวลาที่มีคนดูวิดีโอหนึ่งคน
+โมดูลนี้ให้ process เดียวรับคนดูพร้อมกันได้เป็นพัน ๆ คน โดยอ่านไฟล์ผ่าน thread pool
+ไม่บล็อก event loop (งานหาไฟล์ / โหลดจาก Drive ใช้ pool แยกขนาด STREAM_RESOLVE_WORKERS)
+และส่งข้อมูลทีละชิ้นด้วย await send(...) ซึ่งเซิร์ฟเวอร์ ASGI
+จะรอจนฝั่ง client รับข้อมูลทันก่อน (backpressure) หน่วยความจำต่อคนจึงคงที่
+
+การตรวจสอบสิทธิ์และการหาไฟล์ใช้ logic เดียวกับ Flask (resolve_episode_stream)
+และอ่าน session cookie ของ Flask โดยตรง ผู้ใช้จึงไม่ต้องล็อกอินใหม่
+
+วิธีใช้ (ตัวอย่าง):
+    uvicorn stream_asgi:app --host 127.0.0.1 --port 5001
+แล้วตั้ง reverse proxy ให้ส่ง /stream/ มาที่พอร์ตนี้
+ส่วนหน้าอื่น ๆ ยังไปที่ gunicorn app:app ตามเดิม
+"""
+
+import asyncio
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from http.cookies import SimpleCookie
+from urllib.parse import quote, parse_qs
+
+import requests
+from itsdangerous import BadSignature
+
+from app import (
+    app as flask_app,
+    resolve_episode_stream,
+    parse_range_header,
+    _proxy_meta,
+    _proxy_open_chunk,
+    video_offload_headers,
+    verify_stream_token,
+    check_rate_limit,
+    client_ip,
+    touch_video_file,
+    PROXY_CHUNK_SIZE,
+)
+
+STREAM_READ_SIZE = int(os.getenv("STREAM_READ_KB", "256")) * 1024
+STREAM_PATH_RE = re.compile(r"^/stream/(\d+)$")
+# resolve_episode_stream อาจโหลดไฟล์จาก Drive ทั้งไฟล์ (หลายนาที) จึงมี thread pool แยกของตัวเอง
+# ไม่ใช้ pool กลางของ asyncio.to_thread ที่ทุกคนดูใช้อ่านไฟล์ ตอนที่ Drive ช้าการเล่นของคนอื่นจึงไม่ค้าง
+STREAM_RESOLVE_WORKERS = int(os.getenv("STREAM_RESOLVE_WORKERS", "4"))
+_resolve_executor = ThreadPoolExecutor(max_workers=STREAM_RESOLVE_WORKERS, thread_name_prefix="stream-resolve")
+
+
+def _load_session(headers) -> dict:
+    """ถอดรหัส session cookie ของ Flask (ใช้ SECRET_KEY เดียวกัน)"""
+    cookie_name = flask_app.config["SESSION_COOKIE_NAME"]
+    raw = b"; ".join(v for k, v in headers if k == b"cookie").decode("latin-1")
+    if not raw:
+        return {}
+    cookie = SimpleCookie()
+    try:
+        cookie.load(raw)
+    except Exception:
+        return {}
+    morsel = cookie.get(cookie_name)
+    if morsel is None:
+        return {}
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    if serializer is None:
+        return {}
+    max_age = int(flask_app.permanent_session_lifetime.total_seconds())
+    try:
+        return serializer.loads(morsel.value, max_age=max_age)
+    except BadSignature:
+        return {}
+
+
+def _header(headers, name: bytes):
+    for k, v in headers:
+        if k == name:
+            return v.decode("latin-1")
+    return None
+
+
+async def _send_simple(send, status, headers=None, body=b""):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(k.encode("latin-1"), v.encode("latin-1")) for k, v in (headers or {}).items()]
+            + [(b"content-length", str(len(body)).encode("latin-1"))],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+class _Disconnect:
+    """คอยฟัง http.disconnect เพื่อหยุดอ่านไฟล์ทันทีเมื่อผู้ชมปิดหน้า"""
+
+    def __init__(self, receive):
+        self.closed = False
+        self._task = asyncio.ensure_future(self._watch(receive))
+
+    async def _watch(self, receive):
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                self.closed = True
+                return
+
+    def cancel(self):
+        self._task.cancel()
+
+
+def _range_headers(start, end, total, partial, content_type):
+    headers = {
+        "content-type": content_type,
+        "accept-ranges": "bytes",
+        "content-length": str(end - start + 1),
+    }
+    if partial:
+        headers["content-range"] = f"bytes {start}-{end}/{total}"
+    return headers
+
+
+async def _start(send, status, headers):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(k.encode("latin-1"), v.encode("latin-1")) for k, v in headers.items()],
+        }
+    )
+
+
+async def _stream_file(send, receive, path, range_header, head_only):
+    total = await asyncio.to_thread(os.path.getsize, path)
+    try:
+        byte_range = parse_range_header(range_header, total)
+    except ValueError:
+        await _send_simple(send, 416, {"content-range": f"bytes */{total}"})
+        return
+    start, end = byte_range if byte_range else (0, total - 1)
+    await _start(send, 206 if byte_range else 200, _range_headers(start, end, total, bool(byte_range), "video/mp4"))
+    if head_only or total == 0:
+        await send({"type": "http.response.body", "body": b""})
+        return
+
+    watcher = _Disconnect(receive)
+    f = await asyncio.to_thread(open, path, "rb")
+    try:
+        await asyncio.to_thread(f.seek, start)
+        remaining = end - start + 1
+        while remaining > 0 and not watcher.closed:
+            chunk = await asyncio.to_thread(f.read, min(STREAM_READ_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+    finally:
+        watcher.cancel()
+        await asyncio.to_thread(f.close)
+
+
+async def _stream_proxy(send, receive, video_url, range_header, head_only):
+    try:
+        meta = await asyncio.to_thread(_proxy_meta, video_url)
+    except requests.RequestException:
+        meta = None
+    if meta is None:
+        # เหมือน proxy_direct_response: ต้นทางไม่รองรับ Range หรือติดต่อไม่ได้ ส่งไปที่ต้นทางตรง ๆ
+        await _send_simple(send, 302, {"location": video_url})
+        return
+    total = meta["size"]
+    try:
+        byte_range = parse_range_header(range_header, total)
+    except ValueError:
+        await _send_simple(send, 416, {"content-range": f"bytes */{total}"})
+        return
+    start, end = byte_range if byte_range else (0, total - 1)
+    content_type = meta.get("content_type") or "video/mp4"
+    await _start(send, 206 if byte_range else 200, _range_headers(start, end, total, bool(byte_range), content_type))
+    if head_only:
+        await send({"type": "http.response.body", "body": b""})
+        return
+
+    watcher = _Disconnect(receive)
+    pos = start
+    try:
+        while pos <= end and not watcher.closed:
+            index = pos // PROXY_CHUNK_SIZE
+            chunk_end = min((index + 1) * PROXY_CHUNK_SIZE, end + 1)
+            f = await asyncio.to_thread(_proxy_open_chunk, video_url, index, total)
+            try:
+                await asyncio.to_thread(f.seek, pos - index * PROXY_CHUNK_SIZE)
+                while pos < chunk_end and not watcher.closed:
+                    piece = await asyncio.to_thread(f.read, min(STREAM_READ_SIZE, chunk_end - pos))
+                    if not piece:
+                        raise RuntimeError("chunk ในแคชไม่ครบ")
+                    pos += len(piece)
+                    await send({"type": "http.response.body", "body": piece, "more_body": pos <= end})
+            finally:
+                await asyncio.to_thread(f.close)
+    except (requests.RequestException, RuntimeError, OSError) as e:
+        # ส่ง header ไปแล้ว เปลี่ยนสถานะไม่ได้: จบ body ตรงนี้ (สั้นกว่า content-length
+        # เซิร์ฟเวอร์จะปิดการเชื่อมต่อ) ตัวเล่นจะขอช่วงที่ขาดใหม่เอง
+        flask_app.logger.warning("proxy %s: หยุดส่งที่ไบต์ %d: %s", video_url, pos, e)
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        watcher.cancel()
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    if scope["type"] != "http":
+        return
+
+    match = STREAM_PATH_RE.match(scope["path"])
+    if not match:
+        await _send_simple(send, 404)
+        return
+    if scope["method"] not in ("GET", "HEAD"):
+        await _send_simple(send, 405, {"allow": "GET, HEAD"})
+        return
+
+    headers = scope["headers"]
+    session = _load_session(headers)
+    if not session.get("user_id"):
+        # เหมือน user_login_required: ส่งไปหน้าเข้าสู่ระบบ
+        await _send_simple(send, 302, {"location": "/login?next=" + quote(scope["path"])})
+        return
+
+    client = scope.get("client") or ("-", 0)
+    # backend sqlite ต้องเขียน DB (อาจรอ lock) จึงรันใน thread ไม่ให้บล็อก event loop
+    wait = await asyncio.to_thread(
+        check_rate_limit,
+        "stream_episode",
+        scope["method"],
+        client_ip(lambda name: _header(headers, name.lower().encode("latin-1")), client[0]),
+        session.get("user_id"),
+    )
+    if wait is not None:
+        await _send_simple(send, 429, {"retry-after": str(max(1, int(wait + 0.999)))})
+        return
+
+    episode_id = int(match.group(1))
+    range_header = _header(headers, b"range")
+    head_only = scope["method"] == "HEAD"
+
+    # ทางลัด: stream token ที่ยังใช้ได้ ไม่ต้อง query DB
+    query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    token = (query.get("t") or [None])[0]
+    # verify อาจต้องโหลดแคตตาล็อกใหม่จาก DB เมื่อเวอร์ชันเปลี่ยน จึงรันใน thread เช่นกัน
+    verified = (
+        await asyncio.to_thread(verify_stream_token, token, session.get("user_id"), episode_id) if token else None
+    )
+    if verified is not None and os.path.exists(verified[0]):
+        abs_path, is_gdrive = verified
+        if is_gdrive:
+            touch_video_file(os.path.abspath(abs_path))
+        kind, value = "file", abs_path
+    else:
+        # resolve อาจต้องโหลดไฟล์จาก Drive ใหม่ จึงรันใน pool แยก (_resolve_executor)
+        kind, value = await asyncio.get_running_loop().run_in_executor(
+            _resolve_executor, resolve_episode_stream, episode_id
+        )
+        if kind == "error":
+            await _send_simple(send, value)
+            return
+
+    if kind == "proxy":
+        await _stream_proxy(send, receive, value, range_header, head_only)
+        return
+
+    offload = video_offload_headers(value)
+    if offload is not None:
+        await _send_simple(send, 200, {k.lower(): v for k, v in offload.items()})
+        return
+    await _stream_file(send, receive, value, range_header, head_only)
@@ -0,0 +1,122 @@
+import os
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# app.py สร้าง videos.db ในโฟลเดอร์ปัจจุบันตอน import ให้ไปสร้างในโฟลเดอร์ชั่วคราวแทน
+os.chdir(tempfile.mkdtemp(prefix="free-video-tests-"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as app_module  # noqa: E402
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    monkeypatch.setattr(app_module, "VIDEO_ROOT", str(tmp_path / "video_files"))
+    return app_module
+
+
+@pytest.fixture
+def db(app, tmp_path, monkeypatch):
+    """ฐานข้อมูลใหม่ต่อการทดสอบ แคชที่ผูกกับ DB เดิมถูกล้าง"""
+    monkeypatch.setattr(app, "DB_PATH", str(tmp_path / "videos.db"))
+    monkeypatch.setattr(app, "_catalog_snapshot", None)
+    monkeypatch.setattr(app, "_visibility_index", {"generation": None, "series": frozenset(), "episodes": frozenset()})
+    app.init_db()
+    app.invalidate_catalog_version_cache()
+    app._visibility_generation_cache["value"] = None
+    yield app
+    app.invalidate_catalog_version_cache()
+    app._visibility_generation_cache["value"] = None
+
+
+@pytest.fixture
+def seed(db):
+    """สร้างเรื่องหนึ่งเรื่องพร้อมตอนแบบลิงก์ตรง และผู้ใช้หนึ่งคน คืน (series_id, [episode ids], user_id)"""
+    counter = iter(range(1, 1000))
+
+    def make(episodes=3):
+        n = next(counter)
+        conn = db.get_db_connection()
+        series_id = conn.execute(
+            "INSERT INTO series (title, created_at) VALUES (?, '2024-01-01')", (f"series {n}",)
+        ).lastrowid
+        episode_ids = [
+            conn.execute(
+                """
+                INSERT INTO episodes (series_id, title, episode_number, source_type, video_url, created_at)
+                VALUES (?, ?, ?, 'direct', ?, '2024-01-01')
+                """,
+                (series_id, f"ep {i}", i, f"http://example.invalid/{n}/{i}.mp4"),
+            ).lastrowid
+            for i in range(1, episodes + 1)
+        ]
+        user_id = conn.execute(
+            "INSERT INTO users (username, password, created_at) VALUES (?, 'x', '2024-01-01')", (f"user{n}",)
+        ).lastrowid
+        conn.commit()
+        conn.close()
+        return series_id, episode_ids, user_id
+
+    return make
+
+
+class StubServer:
+    """HTTP server ในเครื่องสำหรับจำลองต้นทาง
+    handler(request) คืน (status, headers, body) หรือเรียก request.cut(...) เพื่อตัดการเชื่อมต่อกลางทาง"""
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                stub.requests.append({"path": self.path, "range": self.headers.get("Range")})
+                status, headers, body = stub.handler(self)
+                if status is None:
+                    return
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def cut(self, status, headers, body):
+                """ส่ง header ครบแต่ส่ง body แค่บางส่วนแล้วตัดการเชื่อมต่อ"""
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+                self.wfile.flush()
+                self.connection.shutdown(2)
+                return None, None, None
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub_server():
+    servers = []
+
+    def start(handler):
+        server = StubServer(handler)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.close()
@@ -0,0 +1,107 @@
+import io
+import json
+
+import pytest
+
+
+@pytest.fixture
+def admin(db):
+    client = db.app.test_client()
+    with client.session_transaction() as sess:
+        sess["is_admin"] = True
+    return client
+
+
+def execute(db, sql, params=()):
+    conn = db.get_db_connection()
+    lastrowid = conn.execute(sql, params).lastrowid
+    conn.commit()
+    conn.close()
+    return lastrowid
+
+
+def watch(db, user_id, series_id, episode_id, when):
+    return execute(
+        db,
+        "INSERT INTO watch_history (user_id, series_id, episode_id, watched_at) VALUES (?, ?, ?, ?)",
+        (user_id, series_id, episode_id, when),
+    )
+
+
+def snapshot(db):
+    conn = db.get_db_connection()
+    users = [tuple(r) for r in conn.execute("SELECT id, username, password, created_at FROM users ORDER BY id")]
+    history = [
+        tuple(r)
+        for r in conn.execute("SELECT id, user_id, series_id, episode_id, watched_at FROM watch_history ORDER BY id")
+    ]
+    conn.close()
+    return users, history
+
+
+def download(client, url):
+    resp = client.get(url)
+    assert resp.status_code == 200
+    return resp.get_json()
+
+
+def confirm(client, data):
+    resp = client.post("/admin/backup/users/delta/confirm", data={"manifest_id": data["manifest"]["id"]})
+    assert resp.status_code == 302
+    with client.session_transaction() as sess:
+        assert not [m for cat, m in sess.pop("_flashes", []) if cat == "error"]
+
+
+def restore(client, *files):
+    data = {
+        "restore_mode": "replace",
+        "backup_file": [(io.BytesIO(json.dumps(f).encode("utf-8")), f"{i}.json") for i, f in enumerate(files)],
+    }
+    client.post("/admin/backup", data=data, content_type="multipart/form-data")
+    with client.session_transaction() as sess:
+        return sess.pop("_flashes", [])
+
+
+@pytest.fixture
+def chain(db, seed, admin):
+    """ไฟล์แบบเต็มหนึ่งไฟล์กับ delta ที่ยืนยันแล้วสองไฟล์ คืน (base, delta1, delta2, สถานะตอนออก delta2)"""
+    series_id, eps, user_id = seed(episodes=3)
+    first = watch(db, user_id, series_id, eps[0], "2024-01-02T00:00:00")
+    watch(db, user_id, series_id, eps[1], "2024-01-03T00:00:00")
+    base = download(admin, "/admin/backup/download/users")
+
+    other = execute(db, "INSERT INTO users (username, password, created_at) VALUES ('late', 'y', '2024-02-01')")
+    watch(db, other, series_id, eps[2], "2024-02-02T00:00:00")
+    execute(db, "DELETE FROM watch_history WHERE id = ?", (first,))
+    delta1 = download(admin, "/admin/backup/download/users/delta")
+    confirm(admin, delta1)
+
+    execute(db, "UPDATE users SET password = 'changed' WHERE id = ?", (user_id,))
+    execute(db, "DELETE FROM users WHERE id = ?", (other,))
+    watch(db, user_id, series_id, eps[2], "2024-03-01T00:00:00")
+    delta2 = download(admin, "/admin/backup/download/users/delta")
+    confirm(admin, delta2)
+    return base, delta1, delta2, snapshot(db)
+
+
+def test_base_plus_confirmed_deltas_restores_same_rows(db, admin, chain):
+    base, delta1, delta2, expected = chain
+    assert delta2["manifest"]["parent_id"] == delta1["manifest"]["id"]
+    assert delta1["manifest"]["parent_id"] == base["manifest"]["id"]
+
+    execute(db, "DELETE FROM watch_history")
+    execute(db, "INSERT INTO users (username, password, created_at) VALUES ('stray', 'z', '2024-04-01')")
+
+    # ลำดับที่อัปโหลดไม่สำคัญ ระบบเรียงตามสายเอง
+    flashes = restore(admin, delta2, base, delta1)
+    assert [cat for cat, _msg in flashes] == ["success"], flashes
+    assert snapshot(db) == expected
+
+
+def test_restore_refuses_gap_in_chain(db, admin, chain):
+    base, _delta1, delta2, expected = chain
+
+    flashes = restore(admin, base, delta2)
+    assert [cat for cat, _msg in flashes] == ["error"]
+    assert delta2["manifest"]["parent_id"] in flashes[0][1]
+    assert snapshot(db) == expected
@@ -0,0 +1,77 @@
+import pytest
+
+
+@pytest.fixture
+def admin(db):
+    client = db.app.test_client()
+    with client.session_transaction() as sess:
+        sess["is_admin"] = True
+    return client
+
+
+def rows(db):
+    conn = db.get_db_connection()
+    result = {
+        r["id"]: (r["is_active"], r["episode_number"])
+        for r in conn.execute("SELECT id, is_active, episode_number FROM episodes")
+    }
+    conn.close()
+    return result
+
+
+def bulk(client, action, ids, **form):
+    data = {"action": action, "ids": [str(i) for i in ids], "format": "json", **form}
+    resp = client.post("/admin/bulk/episodes", data=data)
+    assert resp.status_code == 200, resp.get_data(as_text=True)
+    return resp.get_json()["affected"]
+
+
+def changed(before, after):
+    return {i for i in before if before[i] != after.get(i)}
+
+
+def test_hide_and_show_touch_only_selected(db, seed, admin):
+    series_id, eps, _user = seed(episodes=4)
+    _other_series, other_eps, _other_user = seed(episodes=2)
+    before = rows(db)
+
+    assert bulk(admin, "hide", [eps[0], eps[2], other_eps[1]], series_id=series_id) == 3
+    after = rows(db)
+    assert changed(before, after) == {eps[0], eps[2], other_eps[1]}
+    assert {after[i][0] for i in (eps[0], eps[2], other_eps[1])} == {0}
+
+    # แถวที่เปิดอยู่แล้วไม่ถูกนับ
+    assert bulk(admin, "show", [eps[0], eps[1]], series_id=series_id) == 1
+    final = rows(db)
+    assert changed(after, final) == {eps[0]}
+    assert final[eps[0]][0] == 1
+
+
+def test_delete_removes_only_selected(db, seed, admin):
+    series_id, eps, _user = seed(episodes=4)
+    _other_series, other_eps, _other_user = seed(episodes=2)
+
+    assert bulk(admin, "delete", [eps[1], eps[3]], series_id=series_id) == 2
+    assert set(rows(db)) == {eps[0], eps[2], *other_eps}
+
+
+def test_renumber_selected_ids_in_given_order(db, seed, admin):
+    series_id, eps, _user = seed(episodes=4)
+    _other_series, other_eps, _other_user = seed(episodes=2)
+    before = rows(db)
+
+    # ตอนของเรื่องอื่นที่ติดมาต้องถูกข้าม
+    affected = bulk(admin, "renumber", [eps[3], eps[1], other_eps[0]], series_id=series_id, start="10")
+    assert affected == 2
+    after = rows(db)
+    assert changed(before, after) == {eps[3], eps[1]}
+    assert after[eps[3]][1] == 10
+    assert after[eps[1]][1] == 11
+
+
+def test_empty_selection_changes_nothing(db, seed, admin):
+    series_id, _eps, _user = seed(episodes=3)
+    before = rows(db)
+    resp = admin.post("/admin/bulk/episodes", data={"action": "delete", "series_id": series_id})
+    assert resp.status_code == 302
+    assert rows(db) == before
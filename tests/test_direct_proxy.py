@@ -0,0 +1,178 @@
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+
+DATA = os.urandom(300 * 1024 + 123)
+
+
+def origin_handler(data_ref, delay=0.0, etag='"v1"'):
+    """ต้นทางที่รองรับ Range (data_ref[0] คือข้อมูลปัจจุบัน เปลี่ยนได้ระหว่างทดสอบ)"""
+
+    def handle(request):
+        data = data_ref[0]
+        rng = request.headers.get("Range")
+        if not rng:
+            return 200, {"Content-Type": "video/mp4", "Content-Length": str(len(data))}, data
+        start, end = rng.split("=")[1].split("-")
+        start, end = int(start), min(int(end or len(data) - 1), len(data) - 1)
+        if delay and start != end:
+            time.sleep(delay)
+        body = data[start:end + 1]
+        return 206, {
+            "Content-Type": "video/mp4",
+            "Content-Length": str(len(body)),
+            "Content-Range": f"bytes {start}-{end}/{len(data)}",
+            "ETag": etag,
+        }, body
+
+    return handle
+
+
+@pytest.fixture
+def proxy(app, monkeypatch, tmp_path):
+    monkeypatch.setattr(app, "PROXY_CACHE_ROOT", str(tmp_path / "proxy_cache"))
+    monkeypatch.setattr(app, "PROXY_CHUNK_SIZE", 64 * 1024)
+    monkeypatch.setattr(app, "_proxy_lru", app.OrderedDict())
+    monkeypatch.setattr(app, "_proxy_lru_bytes", 0)
+    monkeypatch.setattr(app, "_proxy_lru_loaded", False)
+    return app
+
+
+def fetch(app, url, range_header=None):
+    headers = {"Range": range_header} if range_header else {}
+    with app.app.test_request_context("/stream/1", headers=headers):
+        resp = app.proxy_direct_response(url)
+        return resp.status_code, resp.headers, b"".join(resp.response)
+
+
+def chunk_requests(server):
+    return [r for r in server.requests if r["range"] != "bytes=0-0"]
+
+
+def test_range_across_chunks_is_served_from_cache(proxy, stub_server):
+    server = stub_server(origin_handler([DATA]))
+    url = server.url + "/video.mp4"
+
+    status, headers, body = fetch(proxy, url, "bytes=60000-200000")
+    assert status == 206
+    assert headers["Content-Range"] == f"bytes 60000-200000/{len(DATA)}"
+    assert body == DATA[60000:200001]
+    fetched = len(chunk_requests(server))
+    assert fetched == 4
+
+    status, _headers, body = fetch(proxy, url)
+    assert status == 200
+    assert body == DATA
+    assert len(chunk_requests(server)) == fetched + 1  # เฉพาะ chunk ที่ยังไม่มี
+
+
+def test_concurrent_readers_fetch_each_chunk_once(proxy, stub_server):
+    server = stub_server(origin_handler([DATA], delay=0.2))
+    url = server.url + "/video.mp4"
+    meta = proxy._proxy_meta(url)
+    results = []
+
+    def read():
+        with proxy._proxy_open_chunk(url, 1, meta["size"]) as f:
+            results.append(f.read())
+
+    threads = [threading.Thread(target=read) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert results == [DATA[64 * 1024:128 * 1024]] * 8
+    assert len(chunk_requests(server)) == 1
+    assert proxy._proxy_inflight == {}
+
+
+def test_short_upstream_chunk_is_not_cached(proxy, stub_server):
+    def short(request):
+        rng = request.headers.get("Range")
+        start, end = (int(x) for x in rng.split("=")[1].split("-"))
+        body = DATA[start:end + 1][:-10]
+        return 206, {"Content-Range": f"bytes {start}-{end}/{len(DATA)}", "Content-Length": str(len(body))}, body
+
+    server = stub_server(short)
+    url = server.url + "/video.mp4"
+
+    with pytest.raises(RuntimeError):
+        proxy._proxy_open_chunk(url, 1, len(DATA))
+    cache_dir = proxy._proxy_cache_dir(url)
+    assert not os.path.exists(cache_dir) or os.listdir(cache_dir) == []
+
+
+def test_meta_expires_and_changed_origin_drops_chunks(proxy, stub_server, monkeypatch):
+    data_ref = [DATA]
+    server = stub_server(origin_handler(data_ref))
+    url = server.url + "/video.mp4"
+    fetch(proxy, url, "bytes=0-10")
+
+    data_ref[0] = DATA[::-1] + b"more"
+    # ยังไม่หมดอายุ: ใช้ขนาดเดิมจากแคช
+    assert proxy._proxy_meta(url)["size"] == len(DATA)
+
+    monkeypatch.setattr(proxy, "PROXY_META_TTL", 0)
+    assert proxy._proxy_meta(url)["size"] == len(data_ref[0])
+    status, _headers, body = fetch(proxy, url, "bytes=0-10")
+    assert status == 206
+    assert body == data_ref[0][:11]
+
+
+def test_origin_without_range_support_redirects(proxy, stub_server):
+    def no_range(request):
+        return 200, {"Content-Type": "video/mp4", "Content-Length": str(len(DATA))}, DATA
+
+    server = stub_server(no_range)
+    status, headers, _body = fetch(proxy, server.url + "/video.mp4")
+    assert status == 302
+    assert headers["Location"].endswith("/video.mp4")
+
+
+def run_asgi_proxy(url, range_header=None):
+    import stream_asgi
+
+    sent = []
+
+    async def receive():
+        await asyncio.sleep(3600)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(stream_asgi._stream_proxy(send, receive, url, range_header, False))
+    return sent
+
+
+def test_asgi_unreachable_origin_redirects(proxy, stub_server):
+    server = stub_server(origin_handler([DATA]))
+    url = server.url + "/video.mp4"
+    server.close()
+
+    sent = run_asgi_proxy(url)
+    assert sent[0]["status"] == 302
+    assert (b"location", url.encode()) in sent[0]["headers"]
+
+
+def test_asgi_chunk_failure_ends_body(proxy, stub_server, monkeypatch):
+    import stream_asgi
+
+    monkeypatch.setattr(stream_asgi, "PROXY_CHUNK_SIZE", proxy.PROXY_CHUNK_SIZE)
+    healthy = origin_handler([DATA])
+
+    def failing(request):
+        rng = request.headers.get("Range")
+        if rng in ("bytes=0-0", f"bytes=0-{64 * 1024 - 1}"):
+            return healthy(request)
+        return 500, {"Content-Length": "0"}, b""
+
+    server = stub_server(failing)
+    sent = run_asgi_proxy(server.url + "/video.mp4", "bytes=0-200000")
+    assert sent[0]["status"] == 206
+    body = b"".join(m["body"] for m in sent[1:])
+    assert body == DATA[:64 * 1024]
+    assert not sent[-1].get("more_body")
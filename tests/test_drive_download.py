@@ -0,0 +1,172 @@
+import hashlib
+import os
+import struct
+
+import pytest
+
+
+def box(kind, payload):
+    return struct.pack(">I4s", 8 + len(payload), kind) + payload
+
+
+MP4 = box(b"ftyp", b"isom" * 4) + box(b"moov", b"m" * 4000) + box(b"mdat", os.urandom(300000))
+
+
+def ranged_handler(data, cut_first=None):
+    """ตอบแบบรองรับ Range ถ้า cut_first ระบุ คำขอดาวน์โหลดแรก (ไม่นับ probe) จะถูกตัดหลังส่งไปกี่ไบต์"""
+    state = {"cut": cut_first}
+
+    def handle(request):
+        start = 0
+        rng = request.headers.get("Range")
+        if rng:
+            start = int(rng.split("=")[1].split("-")[0])
+            if start >= len(data):
+                return 416, {"Content-Range": f"bytes */{len(data)}"}, b""
+        body = data[start:]
+        headers = {"Content-Type": "video/mp4", "Content-Length": str(len(body))}
+        status = 200
+        if rng:
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{len(data) - 1}/{len(data)}"
+        if state["cut"] is not None and rng != "bytes=0-0":
+            cut, state["cut"] = state["cut"], None
+            return request.cut(status, headers, body[:cut])
+        return status, headers, body
+
+    return handle
+
+
+@pytest.fixture
+def drive(app, monkeypatch, stub_server):
+    def start(handler):
+        server = stub_server(handler)
+        monkeypatch.setattr(app, "DRIVE_DOWNLOAD_URL", server.url + "/download?id={id}")
+        return server
+
+    monkeypatch.setattr(app, "DRIVE_RETRY_BACKOFF", 0)
+    monkeypatch.setattr(app, "DRIVE_GDOWN_FALLBACK", False)
+    return start
+
+
+def test_resume_after_disconnect(app, drive):
+    server = drive(ranged_handler(MP4, cut_first=len(MP4) // 2))
+
+    path, size, digest = app.fetch_drive_file("resume", 1)
+
+    assert open(path, "rb").read() == MP4
+    assert size == len(MP4)
+    assert digest == hashlib.sha256(MP4).hexdigest()
+    resumed = [r["range"] for r in server.requests if r["range"] not in (None, "bytes=0-0")]
+    assert resumed and int(resumed[0].split("=")[1].rstrip("-")) > 0
+    assert not os.path.exists(path + ".part")
+
+
+def test_truncated_file_resumes_from_its_size(app, drive):
+    server = drive(ranged_handler(MP4))
+    target = os.path.join(app.VIDEO_ROOT, "series_1", "old.mp4")
+    os.makedirs(os.path.dirname(target))
+    with open(target, "wb") as f:
+        f.write(MP4[:50000])
+
+    path, _size, _digest = app.fetch_drive_file("old", 1)
+
+    assert open(path, "rb").read() == MP4
+    assert [r["range"] for r in server.requests] == ["bytes=50000-"]
+
+
+def test_range_answered_with_200_restarts_file(app, drive):
+    def ignore_range(request):
+        return 200, {"Content-Type": "video/mp4", "Content-Length": str(len(MP4))}, MP4
+
+    server = drive(ignore_range)
+    part = os.path.join(app.VIDEO_ROOT, "series_1", "full.mp4.part")
+    os.makedirs(os.path.dirname(part))
+    with open(part, "wb") as f:
+        f.write(MP4[:1000])
+
+    path, size, _digest = app.fetch_drive_file("full", 1)
+
+    assert server.requests[0]["range"] == "bytes=1000-"
+    assert size == len(MP4)
+    assert open(path, "rb").read() == MP4
+
+
+def test_html_quota_page_is_rejected(app, drive):
+    def quota_page(request):
+        body = b"<html>Quota exceeded</html>"
+        return 200, {"Content-Type": "text/html; charset=utf-8", "Content-Length": str(len(body))}, body
+
+    drive(quota_page)
+
+    with pytest.raises(RuntimeError, match="หน้าเว็บ"):
+        app.fetch_drive_file("quota", 1)
+    assert not os.path.exists(os.path.join(app.VIDEO_ROOT, "series_1", "quota.mp4"))
+
+
+def test_size_mismatch_is_rejected(app, drive):
+    def no_length(request):
+        # ไม่บอกขนาด ต้องเทียบกับขนาดที่เคยบันทึกไว้
+        request.close_connection = True
+        return 200, {"Content-Type": "video/mp4"}, MP4[:-100]
+
+    drive(no_length)
+
+    with pytest.raises(RuntimeError, match="ขนาดไฟล์"):
+        app.fetch_drive_file("short", 1, known_size=len(MP4), known_sha256="0" * 64)
+    folder = os.path.join(app.VIDEO_ROOT, "series_1")
+    assert os.listdir(folder) == []
+
+
+def test_truncated_mp4_box_is_rejected(app, drive):
+    data = MP4[:-100]
+
+    def lying_length(request):
+        return 200, {"Content-Type": "video/mp4", "Content-Length": str(len(data))}, data
+
+    drive(lying_length)
+
+    with pytest.raises(RuntimeError, match="mdat"):
+        app.fetch_drive_file("cut", 1)
+
+
+def test_non_mp4_file_is_only_size_checked(app, drive):
+    mkv = b"\x1a\x45\xdf\xa3" + os.urandom(5000)
+
+    def serve(request):
+        return 200, {"Content-Type": "video/x-matroska", "Content-Length": str(len(mkv))}, mkv
+
+    drive(serve)
+
+    path, size, _digest = app.fetch_drive_file("movie", 1)
+    assert size == len(mkv)
+    assert open(path, "rb").read() == mkv
+
+
+def test_existing_verified_file_is_not_rehashed(app, drive, monkeypatch):
+    server = drive(ranged_handler(MP4))
+    path, size, digest = app.fetch_drive_file("cached", 1)
+    requests_before = len(server.requests)
+
+    def fail(*args):
+        raise AssertionError("ไม่ควรอ่านไฟล์ซ้ำ")
+
+    monkeypatch.setattr(app, "_file_sha256", fail)
+    monkeypatch.setattr(app, "check_mp4_structure", fail)
+
+    assert app.fetch_drive_file("cached", 1, known_size=size, known_sha256=digest) == (path, size, digest)
+    assert len(server.requests) == requests_before
+    assert os.listdir(os.path.dirname(path)) == ["cached.mp4"]
+
+
+def test_segmented_download(app, drive, monkeypatch):
+    monkeypatch.setattr(app, "DRIVE_SEGMENT_BYTES", 64 * 1024)
+    server = drive(ranged_handler(MP4))
+
+    path, _size, digest = app.fetch_drive_file("segments", 1)
+
+    assert digest == hashlib.sha256(MP4).hexdigest()
+    ranges = [r["range"] for r in server.requests]
+    assert ranges[0] == "bytes=0-0"
+    assert len(ranges) == 1 + -(-len(MP4) // (64 * 1024))
+    assert not os.path.exists(path + ".part.ranges")
@@ -0,0 +1,106 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+
+@pytest.fixture
+def importer(db, tmp_path, monkeypatch):
+    """import_episode_manifest ที่ fetch_drive_file / รูปปกเป็นของปลอม ไฟล์ Drive ชื่อ bad จะโหลดไม่สำเร็จ"""
+    gate = threading.Event()
+    budget_calls = []
+
+    def fake_fetch(file_id, series_id, known_size=None, known_sha256=None, priority=None):
+        assert priority == db.DOWNLOAD_PRIORITY_PREFETCH
+        gate.wait(5)
+        if file_id.startswith("bad"):
+            raise RuntimeError("quota")
+        path = os.path.join(db.VIDEO_ROOT, f"series_{series_id}", f"{file_id}.mp4")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(b"x" * 10)
+        return path, 10, "0" * 64
+
+    # pool ของการทดสอบนี้เอง ปิดให้เสร็จก่อนที่ monkeypatch จะคืนค่า VIDEO_ROOT / DB_PATH
+    pool = ThreadPoolExecutor(max_workers=4)
+    monkeypatch.setattr(db, "_import_download_pool", pool)
+    monkeypatch.setattr(db, "fetch_drive_file", fake_fetch)
+    monkeypatch.setattr(db, "_fetch_episode_cover", lambda episode_id, url: f"covers/episodes/ep_{episode_id}/c.jpg")
+    monkeypatch.setattr(db, "enforce_video_disk_budget", lambda keep=None: budget_calls.append(set(keep)))
+
+    conn = db.get_db_connection()
+    series_id = conn.execute("INSERT INTO series (title, created_at) VALUES ('s', '2024-01-01')").lastrowid
+    conn.commit()
+    conn.close()
+    yield SimpleNamespace(app=db, gate=gate, budget_calls=budget_calls, series_id=series_id)
+    gate.set()
+    pool.shutdown(wait=True)
+
+
+def episode_rows(importer):
+    conn = importer.app.get_db_connection()
+    rows = {
+        r["episode_number"]: dict(r)
+        for r in conn.execute("SELECT * FROM episodes WHERE series_id = ?", (importer.series_id,))
+    }
+    conn.close()
+    return rows
+
+
+ITEMS = [
+    {"episode_number": "1", "title": "one", "drive": "fileAAAAAAAAAAAAAAAAAAAA", "thumbnail_url": "http://x/1.jpg"},
+    {"episode_number": "2", "title": "two", "drive": "fileBBBBBBBBBBBBBBBBBBBB"},
+    {"episode_number": "3", "title": "three", "drive": "badCCCCCCCCCCCCCCCCCCCCC"},
+    {"episode_number": "4", "title": "four", "video_url": "http://x/4.mp4"},
+]
+
+
+def test_rows_are_inserted_before_downloads_finish(importer):
+    results = importer.app.import_episode_manifest(importer.series_id, ITEMS)
+
+    # คืนผลทันทีโดยที่ยังไม่มีไฟล์ไหนโหลดเสร็จ ทุกแถวอยู่ใน DB แล้ว
+    rows = episode_rows(importer)
+    assert sorted(rows) == [1, 2, 3, 4]
+    assert [r["video"] for r in results] == ["queued", "queued", "queued", "linked"]
+    assert [rows[n]["download_state"] for n in (1, 2, 3, 4)] == ["pending", "pending", "pending", None]
+
+    importer.gate.set()
+    for _ in range(100):
+        rows = episode_rows(importer)
+        if all(rows[n]["download_state"] != "pending" for n in (1, 2, 3)):
+            break
+        threading.Event().wait(0.05)
+
+    assert rows[1]["download_state"] is None and rows[1]["file_path"].endswith("fileAAAAAAAAAAAAAAAAAAAA.mp4")
+    assert rows[1]["thumbnail_url"].startswith("covers/episodes/")
+    assert rows[2]["download_state"] is None and rows[2]["file_size"] == 10
+    assert rows[3]["download_state"] == "failed" and rows[3]["file_path"] is None
+
+
+def test_budget_pass_protects_every_file_of_the_import(importer):
+    importer.gate.set()
+    importer.app.import_episode_manifest(importer.series_id, ITEMS[:2], wait=True)
+    assert len(importer.budget_calls) == 2
+    protected = importer.budget_calls[-1]
+    assert {os.path.basename(p) for p in protected} == {
+        "fileAAAAAAAAAAAAAAAAAAAA.mp4",
+        "fileBBBBBBBBBBBBBBBBBBBB.mp4",
+    }
+
+
+def test_rerun_requeues_failed_drive_rows(importer, monkeypatch):
+    importer.gate.set()
+    results = importer.app.import_episode_manifest(importer.series_id, ITEMS[2:3], wait=True)
+    assert results[0]["status"] == "error" and results[0]["video"] == "failed"
+    assert episode_rows(importer)[3]["download_state"] == "failed"
+
+    fetch = importer.app.fetch_drive_file
+    monkeypatch.setattr(
+        importer.app, "fetch_drive_file", lambda file_id, *a, **kw: fetch("ok" + file_id, *a, **kw)
+    )
+    results = importer.app.import_episode_manifest(importer.series_id, ITEMS[2:3], wait=True)
+    assert results[0]["status"] == "skipped" and results[0]["video"] == "downloaded"
+    rows = episode_rows(importer)
+    assert len(rows) == 1 and rows[3]["download_state"] is None
@@ -0,0 +1,48 @@
+from datetime import datetime, timedelta
+
+
+def seed_history(app, ages_days):
+    conn = app.get_db_connection()
+    series_id = conn.execute("INSERT INTO series (title, created_at) VALUES ('s', '2024-01-01')").lastrowid
+    episode_id = conn.execute(
+        "INSERT INTO episodes (series_id, title, source_type, created_at) VALUES (?, 'e', 'direct', '2024-01-01')",
+        (series_id,),
+    ).lastrowid
+    user_id = conn.execute(
+        "INSERT INTO users (username, password, created_at) VALUES ('u', 'x', '2024-01-01')"
+    ).lastrowid
+    now = datetime.utcnow()
+    ids = [
+        conn.execute(
+            "INSERT INTO watch_history (user_id, series_id, episode_id, watched_at) VALUES (?, ?, ?, ?)",
+            (user_id, series_id, episode_id, (now - timedelta(days=age)).isoformat()),
+        ).lastrowid
+        for age in ages_days
+    ]
+    conn.commit()
+    conn.close()
+    return ids
+
+
+def test_retention_does_not_feed_the_backup_changelog(db, monkeypatch):
+    monkeypatch.setattr(db, "HISTORY_RETENTION_SLEEP", 0)
+    ids = seed_history(db, [90, 80, 70, 60, 1, 1])
+
+    conn = db.get_db_connection()
+    db.record_backup_manifest(conn, "base", None)
+    # ผู้ใช้ลบประวัติเองหนึ่งแถว แถวนี้ต้องยังอยู่ใน delta
+    conn.execute("DELETE FROM watch_history WHERE id = ?", (ids[-1],))
+    conn.commit()
+    conn.close()
+
+    result = db.prune_watch_history(days=30, mode="rollup", batch=3)
+    assert result["moved"] == 4
+
+    conn = db.get_db_connection()
+    logged = [r[0] for r in conn.execute("SELECT row_id FROM backup_changelog WHERE table_name = 'watch_history'")]
+    delta = db.build_users_delta(conn)
+    daily = conn.execute("SELECT SUM(view_count) FROM watch_history_daily").fetchone()[0]
+    conn.close()
+    assert logged == [ids[-1]]
+    assert delta["deleted"]["watch_history"] == [ids[-1]]
+    assert daily == 4
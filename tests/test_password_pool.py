@@ -0,0 +1,40 @@
+import threading
+import time
+
+import pytest
+
+
+@pytest.fixture
+def hasher(app, monkeypatch):
+    monkeypatch.setattr(app, "_password_slots", threading.BoundedSemaphore(1))
+    return app
+
+
+def test_pool_does_not_fork(hasher):
+    assert hasher._get_password_pool()._mp_context.get_start_method() in ("forkserver", "spawn")
+
+
+def test_hash_round_trip(hasher):
+    pwhash = hasher.hash_password("secret")
+    assert hasher.verify_password(pwhash, "secret")
+    assert not hasher.verify_password(pwhash, "wrong")
+
+
+def test_timed_out_job_keeps_its_slot_until_it_finishes(hasher, monkeypatch):
+    hasher._run_password_job(time.sleep, 0)  # ให้ process ใน pool พร้อมก่อนจับเวลา
+    monkeypatch.setattr(hasher, "PASSWORD_HASH_TIMEOUT", 0.2)
+    rejected = hasher.password_metrics["rejected"]
+    with pytest.raises(hasher.PasswordHasherBusy):
+        hasher._run_password_job(time.sleep, 1.5)
+
+    # งานแรกยังรันอยู่ใน pool: คิว (ขนาด 1) ยังเต็ม
+    with pytest.raises(hasher.PasswordHasherBusy):
+        hasher._run_password_job(time.sleep, 0)
+    assert hasher.password_metrics["rejected"] == rejected + 1
+
+    deadline = time.monotonic() + 10
+    while not hasher._password_slots.acquire(blocking=False):
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+    hasher._password_slots.release()
+    assert hasher._run_password_job(time.sleep, 0) is None
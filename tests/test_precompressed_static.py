@@ -0,0 +1,37 @@
+import gzip
+import os
+
+
+def test_compress_static_command_builds_and_stale_file_is_not_served(app, tmp_path, monkeypatch):
+    static = tmp_path / "static"
+    static.mkdir()
+    source = static / "site.css"
+    source.write_text("body { color: red; }\n" * 200)
+    monkeypatch.setattr(app.app, "static_folder", str(static))
+    monkeypatch.setattr(app, "COMPRESS_ENABLED", True)
+    monkeypatch.setattr(app, "brotli", None)
+
+    result = app.app.test_cli_runner().invoke(args=["compress-static"])
+    assert result.exit_code == 0, result.output
+    assert gzip.decompress((static / "site.css.gz").read_bytes()) == source.read_bytes()
+
+    client = app.app.test_client()
+    resp = client.get("/static/site.css", headers={"Accept-Encoding": "gzip"})
+    assert resp.headers.get("Content-Encoding") == "gzip"
+    resp.close()
+
+    # แก้ต้นฉบับหลัง deploy แต่ยังไม่ได้รันคำสั่งใหม่: ต้องไม่ส่งไฟล์ .gz เก่า
+    source.write_text("body { color: blue; }\n")
+    gz = static / "site.css.gz"
+    old = os.path.getmtime(source) - 10
+    os.utime(gz, (old, old))
+    resp = client.get("/static/site.css", headers={"Accept-Encoding": "identity"})
+    assert resp.headers.get("Content-Encoding") is None
+    assert resp.get_data() == b"body { color: blue; }\n"
+    resp.close()
+    resp = client.get("/static/site.css", headers={"Accept-Encoding": "gzip"})
+    body = resp.get_data()
+    if resp.headers.get("Content-Encoding") == "gzip":
+        body = gzip.decompress(body)
+    assert body == b"body { color: blue; }\n"
+    resp.close()
@@ -0,0 +1,46 @@
+import threading
+
+import pytest
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def limited(db, request, tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "RATE_LIMIT_ENABLED", True)
+    monkeypatch.setattr(db, "RATE_LIMIT_BACKEND", request.param)
+    monkeypatch.setattr(db, "RATE_LIMIT_DB", str(tmp_path / "ratelimit.db"))
+    monkeypatch.setattr(db, "_ratelimit_local", threading.local())
+    monkeypatch.setattr(db, "_memory_buckets", {})
+    monkeypatch.setattr(db, "rate_limit_rejections", {})
+    monkeypatch.setitem(db.RATE_LIMIT_POLICIES, "search_suggest", [(("GET",), "ip", 3, 0.1)])
+    return db
+
+
+def suggest(client, ip):
+    return client.get("/search/suggest?q=x", environ_base={"REMOTE_ADDR": ip})
+
+
+def test_exhausted_bucket_returns_429_with_retry_after(limited):
+    client = limited.app.test_client()
+    assert [suggest(client, "10.0.0.1").status_code for _ in range(3)] == [200, 200, 200]
+
+    resp = suggest(client, "10.0.0.1")
+    assert resp.status_code == 429
+    # ขาดหนึ่ง token เติม 0.1 ต่อวินาที: ต้องรอประมาณ 10 วินาที
+    assert 9 <= int(resp.headers["Retry-After"]) <= 10
+    assert limited.rate_limit_rejections == {"search_suggest": 1}
+
+    # bucket แยกตาม IP
+    assert suggest(client, "10.0.0.2").status_code == 200
+
+
+def test_bucket_refills_over_time(limited, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(limited.time, "time", lambda: clock[0])
+    client = limited.app.test_client()
+    for _ in range(3):
+        assert suggest(client, "10.0.0.1").status_code == 200
+    assert suggest(client, "10.0.0.1").status_code == 429
+
+    clock[0] += 10
+    assert suggest(client, "10.0.0.1").status_code == 200
+    assert suggest(client, "10.0.0.1").status_code == 429
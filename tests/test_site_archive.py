@@ -0,0 +1,114 @@
+import io
+import json
+import os
+import sqlite3
+import tarfile
+
+import pytest
+
+
+@pytest.fixture
+def site(db, tmp_path, monkeypatch):
+    base = tmp_path / "site"
+    (base / "static" / "covers").mkdir(parents=True)
+    monkeypatch.setattr(db, "BASE_DIR", str(base))
+    monkeypatch.setattr(db, "COVER_ROOT", str(base / "static" / "covers"))
+    monkeypatch.setattr(db, "VIDEO_ROOT", str(base / "video_files"))
+    return db
+
+
+def build_archive(tmp_path, files, rewrites=None):
+    """archive ที่มี manifest, DB ที่ถูกต้อง และไฟล์สื่อตาม files (path -> bytes)"""
+    db_path = tmp_path / "archive.db"
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE IF NOT EXISTS series (id INTEGER PRIMARY KEY)")
+    conn.execute("CREATE TABLE IF NOT EXISTS episodes (id INTEGER PRIMARY KEY)")
+    conn.commit()
+    conn.close()
+
+    out = io.BytesIO()
+    with tarfile.open(fileobj=out, mode="w:gz") as tar:
+
+        def add(name, data):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+        manifest = {"version": "myseries_site_v1", "files": sorted(files), "rewrites": rewrites or []}
+        add("manifest.json", json.dumps(manifest).encode("utf-8"))
+        add("db/videos.db", db_path.read_bytes())
+        for rel, data in files.items():
+            add("media/" + rel, data)
+    out.seek(0)
+    return out
+
+
+def add_episode(app, file_path, title="ep"):
+    conn = app.get_db_connection()
+    series_id = conn.execute(
+        "INSERT INTO series (title, created_at) VALUES ('s', '2024-01-01')"
+    ).lastrowid
+    episode_id = conn.execute(
+        "INSERT INTO episodes (series_id, title, source_type, file_path, created_at) "
+        "VALUES (?, ?, 'upload', ?, '2024-01-01')",
+        (series_id, title, file_path),
+    ).lastrowid
+    conn.commit()
+    conn.close()
+    return episode_id
+
+
+@pytest.mark.parametrize(
+    "rel",
+    [
+        "app.py",
+        "templates/base.html",
+        "videos.db-wal",
+        "video_files/../app.py",
+        "static/covers/../../app.py",
+        "static/other.css",
+    ],
+)
+def test_import_rejects_media_outside_media_roots(site, tmp_path, rel):
+    archive = build_archive(tmp_path, {rel: b"owned"})
+    with pytest.raises(ValueError, match="ไม่ปลอดภัย"):
+        site.import_site_archive(archive)
+    assert not os.path.exists(os.path.join(site.BASE_DIR, "app.py"))
+    assert not os.path.exists(os.path.join(site.BASE_DIR, rel))
+
+
+def test_import_rejects_rewrite_outside_media_roots(site, tmp_path):
+    archive = build_archive(
+        tmp_path,
+        {"video_files/a.mp4": b"x"},
+        rewrites=[{"table": "episodes", "column": "thumbnail_url", "id": 1, "path": "video_files/a.mp4"}],
+    )
+    with pytest.raises(ValueError, match="ไม่ปลอดภัย"):
+        site.import_site_archive(archive)
+
+
+def test_external_files_with_same_name_round_trip(site, tmp_path):
+    for name, data in (("a", b"first"), ("b", b"second")):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / "1.mp4").write_bytes(data)
+    first = add_episode(site, str(tmp_path / "a" / "1.mp4"))
+    second = add_episode(site, str(tmp_path / "b" / "1.mp4"))
+
+    out = io.BytesIO()
+    site._write_site_archive(out, "gzip")
+    out.seek(0)
+    result = site.import_site_archive(out)
+    assert result["media_files"] == 2
+
+    conn = site.get_db_connection()
+    rows = {
+        r["id"]: r["file_path"]
+        for r in conn.execute("SELECT id, file_path FROM episodes WHERE id IN (?, ?)", (first, second))
+    }
+    conn.close()
+    assert rows[first] != rows[second]
+    for episode_id, data in ((first, b"first"), (second, b"second")):
+        path = rows[episode_id]
+        assert path.startswith("video_files/external/")
+        with open(os.path.join(site.BASE_DIR, path), "rb") as f:
+            assert f.read() == data
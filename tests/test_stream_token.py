@@ -0,0 +1,77 @@
+import os
+
+import pytest
+
+
+@pytest.fixture
+def token_setup(db, seed, tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "VISIBILITY_GENERATION_TTL", 0)
+    series_id, episode_ids, user_id = seed()
+    video = tmp_path / "ep.mp4"
+    video.write_bytes(b"\0" * 16)
+    conn = db.get_db_connection()
+    conn.execute("UPDATE episodes SET file_path = ? WHERE id = ?", (str(video), episode_ids[0]))
+    conn.commit()
+    conn.close()
+    db.invalidate_catalog_version_cache()
+    token = db.make_stream_token(user_id, episode_ids[0], str(video), False)
+    return series_id, episode_ids, user_id, str(video), token
+
+
+def verified_path(db, token, user_id, episode_id):
+    verified = db.verify_stream_token(token, user_id, episode_id)
+    return verified and (os.path.abspath(verified[0]), verified[1])
+
+
+def execute(db, sql, params=()):
+    conn = db.get_db_connection()
+    conn.execute(sql, params)
+    conn.commit()
+    conn.close()
+
+
+def test_token_is_bound_to_user_and_episode(db, token_setup):
+    _series_id, episode_ids, user_id, video, token = token_setup
+    assert verified_path(db, token, user_id, episode_ids[0]) == (video, False)
+    assert db.verify_stream_token(token, user_id + 1, episode_ids[0]) is None
+    assert db.verify_stream_token(token, user_id, episode_ids[1]) is None
+    body, sig = token.split(".")
+    assert db.verify_stream_token(body + "." + sig[::-1], user_id, episode_ids[0]) is None
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "UPDATE episodes SET is_active = 0 WHERE id = {other}",
+        "UPDATE series SET is_active = 0 WHERE id = {series}",
+        "DELETE FROM episodes WHERE id = {other}",
+        "INSERT INTO episodes (series_id, title, episode_number, is_active, source_type, created_at)"
+        " VALUES ({series}, 'hidden', 99, 0, 'direct', '2024-01-01')",
+    ],
+)
+def test_visibility_generation_bump_revokes_token(db, token_setup, sql):
+    series_id, episode_ids, user_id, _video, token = token_setup
+    execute(db, sql.format(other=episode_ids[1], series=series_id))
+    assert db.verify_stream_token(token, user_id, episode_ids[0]) is None
+
+
+def test_unrelated_changes_keep_token(db, token_setup):
+    series_id, episode_ids, user_id, video, token = token_setup
+    execute(db, "UPDATE episodes SET title = 'renamed' WHERE id = ?", (episode_ids[1],))
+    execute(
+        db,
+        "INSERT INTO episodes (series_id, title, episode_number, source_type, created_at)"
+        " VALUES (?, 'new', 50, 'direct', '2024-01-01')",
+        (series_id,),
+    )
+    assert verified_path(db, token, user_id, episode_ids[0]) == (video, False)
+
+
+def test_visibility_index_follows_generation(db, token_setup):
+    series_id, episode_ids, _user_id, _video, _token = token_setup
+    assert db.is_episode_visible(series_id, episode_ids[1])
+    execute(db, "UPDATE episodes SET is_active = 0 WHERE id = ?", (episode_ids[1],))
+    assert not db.is_episode_visible(series_id, episode_ids[1])
+    assert db.is_episode_visible(series_id, episode_ids[0])
+    execute(db, "UPDATE series SET is_active = 0 WHERE id = ?", (series_id,))
+    assert not db.is_episode_visible(series_id, episode_ids[0])
@@ -0,0 +1,53 @@
+def rollup(app, user_id, series_id):
+    conn = app.get_db_connection()
+    row = conn.execute(
+        "SELECT last_episode_id, view_count FROM series_watch_rollup WHERE user_id = ? AND series_id = ?",
+        (user_id, series_id),
+    ).fetchone()
+    conn.close()
+    return tuple(row) if row else None
+
+
+def watch(app, user_id, series_id, episode_ids):
+    conn = app.get_db_connection()
+    for episode_id in episode_ids:
+        app.record_watch(conn, user_id, series_id, episode_id)
+    conn.commit()
+    conn.close()
+
+
+def delete_episode(app, episode_id):
+    conn = app.get_db_connection()
+    conn.execute("DELETE FROM episodes WHERE id = ?", (episode_id,))
+    conn.commit()
+    conn.close()
+
+
+def test_deleting_last_watched_episode_keeps_the_series(seed, db):
+    series_id, (ep1, ep2, ep3), user_id = seed()
+    watch(db, user_id, series_id, [ep1, ep2, ep1, ep3])
+
+    delete_episode(db, ep3)
+    assert rollup(db, user_id, series_id) == (ep1, 4)
+
+    delete_episode(db, ep2)
+    assert rollup(db, user_id, series_id) == (ep1, 4)
+
+    delete_episode(db, ep1)
+    assert rollup(db, user_id, series_id) == (None, 4)
+
+    client = db.app.test_client()
+    with client.session_transaction() as s:
+        s["user_id"] = user_id
+    page = client.get("/me").get_data(as_text=True)
+    assert "series 1" in page and "(4 ครั้ง)" in page
+
+
+def test_deleting_the_series_still_removes_the_row(seed, db):
+    series_id, (ep1, _ep2, _ep3), user_id = seed()
+    watch(db, user_id, series_id, [ep1])
+    conn = db.get_db_connection()
+    conn.execute("DELETE FROM series WHERE id = ?", (series_id,))
+    conn.commit()
+    conn.close()
+    assert rollup(db, user_id, series_id) is None